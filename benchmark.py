@@ -0,0 +1,373 @@
+# coding=UTF-8
+"""开放时段压力测试：模拟大量家长登录、预约以及老师在实时面板上处理队列，
+统计各路由与Socket事件的吞吐量、p50/p95/p99延迟以及每个请求的数据库操作次数。
+
+用法：
+    python benchmark.py --parents 300 --teachers 11 --events 20
+    python benchmark.py --storage memory         # 使用内置的内存存储引擎，不需要MongoDB
+    python benchmark.py --storage mongomock      # 不需要MongoDB，需安装mongomock
+    python benchmark.py --surge                  # 以排队预约模式运行
+    python benchmark.py --event grade8           # 压测events.json中的某个场次
+    python benchmark.py --slow-mongo 2           # 另测一次2秒的慢查询期间其他老师的队列更新多久送达
+    python benchmark.py --concurrency 20         # 20个并发客户端同时预约、处理队列，统计写入冲突与重试次数
+
+默认连接 AQS_MONGODB_URI（缺省为本机mongod）中的 aqs_bench 数据库，每次运行前会清空该数据库。
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class OpCounter:
+    """统计数据库调用次数，按当前正在测量的路由或事件归类"""
+
+    def __init__(self):
+        # 线程id -> 该线程正在测量的路由或事件，并发运行时各客户端分别归类
+        self.labels = {}
+        self.counts = defaultdict(int)
+        # 线程id -> 该线程下一次数据库调用前的等待秒数
+        self.stalls = {}
+        # 以版本号为条件的写入未匹配（比较交换冲突）与名额条件不满足被拒绝的次数，以及冲突后重新加载队列重试的次数
+        self.conflicts = 0
+        self.rejections = 0
+        self.retries = 0
+
+    @property
+    def current(self):
+        return self.labels.get(threading.get_ident())
+
+    @current.setter
+    def current(self, label):
+        self.labels[threading.get_ident()] = label
+
+    def stall_next(self, delay):
+        """当前线程的下一次数据库调用等待delay秒，模拟一次慢查询；eventlet下time.sleep与等待网络一样会让出"""
+        self.stalls[threading.get_ident()] = delay
+
+    def hit(self):
+        if self.current is not None:
+            self.counts[self.current] += 1
+        delay = self.stalls.pop(threading.get_ident(), 0)
+        if delay:
+            time.sleep(delay)
+
+    def check(self, name, query, result):
+        """统计条件写入的结果：带version条件的更新未匹配为冲突，带名额条件（$expr）的占用未写入为拒绝"""
+        if not isinstance(query, dict):
+            return
+        if name == 'update_one' and 'version' in query and not result.matched_count:
+            self.conflicts += 1
+        elif name == 'find_one_and_update' and '$expr' in query and result is None:
+            self.rejections += 1
+
+
+class CountingCollection:
+    """包装集合对象，每次调用集合方法记为一次数据库操作"""
+
+    def __init__(self, collection, counter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self._counter.hit()
+            result = attr(*args, **kwargs)
+            if args:
+                self._counter.check(name, args[0], result)
+            return result
+        return call
+
+
+class CountingDatabase:
+    def __init__(self, database, counter):
+        self._database = database
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return CountingCollection(self._database[name], self._counter)
+
+    def __getitem__(self, name):
+        return CountingCollection(self._database[name], self._counter)
+
+
+class Recorder:
+    def __init__(self, counter):
+        self.counter = counter
+        self.latencies = defaultdict(list)
+
+    def measure(self, label, func, *args, **kwargs):
+        self.counter.current = label
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.latencies[label].append(time.perf_counter() - started)
+            self.counter.current = None
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def run_parallel(concurrency, items, func):
+    """把items轮流分给concurrency个并发客户端，每个客户端按顺序对分到的项调用func；
+    eventlet模式下threading已被替换为绿色线程，客户端在数据库I/O上交替执行"""
+    if concurrency <= 1:
+        for item in items:
+            func(item)
+        return
+    errors = []
+
+    def worker(chunk):
+        try:
+            for item in chunk:
+                func(item)
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=worker, args=(items[i::concurrency],)) for i in range(min(concurrency, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def load_app(args):
+    """按参数配置环境变量后导入main_app，导入时会连接数据库并初始化老师数据"""
+    os.environ['AQS_DB_NAME'] = args.db_name
+    # 每次运行前都会清空数据库，不使用也不写入预热快照
+    os.environ['AQS_WARM_START_INTERVAL'] = '0'
+    if args.mongodb_uri:
+        os.environ['AQS_MONGODB_URI'] = args.mongodb_uri
+    if args.surge:
+        os.environ['AQS_SURGE_MODE'] = '1'
+    if args.storage == 'memory':
+        os.environ['AQS_STORAGE'] = 'memory'
+    elif args.storage == 'mongomock':
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit('--storage mongomock 需要先安装mongomock：pip install mongomock')
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    else:
+        import pymongo
+        uri = os.environ.get('AQS_MONGODB_URI', 'mongodb://127.0.0.1:27017/')
+        pymongo.MongoClient(uri).drop_database(args.db_name)
+    os.chdir(BASE_DIR)
+    sys.path.insert(0, BASE_DIR)
+    import main_app
+    main_app.ENABLE_TIME_CHECK = False
+    # 测试客户端中让Socket事件同步执行，才能测到处理耗时
+    main_app.socketio.server.async_handlers = False
+    return main_app
+
+
+def run(args):
+    main_app = load_app(args)
+    counter = OpCounter()
+    main_app.db = CountingDatabase(main_app.db, counter)
+    for item in main_app.events:
+        item.bind(main_app.db)
+    event = main_app.events.get(args.event) if args.event else main_app.events.default
+    if event is None:
+        sys.exit(f'未找到场次{args.event}')
+    recorder = Recorder(counter)
+    app = main_app.app
+    rng = random.Random(args.seed)
+    ip_base = rng.randrange(1, 200)
+    classes = [name for grade in main_app.classes_data.values() for name in grade]
+    teacher_ids = [str(teacher['id']) for teacher in event.teachers][:args.teachers]
+    # 已加载的队列因冲突重新加载即为一次重试，首次加载不计
+    reload_queue = event.reload_queue
+
+    def counting_reload(teacher_id):
+        if str(teacher_id) in event.queues:
+            counter.retries += 1
+        return reload_queue(teacher_id)
+    event.reload_queue = counting_reload
+
+    # 随机选择在开始前全部确定，并发运行时结果与运行顺序无关
+    parents = []
+    for i in range(args.parents):
+        class_name = rng.choice(classes)
+        candidates = [teacher['id'] for teacher in event.teachers if class_name in teacher['class'] and str(teacher['id']) in teacher_ids]
+        chosen = rng.sample(candidates, min(len(candidates), rng.randint(1, 3)))
+        headers = {'X-Forwarded-For': f'10.{ip_base}.{i // 250}.{i % 250 + 1}'}
+        parents.append({'client': app.test_client(), 'name': f'家长{i}', 'class_name': class_name, 'chosen': chosen, 'headers': headers})
+    skips = {teacher_id: [rng.random() < args.skip_ratio for _ in range(args.events)] for teacher_id in teacher_ids}
+    counter.conflicts = counter.rejections = counter.retries = 0
+
+    started = time.perf_counter()
+
+    # 家长登录、打开预约页、提交预约
+    def login_parent(parent):
+        client, headers = parent['client'], parent['headers']
+        client.get(f'/login?event={event.id}', headers=headers)
+        recorder.measure('POST /verify-key', client.post, '/verify-key', json={'key': app.config['PARENT_KEY']}, headers=headers)
+        recorder.measure('POST /handle', client.post, '/handle', json={'name': parent['name'], 'className': parent['class_name']}, headers=headers)
+
+    def open_appointment(parent):
+        recorder.measure('GET /parent/appointment', parent['client'].get, '/parent/appointment', headers=parent['headers'])
+
+    def save_appointment(parent):
+        client, headers = parent['client'], parent['headers']
+        response = recorder.measure('POST /parent/appointment/save', client.post, '/parent/appointment/save', json={'appointments': parent['chosen']}, headers=headers)
+        result = response.get_json() or {}
+        while result.get('pending'):
+            main_app.socketio.sleep(0.05)
+            response = recorder.measure('GET /parent/appointment/save/status', client.get, f"/parent/appointment/save/status?ticket={result['ticket']}", headers=headers)
+            result = response.get_json() or {}
+
+    def open_parent(parent):
+        recorder.measure('GET /parent', parent['client'].get, '/parent', headers=parent['headers'])
+
+    for step in (login_parent, open_appointment, save_appointment, open_parent):
+        run_parallel(args.concurrency, parents, step)
+
+    # 老师在实时面板上依次完成或跳过家长
+    sockets = []
+    for i, teacher_id in enumerate(teacher_ids):
+        client = app.test_client()
+        headers = {'X-Forwarded-For': f'10.{ip_base}.250.{i + 1}'}
+        client.get(f'/login?event={event.id}', headers=headers)
+        client.post('/verify-key', json={'key': app.config['TEACHER_KEY']}, headers=headers)
+        client.post('/handle', json={'name': teacher_id}, headers=headers)
+        socket = main_app.socketio.test_client(app, namespace=event.namespace, flask_test_client=client)
+        recorder.measure('ws join_teacher_room', socket.emit, 'join_teacher_room', {'teacherId': teacher_id}, namespace=event.namespace)
+        sockets.append((teacher_id, socket))
+
+    def process_queue(item):
+        teacher_id, socket = item
+        for skip in skips[teacher_id]:
+            recorder.measure('ws promote_first_waiting', socket.emit, 'promote_first_waiting', {'teacherId': teacher_id, 'parentName': first_waiting(event, teacher_id)}, namespace=event.namespace)
+            if skip:
+                recorder.measure('ws skip_parent', socket.emit, 'skip_parent', {'teacherId': teacher_id}, namespace=event.namespace)
+            else:
+                recorder.measure('ws complete_parent', socket.emit, 'complete_parent', {'teacherId': teacher_id}, namespace=event.namespace)
+            socket.get_received(event.namespace)
+    run_parallel(args.concurrency, sockets, process_queue)
+
+    elapsed = time.perf_counter() - started
+    result = report(recorder, counter, elapsed)
+    result['concurrency'] = args.concurrency
+    result['conflicts'] = counter.conflicts
+    result['rejections'] = counter.rejections
+    result['retries'] = counter.retries
+    if args.slow_mongo:
+        result['slow_mongo'] = slow_mongo_scenario(main_app, event, sockets, counter, args.slow_mongo)
+    return result
+
+
+def slow_mongo_scenario(main_app, event, sockets, counter, delay):
+    """第一位老师的操作遇到一次耗时delay秒的数据库调用，期间第二位老师处理家长，
+    测量第二位老师的队列更新多久送达其面板；协作式I/O下应只取决于广播tick，与delay无关"""
+    # 两位老师都需要有正在谈话的家长，完成谈话时才会写数据库并广播
+    for teacher_id, socket in sockets:
+        socket.emit('promote_first_waiting', {'teacherId': teacher_id, 'parentName': first_waiting(event, teacher_id)}, namespace=event.namespace)
+    ready = [(teacher_id, socket) for teacher_id, socket in sockets if event.queues[teacher_id].current]
+    if len(ready) < 2:
+        sys.exit('--slow-mongo 需要至少两位老师的队列中还有家长，请增加--parents或减少--events')
+    (slow_id, slow_socket), (other_id, other_socket) = ready[:2]
+    # 等待之前排定的后台写入完成，避免它们与本场景交错
+    main_app.socketio.sleep(1)
+    other_socket.get_received(event.namespace)
+
+    def slow_operation():
+        counter.stall_next(delay)
+        slow_socket.emit('complete_parent', {'teacherId': slow_id}, namespace=event.namespace)
+
+    started = time.perf_counter()
+    task = main_app.socketio.start_background_task(slow_operation)
+    # 让慢操作先开始并停在数据库调用上
+    main_app.socketio.sleep(0.05)
+    other_socket.emit('complete_parent', {'teacherId': other_id}, namespace=event.namespace)
+    delivered = None
+    while time.perf_counter() - started < delay + 5:
+        if any(packet['name'] == 'queue_delta' for packet in other_socket.get_received(event.namespace)):
+            delivered = time.perf_counter() - started
+            break
+        main_app.socketio.sleep(0.01)
+    task.join()
+    return {'async_mode': main_app.ASYNC_MODE, 'slow_op_s': time.perf_counter() - started, 'other_teacher_update_s': delivered}
+
+
+def first_waiting(event, teacher_id):
+    model = event.queues.get(teacher_id)
+    if model is None:
+        return ''
+    for entry in model:
+        if entry.status.text in ('waiting', 'current'):
+            return entry.name
+    return ''
+
+
+def report(recorder, counter, elapsed):
+    rows = []
+    total = 0
+    for label, values in recorder.latencies.items():
+        total += len(values)
+        rows.append({
+            'name': label,
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1000,
+            'p95_ms': percentile(values, 95) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'db_ops_per_request': counter.counts[label] / len(values)
+        })
+    return {'elapsed_s': elapsed, 'requests': total, 'throughput_rps': total / elapsed if elapsed else 0, 'routes': rows}
+
+
+def print_report(result):
+    print(f"{'路由/事件':<36}{'次数':>8}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'db/请求':>10}")
+    for row in result['routes']:
+        print(f"{row['name']:<36}{row['count']:>8}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['db_ops_per_request']:>10.2f}")
+    print(f"共 {result['requests']} 个请求，耗时 {result['elapsed_s']:.2f}s，吞吐量 {result['throughput_rps']:.1f} req/s")
+    print(f"并发客户端 {result['concurrency']} 个：版本冲突 {result['conflicts']} 次，重新加载重试 {result['retries']} 次，名额占用被拒绝 {result['rejections']} 次")
+    slow = result.get('slow_mongo')
+    if slow:
+        delivered = f"{slow['other_teacher_update_s']:.2f}s" if slow['other_teacher_update_s'] is not None else '未送达'
+        print(f"慢查询（{slow['async_mode']}）：慢操作耗时 {slow['slow_op_s']:.2f}s，期间其他老师的队列更新在 {delivered} 后送达")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='AQS开放时段压力测试')
+    parser.add_argument('--parents', type=int, default=200, help='模拟家长数量')
+    parser.add_argument('--teachers', type=int, default=11, help='连接实时面板的老师数量')
+    parser.add_argument('--events', type=int, default=10, help='每位老师处理的家长数')
+    parser.add_argument('--skip-ratio', type=float, default=0.1, help='老师点击跳过而非完成的比例')
+    parser.add_argument('--storage', choices=['mongo', 'memory', 'mongomock'], default='mongo', help='数据存储：本机mongod、内置内存引擎或mongomock')
+    parser.add_argument('--mongodb-uri', default=None, help='MongoDB地址，缺省使用AQS_MONGODB_URI')
+    parser.add_argument('--db-name', default='aqs_bench', help='压测使用的数据库，运行前会被清空')
+    parser.add_argument('--surge', action='store_true', help='以排队预约模式运行')
+    parser.add_argument('--event', default=None, help='压测的场次id，缺省为第一个场次')
+    parser.add_argument('--slow-mongo', type=float, default=0, help='另测一次耗时若干秒的慢查询期间其他老师的队列更新延迟')
+    parser.add_argument('--concurrency', type=int, default=1, help='并发客户端数量，家长与老师分给这些客户端同时运行')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='以JSON输出结果，便于比较多次运行')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.db_name == 'aqs':
+        sys.exit('不能在正式数据库aqs上运行压测')
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
@@ -0,0 +1,51 @@
+# coding=UTF-8
+"""合并广播：队列变化先记入缓冲区，每个tick（默认每秒4次）为每位有变化的老师只发送一帧：
+同一tick内版本连续的增量合并为一条，出现缺口（批量写入或其他worker的修改）时改发完整快照；
+同时记录哪些老师的总览行需要更新，总览面板每个tick只收到一帧有变化的老师的紧凑行。"""
+
+
+class BroadcastBuffer:
+    def __init__(self):
+        # teacher_id -> {'base': 合并前的版本号, 'version': 合并后的版本号, 'ops': 增量操作}
+        self.deltas = {}
+        # 本tick需要发送完整快照的老师
+        self.snapshots = set()
+        # 本tick总览行有变化的老师
+        self.dirty = set()
+        self.scheduled = False
+
+    def add_delta(self, teacher_id, version, ops):
+        """记录一次队列变化，version为变化后的版本号"""
+        teacher_id = str(teacher_id)
+        self.dirty.add(teacher_id)
+        if teacher_id in self.snapshots:
+            return
+        pending = self.deltas.get(teacher_id)
+        if pending is None:
+            self.deltas[teacher_id] = {'base': version - 1, 'version': version, 'ops': [*ops]}
+        elif pending['version'] == version - 1:
+            pending['version'] = version
+            pending['ops'].extend(ops)
+        else:
+            del self.deltas[teacher_id]
+            self.snapshots.add(teacher_id)
+
+    def add_snapshot(self, teacher_id):
+        """本tick改为发送该老师的完整队列，已暂存的增量一并作废"""
+        teacher_id = str(teacher_id)
+        self.deltas.pop(teacher_id, None)
+        self.snapshots.add(teacher_id)
+        self.dirty.add(teacher_id)
+
+    def take(self):
+        """取出本tick待发送的(增量, 快照老师, 总览老师)并清空缓冲区"""
+        deltas, snapshots, dirty = self.deltas, self.snapshots, self.dirty
+        self.deltas, self.snapshots, self.dirty = {}, set(), set()
+        return deltas, snapshots, dirty
+
+
+def overview_row(teacher_id, model):
+    """总览面板中一位老师的紧凑行：[老师id, 队列版本号, 当前家长, 等待人数]，
+    客户端按版本号只保留较新的行，多worker各自发送时也不会倒退"""
+    entry = model.current_entry()
+    return [str(teacher_id), model.version, entry.name if entry else None, model.active_count - len(model.current)]
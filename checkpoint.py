@@ -0,0 +1,59 @@
+# coding=UTF-8
+"""预热快照：定期把各场次可由数据库重建、但重建较慢的派生状态（名额与人数、队列内存模型、谈话用时估计、
+预序列化的响应，见Event.export_state）写入本地文件，重启时先用快照恢复，再与数据库校正，
+活动进行中重启也能立即恢复服务。
+
+快照只是缓存：数据库始终是权威数据，名额计数在对外服务前按数据库校正，版本号有变化的队列在后台重新读取；
+快照缺失、损坏、格式不符或过旧时按原来的方式完整加载。文件只由本程序写入和读取。"""
+import os
+import pickle
+import time
+
+
+FORMAT_VERSION = 1
+
+
+class CheckpointFile:
+    def __init__(self, path, max_age=3600):
+        """max_age秒之前保存的快照视为过旧，不再使用"""
+        self.path = path
+        self.max_age = max_age
+        # 场次id -> 上次保存时的(队列版本, 名额版本, 名单版本)，没有变化时不重复写入
+        self.saved = {}
+
+    def load(self):
+        """读取快照，返回 {场次id: 状态}，不可用时返回空字典"""
+        try:
+            with open(self.path, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('format') != FORMAT_VERSION or time.time() - data.get('saved_at', 0) > self.max_age:
+            return {}
+        return data['events']
+
+    def save(self, events, payload_keys=(), force=False):
+        """所有场次的状态都没有变化时跳过，否则整体写入临时文件再替换，写到一半中断不会留下损坏的快照；返回是否已写入"""
+        versions = {event.id: (event.queues_version, event.setting_version, event.roster_version) for event in events}
+        if not force and versions == self.saved:
+            return False
+        data = {
+            'format': FORMAT_VERSION,
+            'saved_at': time.time(),
+            'events': {event.id: event.export_state(payload_keys) for event in events}
+        }
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(temporary, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.path)
+        except BaseException:
+            # 写入失败时原有快照保持不变，删除写了一半的临时文件
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        self.saved = versions
+        return True
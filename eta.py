@@ -0,0 +1,102 @@
+# coding=UTF-8
+"""预计谈话时间：根据每位老师实际完成谈话的间隔估计单次用时，
+队列变化后用NumPy一次性算出所有老师队列中每位家长的预计时间并缓存。"""
+import time
+from datetime import datetime
+import numpy as np
+from queue_model import Status
+
+
+# 一天中每一分钟对应的 'HH:MM'，用下标一次性取出所有家长的时间文本
+MINUTE_LABELS = np.array([f'{minute // 60:02d}:{minute % 60:02d}' for minute in range(1440)])
+
+
+class EtaEngine:
+    def __init__(self, start_time, default_minutes=10, alpha=0.3, max_gap_minutes=60, refresh_interval=30):
+        """start_time为谈话开始时间字符串（%Y-%m-%dT%H:%M:%S，本地时间）；
+        alpha为新观测值的权重，超过max_gap_minutes的完成间隔视为老师中途离开，不计入估计"""
+        self.start = datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%S').timestamp()
+        self.default = default_minutes * 60
+        self.alpha = alpha
+        self.max_gap = max_gap_minutes * 60
+        self.refresh_interval = refresh_interval
+        # teacher_id -> 单次谈话用时估计（秒）
+        self.service = {}
+        # teacher_id -> 最近一次完成谈话的时间戳，即当前家长开始谈话的时间
+        self.last_completed = {}
+        # teacher_id -> {家长: 'HH:MM'}
+        self.times = {}
+        self.version = None
+        self.computed_at = 0
+        self.dirty = True
+        # 每次重新计算后递增，导出文件的缓存以此判断预计时间是否变化
+        self.generation = 0
+
+    def record_completion(self, teacher_id, timestamp=None):
+        """记录老师完成一位家长的时间，以相邻两次完成的间隔更新用时估计"""
+        teacher_id = str(teacher_id)
+        timestamp = time.time() if timestamp is None else timestamp
+        previous = self.last_completed.get(teacher_id, self.start)
+        gap = timestamp - previous
+        if 0 < gap <= self.max_gap:
+            estimate = self.service.get(teacher_id, self.default)
+            self.service[teacher_id] = estimate + self.alpha * (gap - estimate)
+        self.last_completed[teacher_id] = timestamp
+        self.dirty = True
+
+    def service_minutes(self, teacher_id):
+        return self.service.get(str(teacher_id), self.default) / 60
+
+    def expected_end(self, teacher_id):
+        """老师当前这次谈话预计结束的时间戳"""
+        teacher_id = str(teacher_id)
+        return self.last_completed.get(teacher_id, self.start) + self.service.get(teacher_id, self.default)
+
+    def refresh(self, queues, version):
+        """队列版本变化、有新的完成记录或距上次计算超过refresh_interval秒时重新计算"""
+        now = time.time()
+        if not self.dirty and version == self.version and now - self.computed_at < self.refresh_interval:
+            return
+        self.compute(queues, now)
+        self.version = version
+        self.computed_at = now
+        self.dirty = False
+        self.generation += 1
+
+    def compute(self, queues, now):
+        """把所有老师的队列(TeacherQueue)拼接为一组数组，一次计算出每位家长的预计开始时间"""
+        teacher_ids = [*queues]
+        entries = [entry for teacher_id in teacher_ids for entry in queues[teacher_id]]
+        counts = np.array([len(queues[teacher_id]) for teacher_id in teacher_ids], dtype=np.int64)
+        self.times = {teacher_id: {} for teacher_id in teacher_ids}
+        if not entries:
+            return
+        owner = np.repeat(np.arange(len(teacher_ids)), counts)
+        status = np.fromiter((entry.status for entry in entries), dtype=np.int8, count=len(entries))
+        active = status != Status.COMPLETED
+        current = status == Status.CURRENT
+
+        # 前方未完成人数 = 全局累计未完成数 - 该老师队列起点处的累计数
+        cumulative = np.concatenate(([0], np.cumsum(active)))
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        ahead = cumulative[:-1] - cumulative[starts][owner]
+
+        service = np.array([self.service.get(teacher_id, self.default) for teacher_id in teacher_ids])
+        anchor = np.array([self.last_completed.get(teacher_id, self.start) for teacher_id in teacher_ids])
+        has_current = np.bincount(owner, weights=current, minlength=len(teacher_ids)) > 0
+        # 有家长正在谈话时，下一位从其预计结束（已超时则为此刻）开始；否则从此刻或开始时间开始
+        free_at = np.where(has_current, np.maximum(anchor + service, now), max(now, self.start))
+        eta = np.where(current, anchor[owner],
+                       free_at[owner] + np.maximum(ahead - has_current[owner], 0) * service[owner])
+
+        offset = time.localtime(now).tm_gmtoff
+        labels = MINUTE_LABELS[((eta + offset) // 60).astype(np.int64) % 1440]
+        for teacher_index, entry, label, is_active in zip(owner.tolist(), entries, labels.tolist(), active.tolist()):
+            if is_active:
+                self.times[teacher_ids[teacher_index]].setdefault(entry.name, label)
+
+    def lookup(self, teacher_id, name):
+        return self.times.get(str(teacher_id), {}).get(name)
+
+    def teacher_times(self, teacher_id):
+        return self.times.get(str(teacher_id), {})
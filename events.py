@@ -0,0 +1,373 @@
+# coding=UTF-8
+"""多场次：同一部署同时服务多个年级的家长会。每个场次有自己的老师名单、开放时间、
+数据库集合前缀与Socket.IO命名空间，队列、名额、预计时间与各类缓存按场次隔离。
+
+场次在events.json中配置，文件修改后无需重启，下一个请求到来时即生效；没有该文件时只有一个
+使用teacher.json、无前缀、默认命名空间的场次，与单场次部署完全相同。各场次的id、prefix与namespace都不能重复。示例：
+[
+    {"id": "grade7", "name": "初一家长会", "grade": "初一", "teachers": "teacher.json",
+     "appointment_start": "2026-11-20T08:00:00", "conversion_start": "2025-11-21T16:45:00",
+     "prefix": "", "namespace": "/"},
+    {"id": "grade8", "name": "初二家长会", "grade": "初二", "teachers": "teacher_2.json",
+     "appointment_start": "2026-11-27T08:00:00", "conversion_start": "2025-11-28T16:45:00",
+     "prefix": "grade8_", "namespace": "/grade8"}
+]
+"""
+import json
+import os
+import time
+from collections import Counter, deque
+from datetime import datetime
+import pymongo
+from broadcast import BroadcastBuffer
+from eta import EtaEngine
+from exporter import ExportCache
+from queue_log import QueueLog
+from queue_model import Status, TeacherQueue
+
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def count_active(queue):
+    """统计队列中未完成的家长人数"""
+    return len([item for item in queue if item.get('status') != 'completed'])
+
+
+class Event:
+    """一个场次的配置与运行状态"""
+
+    def __init__(self, config, db, base_dir='.', multi_worker=False, shared_state_ttl=1):
+        self.id = config['id']
+        # 前缀与命名空间决定数据归属，场次存续期间不可修改，修改时按删除旧场次、新建场次处理
+        self.prefix = config.get('prefix', '')
+        self.namespace = config.get('namespace', '/')
+        self.base_dir = base_dir
+        self.multi_worker = multi_worker
+        self.shared_state_ttl = shared_state_ttl
+        self.bind(db)
+
+        # 队列内存模型（见queue_model.py），任一老师的队列变化时queues_version递增
+        self.queues = {}
+        self.queues_version = 0
+        # 老师名额与人数，每次变化时setting_version递增
+        self.setting_memory = {}
+        self.setting_version = 0
+        self.shared_state_loaded_at = 0
+        # 预序列化的响应与导出文件
+        self.payload_cache = {}
+        self.export_cache = ExportCache()
+        # 按tick合并的队列广播、队列事件日志与家长排位推送的合并写入
+        self.broadcast = BroadcastBuffer()
+        self.queue_log_scheduled = False
+        self.dirty_parents = set()
+        self.parent_push_cache = {}
+        self.parent_push_scheduled = False
+        # 开放时段排队预约
+        self.admission_queue = deque()
+        self.admission_tickets = {}
+        self.admission_seq = 0
+        self.admission_done_seq = 0
+        self.admission_draining = False
+
+        self.teachers = []
+        self.roster = None
+        self.roster_version = 0
+        self.conversion_start = None
+        self.eta_engine = None
+        self.configure(config)
+
+    def bind(self, db):
+        """按前缀取得本场次使用的集合"""
+        self.db = db
+        self.teacher = db[self.prefix + 'teacher']
+        self.parent = db[self.prefix + 'parent']
+        self.queue_log = QueueLog(db, prefix=self.prefix)
+
+    def configure(self, config):
+        """应用名称、年级、老师名单与时间等可随时修改的配置，返回老师名单是否变化"""
+        self.name = config.get('name', '')
+        self.grade = config.get('grade', '初一')
+        self.appointment_start = config['appointment_start']
+        if isinstance(self.appointment_start, str):
+            self.appointment_start = datetime.strptime(self.appointment_start, TIME_FORMAT)
+        if config['conversion_start'] != self.conversion_start:
+            self.conversion_start = config['conversion_start']
+            self.eta_engine = EtaEngine(self.conversion_start)
+        roster = config.get('teachers', 'teacher.json')
+        with open(os.path.join(self.base_dir, roster), 'r', encoding='utf-8') as f:
+            teachers = json.load(f)
+        changed = teachers != self.teachers
+        if changed:
+            self.teachers = teachers
+            self.roster_version += 1
+        self.roster = roster
+        return changed
+
+    def describe(self):
+        """页面与前端脚本需要的场次信息"""
+        return {'id': self.id, 'name': self.name, 'grade': self.grade, 'namespace': self.namespace}
+
+    # ---------- 队列内存模型 ----------
+    def load_queue(self, teacher_id, queue, version=0):
+        """用数据库中的队列重建内存模型"""
+        self.queues_version += 1
+        model = self.queues[str(teacher_id)] = TeacherQueue.from_documents(queue, version)
+        self.update_setting(teacher_id, peoples=model.active_count)
+        return model
+
+    def reload_queue(self, teacher_id):
+        data = self.teacher.find_one({'id': str(teacher_id)}, {'_id': 0, 'queue': 1, 'version': 1})
+        if data is None:
+            return self.load_queue(teacher_id, [])
+        return self.load_queue(teacher_id, data.get('queue', []), data.get('version', 0))
+
+    def apply_queue_ops(self, teacher_id, version, ops):
+        """把已写入数据库的修改同步到内存模型，version为修改后的版本号"""
+        model = self.queues.get(str(teacher_id))
+        if model is None or model.version != version - 1:
+            # 期间有其他worker修改过该队列
+            self.reload_queue(teacher_id)
+            return
+        model.apply(ops)
+        model.version = version
+        self.queues_version += 1
+        self.update_setting(teacher_id, peoples=model.active_count)
+
+    def get_ranking(self, teacher_id, name):
+        """获取家长在某位老师队列中的前方等待人数"""
+        model = self.queues.get(str(teacher_id))
+        if model is None:
+            return 0
+        return model.ahead(name)
+
+    def current_etas(self):
+        """返回最新的预计时间，排位索引变化后首次读取时统一重新计算"""
+        self.eta_engine.refresh(self.queues, self.queues_version)
+        return self.eta_engine
+
+    def parents_in_session(self, exclude_teacher=None):
+        """返回此刻正在其他老师处谈话的家长 -> 预计结束的时间戳"""
+        self.sync_shared_state()
+        return {name: self.eta_engine.expected_end(teacher_id)
+                for teacher_id, model in self.queues.items() if teacher_id != str(exclude_teacher) for name in model.current}
+
+    def parents_remaining(self, exclude_teacher=None):
+        """返回家长 -> 在其他老师处仍在等待的预约数，排程时优先让剩余预约少的家长谈话"""
+        return Counter(entry.name for teacher_id, model in self.queues.items() if teacher_id != str(exclude_teacher)
+                       for entry in model if entry.status == Status.WAITING)
+
+    # ---------- 名额 ----------
+    def update_setting(self, teacher_id, maxParents=None, peoples=None):
+        """修改老师的名额上限与人数，有变化时使依赖setting_memory的缓存失效；
+        人数始终取队列中未完成的家长数（队列模型加载或变化时自动更新），不按预约与取消增减，避免累积误差"""
+        setting = self.setting_memory.setdefault(str(teacher_id), {'maxParents': 10, 'peoples': 0})
+        before = (setting['maxParents'], setting['peoples'])
+        if maxParents is not None:
+            setting['maxParents'] = maxParents
+        if peoples is not None:
+            setting['peoples'] = peoples
+        if (setting['maxParents'], setting['peoples']) != before:
+            self.setting_version += 1
+
+    def sync_shared_state(self, force=False):
+        """多worker模式下从数据库同步老师名额与排位索引，单进程部署时内存即为权威数据"""
+        if not (self.multi_worker or force):
+            return
+        now = time.time()
+        if not force and now - self.shared_state_loaded_at < self.shared_state_ttl:
+            return
+        self.shared_state_loaded_at = now
+        projection = {'_id': 0, 'id': 1, 'maxParents': 1, 'version': 1, 'queue.name': 1, 'queue.status': 1, 'queue.type': 1}
+        for data in self.teacher.find({}, projection):
+            self.update_setting(data['id'], maxParents=data.get('maxParents', 10))
+            model = self.queues.get(data['id'])
+            if model is None or model.version != data.get('version', 0):
+                self.load_queue(data['id'], data.get('queue', []), data.get('version', 0))
+
+    def ensure_indexes(self):
+        self.teacher.create_index('id', unique=True)
+        try:
+            self.parent.create_index('name', unique=True)
+        except pymongo.errors.DuplicateKeyError:
+            # 历史数据中存在重名记录时退化为普通索引，保证查询仍然走索引
+            self.parent.create_index('name')
+        self.queue_log.ensure_indexes()
+
+    def load_teachers(self):
+        """创建索引并一次性加载全部老师数据，缺失的老师批量补建，返回(老师数, 新建数, 从日志恢复数, 校正数)"""
+        self.ensure_indexes()
+        ids = [str(i['id']) for i in self.teachers]
+        existing = {data['id']: data for data in self.teacher.find({'id': {'$in': ids}}, {'_id': 0, 'id': 1, 'maxParents': 1, 'queue': 1, 'active': 1, 'version': 1})}
+        missing = [{'id': i, 'maxParents': 10, 'reservedStudents': [], 'queue': [], 'active': 0, 'version': 0} for i in ids if i not in existing]
+        restored = 0
+        for data in missing:
+            # 老师文档丢失时按快照加事件日志恢复队列
+            queue, version = self.queue_log.state_at(data['id'])
+            if version:
+                data.update({'queue': queue, 'active': count_active(queue), 'version': version})
+                existing[data['id']] = data
+                restored += 1
+        if missing:
+            self.teacher.insert_many(missing, ordered=False)
+        self.queue_log.ensure_baseline(existing.values())
+        # active为数据库中的名额计数器，预约时据此原子地判断是否已满，启动时按队列校正
+        fixes = [pymongo.UpdateOne({'id': data['id']}, {'$set': {'active': count_active(data['queue'])}}) for data in existing.values() if data.get('active') != count_active(data['queue'])]
+        if fixes:
+            self.teacher.bulk_write(fixes, ordered=False)
+        for i in ids:
+            if i in existing:
+                self.update_setting(i, maxParents=existing[i]['maxParents'])
+                self.load_queue(i, existing[i]['queue'], existing[i].get('version', 0))
+            else:
+                self.update_setting(i, maxParents=10)
+                self.load_queue(i, [])
+        return len(ids), len(missing) - restored, restored, len(fixes)
+
+    # ---------- 预热快照 ----------
+    def export_state(self, payload_keys=()):
+        """导出可在重启后沿用的派生状态（见checkpoint.py）；payload_keys为版本号取自本场次计数器的预序列化响应，
+        其他缓存（如按固定版本号缓存的班级列表）重启后可能已过期，不导出。
+        保存快照的线程与处理请求的线程并行，各字典先整体复制再遍历，遍历期间的增删不会影响导出"""
+        queues = dict(self.queues)
+        setting_memory = dict(self.setting_memory)
+        payloads = dict(self.payload_cache)
+        return {
+            'prefix': self.prefix,
+            'teachers': self.teachers,
+            'conversion_start': self.conversion_start,
+            'roster_version': self.roster_version,
+            'setting_version': self.setting_version,
+            'queues_version': self.queues_version,
+            'setting_memory': {teacher_id: dict(setting) for teacher_id, setting in setting_memory.items()},
+            'queues': {teacher_id: (model.version, model.to_documents()) for teacher_id, model in queues.items()},
+            'service': dict(self.eta_engine.service),
+            'last_completed': dict(self.eta_engine.last_completed),
+            'payloads': {key: entry for key, entry in payloads.items() if key in payload_keys}
+        }
+
+    def import_state(self, state):
+        """恢复export_state导出的状态，数据前缀或老师名单与快照不同时不恢复，返回是否已恢复。
+        计数器一并恢复，此后的变化继续递增，按版本号缓存的响应不会与新的数据混淆"""
+        if not state or state.get('prefix') != self.prefix or state.get('teachers') != self.teachers:
+            return False
+        self.roster_version = state['roster_version']
+        self.setting_version = state['setting_version']
+        self.queues_version = state['queues_version']
+        self.setting_memory = {teacher_id: dict(setting) for teacher_id, setting in state['setting_memory'].items()}
+        self.queues = {teacher_id: TeacherQueue.from_documents(queue, version) for teacher_id, (version, queue) in state['queues'].items()}
+        if state.get('conversion_start') == self.conversion_start:
+            self.eta_engine.service.update(state['service'])
+            self.eta_engine.last_completed.update(state['last_completed'])
+        self.payload_cache.update(state['payloads'])
+        return True
+
+    def warm_start(self, state):
+        """用预热快照恢复状态，再以一次只读取名额字段与版本号的查询校正名额，校正后即可对外服务；
+        返回队列版本号与快照不同、需要在后台重新读取的老师及其数据库中的名额计数。
+        快照不可用或数据库中缺少老师（需要补建）时返回None，应改为完整加载"""
+        if not self.import_state(state):
+            return None
+        ids = [str(i['id']) for i in self.teachers]
+        projection = {'_id': 0, 'id': 1, 'maxParents': 1, 'active': 1, 'version': 1}
+        counters = {data['id']: data for data in self.teacher.find({'id': {'$in': ids}}, projection)}
+        if len(counters) < len(ids):
+            return None
+        stale = []
+        for i in ids:
+            data = counters[i]
+            model = self.queues.get(i)
+            if model is None or model.version != data.get('version', 0):
+                # 队列读取之前先显示数据库中的名额计数
+                stale.append(i)
+                self.update_setting(i, maxParents=data.get('maxParents', 10), peoples=data.get('active', 0))
+            else:
+                self.update_setting(i, maxParents=data.get('maxParents', 10), peoples=model.active_count)
+        return stale, {i: data.get('active') for i, data in counters.items()}
+
+    def reconcile(self, stale, active):
+        """预热启动后在后台完成：重新读取有变化的老师队列，建立索引与事件日志基线，
+        并按队列校正数据库中的名额计数器，返回校正数"""
+        self.ensure_indexes()
+        if stale:
+            for data in self.teacher.find({'id': {'$in': stale}}, {'_id': 0, 'id': 1, 'queue': 1, 'version': 1, 'active': 1}):
+                self.load_queue(data['id'], data.get('queue', []), data.get('version', 0))
+                active[data['id']] = data.get('active')
+        self.queue_log.ensure_baseline([{'id': teacher_id, 'version': model.version, 'queue': model.to_documents()} for teacher_id, model in self.queues.items()])
+        # 以版本号为条件，期间队列已被修改的老师不覆盖
+        fixes = [pymongo.UpdateOne({'id': teacher_id, 'version': model.version}, {'$set': {'active': model.active_count}})
+                 for teacher_id, model in self.queues.items() if teacher_id in active and active[teacher_id] != model.active_count]
+        if fixes:
+            self.teacher.bulk_write(fixes, ordered=False)
+        return len(fixes)
+
+
+class EventRegistry:
+    """从配置文件加载场次，文件修改时间变化后重新加载：新增的场次创建并初始化，
+    已有场次只更新名称、时间与老师名单，运行状态保留；配置有误时保留原有场次"""
+
+    def __init__(self, path, db, default, base_dir='.', check_interval=5, **options):
+        self.path = os.path.join(base_dir, path)
+        self.db = db
+        self.default_config = default
+        self.base_dir = base_dir
+        self.check_interval = check_interval
+        self.options = options
+        self.events = {}
+        self.mtime = None
+        self.checked_at = 0
+
+    def __iter__(self):
+        return iter([*self.events.values()])
+
+    def get(self, event_id):
+        return self.events.get(event_id)
+
+    @property
+    def default(self):
+        return next(iter(self.events.values()))
+
+    def by_namespace(self, namespace):
+        namespace = namespace or '/'
+        return next((event for event in self.events.values() if event.namespace == namespace), None)
+
+    def read(self):
+        """读取配置文件，文件不存在时返回只含默认场次的配置"""
+        if not os.path.exists(self.path):
+            return [self.default_config]
+        with open(self.path, 'r', encoding='utf-8') as f:
+            configs = json.load(f)
+        if not configs:
+            raise ValueError('events.json中至少需要配置一个场次')
+        # 集合前缀相同的场次会共用老师、家长与队列事件集合，前缀缺省为空，多个场次只能有一个不写前缀
+        for key, default in (('id', None), ('namespace', '/'), ('prefix', '')):
+            values = [config.get(key, default) for config in configs]
+            if len(set(values)) != len(values):
+                raise ValueError(f'场次的{key}不能重复')
+        return configs
+
+    def refresh(self, force=False):
+        """距上次检查超过check_interval秒且配置文件有变化时重新加载，返回(新增的场次, 老师名单变化的场次, 移除的场次)"""
+        now = time.time()
+        if not force and now - self.checked_at < self.check_interval:
+            return [], [], []
+        self.checked_at = now
+        mtime = os.path.getmtime(self.path) if os.path.exists(self.path) else None
+        if not force and mtime == self.mtime:
+            return [], [], []
+        self.mtime = mtime
+        configs = self.read()
+        added, changed = [], []
+        events = {}
+        for config in configs:
+            event = self.events.get(config['id'])
+            if event is not None and (event.prefix, event.namespace) == (config.get('prefix', ''), config.get('namespace', '/')):
+                if event.configure(config):
+                    changed.append(event)
+            else:
+                event = Event(config, self.db, self.base_dir, **self.options)
+                added.append(event)
+            events[event.id] = event
+        removed = [event for event_id, event in self.events.items() if events.get(event_id) is not event]
+        self.events = events
+        return added, changed, removed
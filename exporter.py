@@ -0,0 +1,101 @@
+# coding=UTF-8
+"""预约名单导出：不依赖pandas，直接从队列逐行写出xlsx/CSV，并按队列版本缓存生成结果"""
+import csv
+import zipfile
+from collections import OrderedDict
+from io import BytesIO, StringIO
+from openpyxl import Workbook
+
+
+HEADERS = ['序号', '学生姓名', '预计时间', '状态']
+
+STATUS_TEXT_MAP = {
+    'waiting': '等待中',
+    'current': '进行中',
+    'completed': '已完成',
+    'skipped': '已跳过'
+}
+
+
+def queue_rows(queue, estimate):
+    """把队列转换为导出行，estimate(item)返回该家长的预计时间，已完成的家长没有预计时间"""
+    for index, item in enumerate(queue, 1):
+        appointment_time = item.get('appointmentTime', item.get('appointment_time')) or estimate(item) or '-'
+        status_text = STATUS_TEXT_MAP.get(item.get('status', 'waiting'), '未知')
+        yield [index, item.get('name', ''), appointment_time, status_text]
+
+
+def write_xlsx(rows):
+    """以只写模式逐行写出xlsx，内存占用与行数无关"""
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('预约列表')
+    sheet.append(HEADERS)
+    for row in rows:
+        sheet.append(row)
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+
+def write_csv(rows):
+    """写出带BOM的UTF-8 CSV，Excel可直接正确识别中文"""
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(HEADERS)
+    writer.writerows(rows)
+    return ('\ufeff' + output.getvalue()).encode('utf-8')
+
+
+EXPORT_FORMATS = {
+    'xlsx': (write_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': (write_csv, 'text/csv; charset=utf-8')
+}
+
+
+class ExportCache:
+    """按(老师id, 队列版本, 格式)缓存导出文件，队列不变时重复下载无需重新生成；
+    stamp为文件中其他会变化的内容（如预计时间文本），不同时重新生成并替换原有文件"""
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.files = OrderedDict()
+
+    def get_or_build(self, key, build, stamp=None):
+        if key in self.files and self.files[key][0] == stamp:
+            self.files.move_to_end(key)
+            return self.files[key][1]
+        data = build()
+        self.files[key] = (stamp, data)
+        self.files.move_to_end(key)
+        if len(self.files) > self.max_size:
+            self.files.popitem(last=False)
+        return data
+
+
+class _ChunkBuffer:
+    """供zipfile写入的不可寻址缓冲区，每写完一个文件即可取出已生成的字节"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_zip(files):
+    """边生成边输出zip，files为(文件名, 字节)的可迭代对象"""
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+            yield buffer.drain()
+    yield buffer.drain()
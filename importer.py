@@ -0,0 +1,94 @@
+# coding=UTF-8
+"""提前预订（指定预约）名单批量导入：读取CSV或xlsx，每行一名学生（老师编号、班级、学生姓名），
+按class.json校验班级，再与各老师当前的名单比较，得出每位老师需要新增与删除的学生。"""
+import csv
+import zipfile
+from io import BytesIO, StringIO
+from openpyxl import load_workbook
+from openpyxl.utils.exceptions import InvalidFileException
+
+
+# 表头可使用的列名
+COLUMNS = {
+    'teacher': ('老师编号', '老师id', 'teacher_id'),
+    'class': ('班级', 'class'),
+    'name': ('学生姓名', '姓名', 'name')
+}
+
+
+def cell_text(value):
+    """单元格内容转为文本，Excel中的数字编号会读成1.0，按整数处理"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def read_rows(filename, data):
+    """读取上传的文件，返回各行单元格文本；CSV依次尝试UTF-8与GBK（Excel另存的CSV常为GBK）"""
+    if filename.lower().endswith('.xlsx'):
+        try:
+            workbook = load_workbook(BytesIO(data), read_only=True, data_only=True)
+        except (InvalidFileException, zipfile.BadZipFile, KeyError, OSError) as error:
+            raise ValueError('无法读取xlsx文件，请确认文件格式') from error
+        return [[cell_text(value) for value in row] for row in workbook.active.iter_rows(values_only=True)]
+    if filename.lower().endswith('.csv'):
+        for encoding in ('utf-8-sig', 'gbk'):
+            try:
+                text = data.decode(encoding)
+                break
+            except UnicodeDecodeError:
+                continue
+        else:
+            raise ValueError('无法识别CSV文件的编码，请另存为UTF-8')
+        return [[cell_text(value) for value in row] for row in csv.reader(StringIO(text))]
+    raise ValueError('只支持CSV或xlsx文件')
+
+
+def parse_reserved(rows, teachers, classes):
+    """校验各行并按老师汇总名单，返回({老师id: [班级+姓名, ...]}, 错误列表)；
+    名单中的学生按文件中的顺序排列，重复的行只保留一次"""
+    if not rows:
+        return {}, ['文件为空']
+    header = rows[0]
+    index = {}
+    for key, names in COLUMNS.items():
+        found = [i for i, title in enumerate(header) if title in names]
+        if not found:
+            return {}, [f'缺少“{names[0]}”列']
+        index[key] = found[0]
+    teacher_ids = {str(teacher['id']) for teacher in teachers}
+    classes = set(classes)
+    lists = {}
+    errors = []
+    for number, row in enumerate(rows[1:], 2):
+        if not any(row):
+            continue
+        teacher_id, class_name, name = [row[index[key]] if index[key] < len(row) else '' for key in ('teacher', 'class', 'name')]
+        if teacher_id not in teacher_ids:
+            errors.append(f'第{number}行：老师编号“{teacher_id}”不存在')
+        elif class_name not in classes:
+            errors.append(f'第{number}行：班级“{class_name}”不存在')
+        elif not name:
+            errors.append(f'第{number}行：学生姓名为空')
+        else:
+            students = lists.setdefault(teacher_id, [])
+            if class_name + name not in students:
+                students.append(class_name + name)
+    return lists, errors
+
+
+def diff_reserved(current, imported, append=False):
+    """与各老师当前的名单比较，返回有变化的老师 {老师id: {'reserved': 新名单, 'added': [...], 'removed': [...]}}；
+    append为True时只新增，不删除文件中没有的学生"""
+    changes = {}
+    for teacher_id, students in imported.items():
+        old = current.get(teacher_id, [])
+        if append:
+            students = old + [name for name in students if name not in old]
+        added = [name for name in students if name not in old]
+        removed = [name for name in old if name not in students]
+        if added or removed:
+            changes[teacher_id] = {'reserved': students, 'added': added, 'removed': removed}
+    return changes
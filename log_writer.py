@@ -0,0 +1,114 @@
+# coding=UTF-8
+"""非阻塞日志：请求线程只把日志放入队列，由后台线程批量写入文件。
+文件超过大小上限或跨天时自动轮转；同一来源在短时间内的重复记录合并为一条汇总。"""
+import atexit
+import os
+import queue
+import threading
+import time
+
+try:
+    from eventlet import patcher
+except ImportError:
+    patcher = None
+
+# 打过猴子补丁后threading.Thread是绿色线程，写文件和flush会阻塞整个hub；此时改用未打补丁的threading与queue，
+# 写入线程是真正的系统线程。队列和锁来自同一套未打补丁的模块，绿色线程放入记录时只短暂持有锁，不会让出hub
+if patcher is not None and patcher.is_monkey_patched('thread'):
+    threading = patcher.original('threading')
+    queue = patcher.original('queue')
+
+
+class LogWriter:
+    def __init__(self, directory='log', max_bytes=10 * 1024 * 1024, flush_interval=1.0, batch_size=500, dedup_window=10):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.dedup_window = dedup_window
+        self.queue = queue.Queue()
+        self.files = {}
+        self.floods = {}
+        self.thread = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.close)
+
+    def write(self, filename, message, key=None):
+        """放入队列后立即返回；key相同的记录在dedup_window秒内只写第一条，其余计数后合并输出"""
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='log-writer', daemon=True)
+                    self.thread.start()
+        self.queue.put((time.time(), filename, message, key))
+
+    def run(self):
+        while True:
+            records = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(records) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    self.flush(records)
+                    return
+                records.append(record)
+            self.flush(records)
+
+    def flush(self, records):
+        """按文件分组一次写入，并输出已结束的重复记录汇总"""
+        batches = {}
+        now = time.time()
+        for created, filename, message, key in records:
+            if key is not None:
+                flood = self.floods.get((filename, key))
+                if flood is not None and created - flood['start'] < self.dedup_window:
+                    flood['count'] += 1
+                    continue
+                if flood is not None and flood['count']:
+                    batches.setdefault(filename, []).append(self.summary(filename, key, flood))
+                self.floods[(filename, key)] = {'start': created, 'count': 0}
+            batches.setdefault(filename, []).append(message)
+        for (filename, key), flood in [*self.floods.items()]:
+            if now - flood['start'] >= self.dedup_window:
+                if flood['count']:
+                    batches.setdefault(filename, []).append(self.summary(filename, key, flood))
+                del self.floods[(filename, key)]
+        for filename, messages in batches.items():
+            data = ''.join(messages).encode('utf-8')
+            handle = self.open(filename, len(data))
+            handle.write(data)
+            handle.flush()
+
+    def summary(self, filename, key, flood):
+        summary_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        return f"[{summary_time}] {key} - 以上记录在{self.dedup_window}秒内又重复{flood['count']}次，已合并\n\n"
+
+    def open(self, filename, incoming):
+        """返回可写的文件句柄，文件过大或跨天时先轮转"""
+        path = os.path.join(self.directory, filename)
+        today = time.strftime('%Y%m%d')
+        entry = self.files.get(filename)
+        if entry is not None and (entry['day'] != today or entry['handle'].tell() + incoming > self.max_bytes):
+            entry['handle'].close()
+            rotated = f"{path}.{time.strftime('%Y%m%d-%H%M%S')}"
+            suffix = 1
+            while os.path.exists(rotated):
+                rotated = f"{path}.{time.strftime('%Y%m%d-%H%M%S')}.{suffix}"
+                suffix += 1
+            os.replace(path, rotated)
+            entry = None
+        if entry is None:
+            entry = self.files[filename] = {'handle': open(path, 'ab'), 'day': today}
+        return entry['handle']
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+        for entry in self.files.values():
+            entry['handle'].close()
+        self.files.clear()
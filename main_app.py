@@ -1,22 +1,52 @@
 # coding=UTF-8
-from flask import Flask, request, render_template, redirect, session, send_file, jsonify, Response
-from flask_socketio import SocketIO, emit, join_room, leave_room
+import os
+# 协作式I/O：以eventlet运行时必须在导入其他模块之前打猴子补丁，pymongo的网络等待、后台线程与time.sleep
+# 都变为可让出的绿色线程，一次慢查询只阻塞发起它的请求或事件，不会拖住同一worker上的其他连接；
+# AQS_ASYNC_MODE=threading时改用普通线程（如在调试器中运行）
+ASYNC_MODE = os.environ.get('AQS_ASYNC_MODE', 'eventlet')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, request, render_template, redirect, session, send_file, jsonify, Response, g, has_app_context
+from flask.json import htmlsafe_dumps
+from flask_socketio import SocketIO, emit, join_room
+from markupsafe import Markup
 from flask_limiter import Limiter
 import pymongo
 import time
 import secrets
 import json
-import os
-import pandas as pd
+import gzip
+import hashlib
+import functools
+import atexit
+import threading
 from io import BytesIO
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from urllib.parse import quote
+from datetime import datetime, timezone
+from exporter import EXPORT_FORMATS, queue_rows, stream_zip
+from metrics import Registry, MongoCommandListener
+from log_writer import LogWriter
+from scheduler import next_parent
+from broadcast import overview_row
+from importer import read_rows, parse_reserved, diff_reserved
+from queue_model import Status
+from events import EventRegistry
+from storage import open_database
+from checkpoint import CheckpointFile
+from ratelimit import TieredStorage  # 导入即注册 tiered+mongodb 存储
 
 
 # ==================== 初始化配置 ====================
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(16)
+# 多worker部署时所有进程必须使用同一个密钥，否则session无法在worker之间通用
+app.secret_key = os.environ.get('AQS_SECRET_KEY') or secrets.token_hex(16)
 app.config['PARENT_KEY'] = 'parent'
 app.config['TEACHER_KEY'] = 'teacher123321'
+# 管理员密钥，可批量导入所有老师的提前预订名单；未设置时没有管理员，老师只能导入自己的名单
+app.config['ADMIN_KEY'] = os.environ.get('AQS_ADMIN_KEY')
 
 APPOINTMENT_START_TIME = datetime(2026, 11, 20, 8, 0, 0)
 CONVERSION_START_TIME = "2025-11-21T16:45:00"
@@ -34,25 +64,151 @@ def get_real_ip():
         return request.remote_addr
 
 
-mongodb_uri = f"mongodb://127.0.0.1:27017/"
+mongodb_uri = os.environ.get('AQS_MONGODB_URI', 'mongodb://127.0.0.1:27017/')
+# 存储后端（见storage.py）：mongo为默认；memory为进程内存引擎，不需要数据库服务，只能单worker运行，重启后数据清空
+STORAGE = os.environ.get('AQS_STORAGE', 'mongo')
+
+# 多worker模式：设置消息队列地址后（如 redis://127.0.0.1:6379/0，或经kombu使用MongoDB的 mongodb://127.0.0.1:27017/aqs_socketio），
+# 任一worker发出的房间广播都会经消息队列送达所有worker上的订阅者，老师名额与排位每隔SHARED_STATE_TTL秒从数据库同步
+MESSAGE_QUEUE = os.environ.get('AQS_MESSAGE_QUEUE')
+MULTI_WORKER = bool(MESSAGE_QUEUE)
+SHARED_STATE_TTL = float(os.environ.get('AQS_SHARED_STATE_TTL', '1'))
+if MULTI_WORKER and STORAGE == 'memory':
+    raise RuntimeError('AQS_STORAGE=memory的数据只在本进程内，不能与AQS_MESSAGE_QUEUE多worker部署同时使用')
+
+def report_ratelimit_error(error):
+    error_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    log_writer.write('error.log', f"[{error_time}] Route: RateLimitSync - Error: {str(error)}\n\n", key=f"Route: RateLimitSync - Error: {str(error)}")
 
+
+# 限流计数先在本worker内存中判断，每隔AQS_RATELIMIT_SYNC秒与数据库批量同步一次（见ratelimit.py）；内存存储时只在本进程计数
 limiter = Limiter(
     app=app,
     key_func=get_real_ip,
-    storage_uri=mongodb_uri
+    storage_uri='memory://' if STORAGE == 'memory' else 'tiered+' + mongodb_uri,
+    storage_options={'sync_interval': float(os.environ.get('AQS_RATELIMIT_SYNC', '2')), 'on_error': report_ratelimit_error},
+    strategy='moving-window'
 )
 
-os.makedirs('log', exist_ok=True)
 
-# 初始化SocketIO
-socketio = SocketIO(app, ping_interval=5, ping_timeout=20)
+def reset_rate_limit():
+    """登录成功后只清除当前IP在本路由上的计数，不影响其他人"""
+    for current in limiter.current_limits:
+        limiter.limiter.clear(current.limit, *current.request_args)
 
-# 数据库连接
-client = pymongo.MongoClient(mongodb_uri)
-db = client['aqs']
+# 日志由后台线程批量写入log目录，同一IP对同一路由的重复记录在10秒内合并为一条
+# 日志目录，测试时指向临时目录
+log_writer = LogWriter(os.environ.get('AQS_LOG_DIR', 'log'))
 
-with open('teacher.json', 'r', encoding='utf-8') as f:
-    teachers = json.load(f)
+# 初始化SocketIO
+socketio = SocketIO(app, ping_interval=5, ping_timeout=20, message_queue=MESSAGE_QUEUE, async_mode=ASYNC_MODE)
+
+# 导出文件的生成（openpyxl逐行写xlsx）是纯计算，eventlet下放到最多AQS_EXPORT_THREADS个系统线程中执行，
+# 生成期间事件循环仍能处理其他连接；threading模式下每个请求本就在自己的线程中，直接执行
+EXPORT_THREADS = int(os.environ.get('AQS_EXPORT_THREADS', '4'))
+if ASYNC_MODE == 'eventlet':
+    from eventlet import tpool
+    tpool.set_num_threads(EXPORT_THREADS)
+
+
+def run_blocking(func, *args):
+    """在线程池中执行不会让出的计算，func不能访问请求上下文"""
+    if ASYNC_MODE == 'eventlet':
+        return tpool.execute(func, *args)
+    return func(*args)
+
+# ==================== 运行指标 ====================
+# /metrics 输出Prometheus格式的指标，设置AQS_METRICS_TOKEN后需以 ?token= 访问；多worker部署时每个worker各自统计
+METRICS_TOKEN = os.environ.get('AQS_METRICS_TOKEN')
+registry = Registry()
+http_latency = registry.histogram('aqs_http_request_duration_seconds', 'HTTP请求处理耗时', ['method', 'route'])
+http_in_flight = registry.gauge('aqs_http_requests_in_flight', '正在处理的HTTP请求数')
+event_latency = registry.histogram('aqs_socket_event_duration_seconds', 'Socket事件处理耗时', ['event'])
+event_in_flight = registry.gauge('aqs_socket_events_in_flight', '正在处理的Socket事件数')
+mongo_calls = registry.histogram('aqs_mongo_calls_per_request', '每个请求或事件的数据库命令数', ['handler'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55))
+mongo_seconds = registry.histogram('aqs_mongo_seconds_per_request', '每个请求或事件的数据库耗时', ['handler'])
+broadcast_fanout = registry.histogram('aqs_broadcast_fanout', '每次房间广播送达的本worker连接数', ['event'], buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+broadcast_batch = registry.histogram('aqs_broadcast_ops_per_frame', '每帧合并的队列增量操作数', buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55))
+queue_active = registry.gauge('aqs_teacher_queue_active', '老师队列中未完成的家长数', ['event', 'teacher'])
+queue_capacity = registry.gauge('aqs_teacher_queue_capacity', '老师的预约名额上限', ['event', 'teacher'])
+
+
+def record_mongo_command(duration):
+    """数据库命令完成时计入当前请求或事件"""
+    if has_app_context() and 'mongo_calls' in g:
+        g.mongo_calls += 1
+        g.mongo_seconds += duration
+
+
+def start_tracking():
+    g.started = time.perf_counter()
+    g.mongo_calls = 0
+    g.mongo_seconds = 0.0
+
+
+def finish_tracking(handler):
+    mongo_calls.observe(g.mongo_calls, handler)
+    mongo_seconds.observe(g.mongo_seconds, handler)
+    return time.perf_counter() - g.started
+
+
+@app.before_request
+def before_request_metrics():
+    start_tracking()
+    g.http_request = True
+    http_in_flight.inc()
+
+
+@app.teardown_request
+def teardown_request_metrics(error=None):
+    # Socket事件结束时也会触发teardown，只统计HTTP请求
+    if not g.get('http_request'):
+        return
+    rule = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_latency.observe(finish_tracking(f'{request.method} {rule}'), request.method, rule)
+    http_in_flight.dec()
+
+
+def timed_event(name):
+    """统计Socket事件的处理耗时与数据库调用"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_tracking()
+            event_in_flight.inc()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                event_latency.observe(finish_tracking(f'ws {name}'), name)
+                event_in_flight.dec()
+        return wrapper
+    return decorator
+
+
+def room_size(room, namespace='/'):
+    """本worker上加入某个房间的连接数"""
+    return len(socketio.server.manager.rooms.get(namespace, {}).get(room, {}))
+
+
+@registry.collect
+def collect_queue_lengths():
+    for event in events:
+        for teacher_id, setting in event.setting_memory.items():
+            queue_active.set(setting['peoples'], event.id, teacher_id)
+            queue_capacity.set(setting['maxParents'], event.id, teacher_id)
+
+
+# 数据库连接：eventlet下每个等待数据库的绿色线程占用连接池中的一个连接，AQS_MONGO_POOL_SIZE限制同时进行的
+# 数据库操作数，超出时最多等待AQS_MONGO_WAIT_TIMEOUT秒后报错，AQS_MONGO_MIN_POOL_SIZE为预先建立的空闲连接数
+db = open_database(
+    STORAGE,
+    mongodb_uri,
+    os.environ.get('AQS_DB_NAME', 'aqs'),
+    maxPoolSize=int(os.environ.get('AQS_MONGO_POOL_SIZE', '100')),
+    minPoolSize=int(os.environ.get('AQS_MONGO_MIN_POOL_SIZE', '0')),
+    waitQueueTimeoutMS=int(float(os.environ.get('AQS_MONGO_WAIT_TIMEOUT', '10')) * 1000),
+    event_listeners=[MongoCommandListener(record_mongo_command)]
+)
 
 with open('class.json', 'r', encoding='utf-8') as f:
     classes_data = json.load(f)
@@ -60,14 +216,231 @@ with open('class.json', 'r', encoding='utf-8') as f:
 with open('notice.txt', 'r', encoding='utf-8') as file:
     notice = file.readlines()
 
-setting_memory = {}
-for i in teachers:
-    data = db.teacher.find_one({'id': str(i['id'])})
-    if data == None:
-        db.teacher.insert_one({'id': str(i['id']), 'maxParents': 10, 'reservedStudents': [], 'queue': []})
-        setting_memory[str(i['id'])] = {'maxParents': 10, 'peoples': 0}
+# ==================== 场次 ====================
+# 每个场次的老师名单、开放时间、集合前缀与Socket.IO命名空间在events.json（可由AQS_EVENTS指定）中配置，
+# 队列内存模型、名额、预计时间与缓存都按场次隔离，见events.py；没有events.json时只有一个沿用teacher.json与上面时间设置的默认场次
+events = EventRegistry(os.environ.get('AQS_EVENTS', 'events.json'), db, {
+    'id': 'default',
+    'grade': '初一',
+    'teachers': 'teacher.json',
+    'appointment_start': APPOINTMENT_START_TIME,
+    'conversion_start': CONVERSION_START_TIME
+}, multi_worker=MULTI_WORKER, shared_state_ttl=SHARED_STATE_TTL)
+
+
+def current_event():
+    """当前请求或Socket事件所属的场次，后台任务中为event_context指定的场次"""
+    return g.event
+
+
+@contextmanager
+def event_context(event):
+    """后台任务没有请求上下文，在新的应用上下文中指定场次后运行"""
+    with app.app_context():
+        g.event = event
+        yield event
+
+
+# ==================== 预热快照 ====================
+# 每隔AQS_WARM_START_INTERVAL秒（0为关闭）及进程退出时，把各场次的名额、队列内存模型、用时估计与预序列化响应
+# 写入AQS_WARM_START_FILE；重启时先用快照恢复并按数据库校正名额，有变化的队列在后台重新读取，见checkpoint.py
+WARM_START_INTERVAL = float(os.environ.get('AQS_WARM_START_INTERVAL', '30'))
+checkpoint = CheckpointFile(os.environ.get('AQS_WARM_START_FILE', os.path.join('state', 'warm_start.pkl')),
+                            max_age=float(os.environ.get('AQS_WARM_START_MAX_AGE', '3600')))
+warm_states = checkpoint.load() if WARM_START_INTERVAL > 0 else {}
+# 版本号取自场次计数器、可随快照恢复的预序列化响应
+WARM_PAYLOADS = ('teachers', 'teachers_json', 'setting')
+
+
+def save_checkpoint():
+    # 快照只是缓存，任何异常都只记录日志，不能结束定期保存的线程
+    try:
+        checkpoint.save([*events], WARM_PAYLOADS)
+    except Exception as error:
+        error_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        log_writer.write('error.log', f"[{error_time}] Route: WarmStart - Error: {str(error)}\n\n", key=f"Route: WarmStart - Error: {str(error)}")
+
+
+def save_checkpoint_periodically():
+    while True:
+        time.sleep(WARM_START_INTERVAL)
+        save_checkpoint()
+
+
+def load_event(event):
+    """加载场次的全部老师数据并记录启动日志；有可用的预热快照时先恢复快照，再在后台与数据库校正"""
+    started = time.time()
+    startup_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    warm = event.warm_start(warm_states.pop(event.id, None))
+    if warm is not None:
+        stale, active = warm
+        elapsed = time.time() - started
+        log_writer.write('startup.log', f"[{startup_time}] Event {event.id}: Warm-started {len(event.teachers)} teachers from snapshot ({len(stale)} queues changed since) in {elapsed * 1000:.1f}ms\n\n")
+        socketio.start_background_task(reconcile_event, event, stale, active)
+        return
+    count, created, restored, fixed = event.load_teachers()
+    elapsed = time.time() - started
+    log_writer.write('startup.log', f"[{startup_time}] Event {event.id}: Loaded {count} teachers ({created} created, {restored} restored from queue log, {fixed} counters fixed) in {elapsed * 1000:.1f}ms\n\n")
+
+
+def reconcile_event(event, stale, active):
+    """预热启动后的后台校正，重新读取的队列推送给老师页面与家长"""
+    started = time.time()
+    fixed = event.reconcile(stale, active)
+    with event_context(event):
+        for teacher_id in stale:
+            event.broadcast.add_snapshot(teacher_id)
+            mark_queue_changed(teacher_id)
+        if stale:
+            schedule_broadcast(event)
+    elapsed = time.time() - started
+    reconcile_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    log_writer.write('startup.log', f"[{reconcile_time}] Event {event.id}: Reconciled with database ({len(stale)} queues reloaded, {fixed} counters fixed) in {elapsed * 1000:.1f}ms\n\n")
+
+
+def refresh_events(force=False):
+    """events.json有变化时加载新增的场次并注册其命名空间，老师名单变化的场次补建老师数据；
+    配置有误时记录错误并继续使用原有场次"""
+    try:
+        added, changed, removed = events.refresh(force)
+    except (OSError, KeyError, ValueError) as error:
+        if force:
+            raise
+        error_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        log_writer.write('error.log', f"[{error_time}] Route: EventConfig - Error: {str(error)}\n\n", key=f"Route: EventConfig - Error: {str(error)}")
+        return
+    for event in added + changed:
+        load_event(event)
+    for event in added:
+        register_namespace(event.namespace)
+
+
+# 已注册Socket事件的命名空间与全部Socket事件处理函数，新场次的命名空间在加载时补注册全部事件
+socket_namespaces = set()
+socket_handlers = {}
+
+
+def register_namespace(namespace):
+    if namespace in socket_namespaces:
+        return
+    socket_namespaces.add(namespace)
+    for name, handler in socket_handlers.items():
+        socketio.on_event(name, handler, namespace=namespace)
+
+
+def socket_event(name):
+    """把Socket事件注册到所有场次的命名空间，处理时按命名空间确定场次，并统计处理耗时与数据库调用"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            g.event = events.by_namespace(request.namespace)
+            if g.event is None:
+                return
+            return func(*args, **kwargs)
+        handler = timed_event(name)(wrapper)
+        socket_handlers[name] = handler
+        for namespace in socket_namespaces:
+            socketio.on_event(name, handler, namespace=namespace)
+        return handler
+    return decorator
+
+
+@app.before_request
+def select_event():
+    """按session确定当前场次，访问任意页面时带 ?event= 可切换场次，切换时清除原有登录状态"""
+    refresh_events()
+    event_id = request.args.get('event')
+    if event_id and event_id != session.get('event') and events.get(event_id) is not None:
+        session.clear()
+        session['event'] = event_id
+    g.event = events.get(session.get('event'))
+    if g.event is None:
+        if 'event' in session:
+            # 所在场次已被移除，需要重新登录
+            session.clear()
+        g.event = events.default
+        session['event'] = g.event.id
+
+
+@app.context_processor
+def inject_event():
+    return {'t_event': g.event.describe()} if 'event' in g else {}
+
+
+def attach_rankings(entries, name):
+    """为预约记录补充实时计算的ranking与estimatedTime字段"""
+    event = current_event()
+    etas = event.current_etas()
+    return [{**item, 'ranking': event.get_ranking(item['teacher_id'], name), 'estimatedTime': etas.lookup(item['teacher_id'], name)} for item in entries]
+
+
+refresh_events(force=True)
+if WARM_START_INTERVAL > 0:
+    # 与日志写入线程一样使用守护线程，不阻止进程退出，退出时由atexit再保存一次
+    threading.Thread(target=save_checkpoint_periodically, name='warm-start', daemon=True).start()
+    atexit.register(save_checkpoint)
+
+
+# ==================== 预序列化响应 ====================
+# 不常变化的数据只序列化一次，连同gzip压缩结果与ETag一起缓存在当前场次中，数据版本变化时才重新生成
+
+
+def cached_payload(key, version, build):
+    """按key缓存build()生成的字节，version变化时重新生成"""
+    payload_cache = current_event().payload_cache
+    entry = payload_cache.get(key)
+    if entry is None or entry['version'] != version:
+        body = build()
+        entry = {'version': version, 'body': body, 'gzip': gzip.compress(body), 'etag': hashlib.md5(body).hexdigest()}
+        payload_cache[key] = entry
+    return entry
+
+
+def cached_json_text(key, version, data):
+    """返回可直接嵌入页面的JSON文本，等同于模板中的tojson过滤器"""
+    return Markup(cached_payload(key, version, lambda: htmlsafe_dumps(data).encode('utf-8'))['body'].decode('utf-8'))
+
+
+def payload_response(body, etag, gzipped=None, mimetype='application/json'):
+    """返回带ETag的响应，客户端缓存未过期时返回304，客户端支持时返回gzip压缩内容"""
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif gzipped is not None and 'gzip' in request.accept_encodings:
+        response = Response(gzipped, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
     else:
-        setting_memory[str(i['id'])] = {'maxParents': data['maxParents'], 'peoples': len(data['queue'])}
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# 页面ETag中加入进程启动时生成的随机值，重启后（预计时间等未持久化的状态已重新计算）客户端缓存全部失效
+PAGE_ETAG_SALT = secrets.token_hex(8)
+
+
+def page_etag(*parts):
+    """按页面依赖的会话信息与数据版本号生成ETag，无需先渲染页面"""
+    return hashlib.md5(json.dumps([PAGE_ETAG_SALT, *parts], ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+def page_response(etag, render):
+    """页面未变化时直接返回304，不渲染也不压缩；否则调用render()渲染，客户端支持时才压缩"""
+    if etag in request.if_none_match:
+        return payload_response(None, etag)
+    body = render().encode('utf-8')
+    gzipped = gzip.compress(body, compresslevel=6) if len(body) > 1024 and 'gzip' in request.accept_encodings else None
+    return payload_response(body, etag, gzipped, mimetype='text/html')
+
+
+def parent_page_etag(page, data):
+    """家长页面依赖：会话、预约记录、老师名单与名额、各队列排位与预计时间"""
+    event = current_event()
+    etas = event.current_etas()
+    booked = [data.get('appointment'), data.get('must')] if data else None
+    return page_etag(page, event.id, session.get('id'), session.get('name'), session.get('className'), booked,
+                     event.conversion_start, event.roster_version, event.setting_version, event.queues_version, etas.generation)
 
 
 # ==================== Flask路由 ====================
@@ -90,12 +463,19 @@ def verify_key():
     if key == app.config['PARENT_KEY']:
         session['parent_verified'] = True
         session['role'] = 'parent'
-        limiter.reset()
+        reset_rate_limit()
         return jsonify({'success': True, 'role': 'parent'})
     elif key == app.config['TEACHER_KEY']:
         session['teacher_verified'] = True
         session['role'] = 'teacher'
-        limiter.reset()
+        reset_rate_limit()
+        return jsonify({'success': True, 'role': 'teacher'})
+    elif app.config['ADMIN_KEY'] and key == app.config['ADMIN_KEY']:
+        # 管理员同样以老师身份登录，另外可导入其他老师的名单
+        session['teacher_verified'] = True
+        session['admin_verified'] = True
+        session['role'] = 'teacher'
+        reset_rate_limit()
         return jsonify({'success': True, 'role': 'teacher'})
     else:
         return jsonify({'success': False, 'message': '密钥错误，请重新输入'})
@@ -105,15 +485,21 @@ def verify_key():
 def get_teachers():
     if not session.get('teacher_verified'):
         return redirect('/login')
-    return jsonify(teachers)
+    event = current_event()
+    entry = cached_payload('teachers', event.roster_version, lambda: json.dumps(event.teachers, ensure_ascii=False).encode('utf-8'))
+    return payload_response(entry['body'], entry['etag'], entry['gzip'])
 
 
 @app.route('/get_classes')
 def get_classes():
     if not (session.get('parent_verified') or session.get('teacher_verified')):
         return jsonify({'success': False, 'message': '未授权'}), 401
-    grade = request.args.get('grade', '初一')
-    return jsonify({'grade': grade, 'classes': classes_data.get(grade, [])})
+    grade = request.args.get('grade', current_event().grade)
+    if grade not in classes_data:
+        # 只缓存class.json中的年级，任意参数不会产生新的缓存项
+        return jsonify({'success': False, 'message': '年级不存在'}), 400
+    entry = cached_payload(f'classes:{grade}', 0, lambda: json.dumps({'grade': grade, 'classes': classes_data[grade]}, ensure_ascii=False).encode('utf-8'))
+    return payload_response(entry['body'], entry['etag'], entry['gzip'])
 
 @app.route('/handle', methods=['POST'])
 @limiter.limit('10 per hour')
@@ -122,12 +508,12 @@ def handle():
         session['name'] = request.json['name']
         session['className'] = request.json['className']
         session['id'] = session['className'] + session['name']
-        limiter.reset()
+        reset_rate_limit()
         return jsonify({'success': True})
     elif session['role'] == 'teacher' and 'teacher_verified' in session:
         session['id'] = request.json['name']
-        session['name'] = teachers[int(session['id'])-1]['name']
-        limiter.reset()
+        session['name'] = current_event().teachers[int(session['id'])-1]['name']
+        reset_rate_limit()
         return jsonify({'success': True})
     else:
         return jsonify({'success': False, 'message': '登录失败，请重试'})
@@ -143,15 +529,21 @@ def logout():
 def parent():
     if not session.get('parent_verified'):
         return redirect('/login')
-    data = db.parent.find_one({'name': session['id']})
-    if data == None:
-        appointments = []
-        must = []
-    else:
-        appointments = data['appointment']
-        must = data['must']
-    
-    return render_template('parent.html', t_name=session['name'], t_appointment=appointments, t_must=must, t_setting=setting_memory, t_start_time=CONVERSION_START_TIME, t_teachers=teachers)
+    event = current_event()
+    event.sync_shared_state()
+    data = event.parent.find_one({'name': session['id']})
+
+    def render():
+        if data == None:
+            appointments = []
+            must = []
+        else:
+            appointments = attach_rankings(data['appointment'], session['id'])
+            must = attach_rankings(data['must'], session['id'])
+        t_setting = cached_json_text('setting', event.setting_version, event.setting_memory)
+        return render_template('parent.html', t_name=session['name'], t_appointment=appointments, t_must=must, t_setting=t_setting, t_start_time=event.conversion_start, t_teachers=event.teachers)
+
+    return page_response(parent_page_etag('parent', data), render)
 
 
 @app.route('/parent/appointment')
@@ -159,45 +551,103 @@ def appointment():
     if not session.get('parent_verified'):
         return redirect('/login')
     
+    event = current_event()
     if ENABLE_TIME_CHECK:
         current_time = datetime.now()
-        if current_time < APPOINTMENT_START_TIME:
-            return render_template('appointment_not_available.html', t_start_time=APPOINTMENT_START_TIME.strftime('%Y-%m-%d %H:%M:%S'))
+        if current_time < event.appointment_start:
+            return render_template('appointment_not_available.html', t_start_time=event.appointment_start.strftime('%Y-%m-%d %H:%M:%S'))
     
-    data = db.parent.find_one({'name': session['id']})
-    if data == None:
-        appointment = []
-        must = []
-    else:
-        appointment = data['appointment']
-        must = data['must']
-    
-    return render_template('appointment.html', t_name=session['name'], t_className=session['className'], t_teacher=teachers, t_notice=notice, t_appointment=appointment, t_must=must, t_setting=setting_memory, t_start_time=CONVERSION_START_TIME)
+    event.sync_shared_state()
+    data = event.parent.find_one({'name': session['id']})
+
+    def render():
+        if data == None:
+            appointment = []
+            must = []
+        else:
+            appointment = attach_rankings(data['appointment'], session['id'])
+            must = attach_rankings(data['must'], session['id'])
+        t_teacher = cached_json_text('teachers_json', event.roster_version, event.teachers)
+        t_setting = cached_json_text('setting', event.setting_version, event.setting_memory)
+        return render_template('appointment.html', t_name=session['name'], t_className=session['className'], t_teacher=t_teacher, t_notice=notice, t_appointment=appointment, t_must=must, t_setting=t_setting, t_start_time=event.conversion_start)
+
+    return page_response(parent_page_etag('appointment', data), render)
+
+
+def reserve_op(teacher_id, item):
+    """占用名额的条件更新：名额未满且家长不在队列中时才写入"""
+    return (
+        {
+            'id': str(teacher_id),
+            'queue.name': {'$ne': item['name']},
+            '$expr': {'$lt': [{'$ifNull': ['$active', 0]}, '$maxParents']}
+        },
+        {'$push': {'queue': item}, '$inc': {'active': 1, 'version': 1}}
+    )
+
+
+def release_ops(teacher_id, name):
+    """归还名额的条件更新：未完成的家长归还名额，已完成的家长只移出队列，两者只会有一个生效"""
+    return [
+        (
+            {'id': str(teacher_id), 'queue': {'$elemMatch': {'name': name, 'status': {'$ne': 'completed'}}}},
+            {'$pull': {'queue': {'name': name}}, '$inc': {'active': -1, 'version': 1}}
+        ),
+        (
+            {'id': str(teacher_id), 'queue.name': name},
+            {'$pull': {'queue': {'name': name}}, '$inc': {'version': 1}}
+        )
+    ]
+
+
+def reserve_slot(teacher_id, name, type='自主预约'):
+    """原子地占用老师的一个预约名额，名额已满或家长已在队列中时返回None"""
+    event = current_event()
+    item = {'name': name, 'status': 'waiting', 'type': type}
+    data = event.teacher.find_one_and_update(
+        *reserve_op(teacher_id, item),
+        projection={'maxParents': 1, 'version': 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if data is None:
+        return None
+    event.update_setting(teacher_id, maxParents=data['maxParents'])
+    ops = [{'op': 'insert', 'item': item}]
+    event.apply_queue_ops(teacher_id, data['version'], ops)
+    emit_queue_delta(teacher_id, data['version'], ops, 'book')
+    return data
+
+
+def release_slot(teacher_id, name):
+    """将家长移出老师队列并归还名额，已完成的家长不占用名额"""
+    event = current_event()
+    for query, update in release_ops(teacher_id, name):
+        data = event.teacher.find_one_and_update(query, update, projection={'version': 1}, return_document=pymongo.ReturnDocument.AFTER)
+        if data is not None:
+            break
+    if data is None:
+        if name in event.queues.get(str(teacher_id), ()):
+            event.reload_queue(teacher_id)
+        return
+    ops = [{'op': 'remove', 'name': name}]
+    event.apply_queue_ops(teacher_id, data['version'], ops)
+    emit_queue_delta(teacher_id, data['version'], ops, 'cancel')
+
+
+def book_teachers(name, teacher_ids):
+    """批量预约多位老师，全部成功或全部回滚，返回预约失败的老师id"""
+    reserved = []
+    for teacher_id in teacher_ids:
+        if reserve_slot(teacher_id, name) is None:
+            for i in reserved:
+                release_slot(i, name)
+            return teacher_id
+        reserved.append(teacher_id)
+    return None
 
 
 def dele(id, name):
-    data = db.teacher.find_one({'id': id})
-    i = 0
-    while data['queue'][i]['name'] != name:
-        i += 1
-    # 获取被删除元素的预约类型
-    removed_type = data['queue'][i].get('type', '未知')
-    i += 1
-    while i < len(data['queue']):
-        data1 = db.parent.find_one({'name': data['queue'][i]['name']})
-        # 根据预约类型查找相应数据
-        if data['queue'][i].get('type') == '自主预约':
-            for j in data1.get('appointment', []):
-                if j['teacher_id'] == int(id):
-                    j['ranking'] -= 1
-            db.parent.update_one({'name': data['queue'][i]['name']}, {'$set': {'appointment': data1.get('appointment', [])}})
-        elif data['queue'][i].get('type') == '指定预约':
-            for j in data1.get('must', []):
-                if j['teacher_id'] == int(id):
-                    j['ranking'] -= 1
-            db.parent.update_one({'name': data['queue'][i]['name']}, {'$set': {'must': data1.get('must', [])}})
-        i += 1
-    db.teacher.update_one({'id': id}, {'$pull': {'queue': {'name': name}}})
+    release_slot(id, name)
 
 
 @app.route('/parent/appointment/save', methods=['POST'])
@@ -205,51 +655,204 @@ def save():
     if not session.get('parent_verified'):
         return redirect('/login')
     
+    event = current_event()
     if ENABLE_TIME_CHECK:
         current_time = datetime.now()
-        if current_time < APPOINTMENT_START_TIME:
-            return jsonify({'success': False, 'message': f'预约尚未开放，开放时间为：{APPOINTMENT_START_TIME.strftime("%Y-%m-%d %H:%M:%S")}'})
+        if current_time < event.appointment_start:
+            return jsonify({'success': False, 'message': f'预约尚未开放，开放时间为：{event.appointment_start.strftime("%Y-%m-%d %H:%M:%S")}'})
     
-    data = db.parent.find_one({'name': session['id']})
-    old_appointments = []
-    if data != None:
-        for i in data['appointment']:
-            old_appointments.append(i['teacher_id'])
+    if SURGE_MODE:
+        ticket = admit_booking(session['id'], request.json['appointments'])
+        return jsonify(wait_admission(ticket))
+    
+    data = event.parent.find_one({'name': session['id']})
+    appointments = data['appointment'] if data != None else []
+    old_appointments = [i['teacher_id'] for i in appointments]
     new_appointments = request.json['appointments']
     
-    for teacher_id in new_appointments:
-        if teacher_id not in old_appointments:
-            teacher_setting = setting_memory.get(str(teacher_id), {})
-            current_peoples = teacher_setting.get('peoples', 0)
-            max_parents = teacher_setting.get('maxParents', 10)
-            
-            if current_peoples >= max_parents:
-                return jsonify({'success': False, 'message': f'老师{teacher_id}的预约人数已满，无法预约'})
-        
-    if data == None:
-        appointments = []
-        for i in new_appointments:
-            appointments.append({'teacher_id': i, 'ranking': setting_memory[str(i)]['peoples']})
-            db.teacher.update_one({'id': str(i)}, {'$push': {'queue': {'name': session['id'], 'status': 'waiting', 'type': '自主预约'}}})
-            setting_memory[str(i)]['peoples'] += 1
-        db.parent.insert_one({'name': session['id'], 'appointment': appointments, 'must': []})
-    else:
-        appointments = data['appointment']
-        for i in old_appointments:
-            if i not in new_appointments:
-                dele(str(i), session['id'])
-                appointments = [item for item in appointments if item.get('teacher_id') != i]
-                setting_memory[str(i)]['peoples'] -= 1
-        for i in new_appointments:
-            if i not in old_appointments:
-                appointments.append({'teacher_id': i, 'ranking': setting_memory[str(i)]['peoples']})
-                db.teacher.update_one({'id': str(i)}, {'$push': {'queue': {'name': session['id'], 'status': 'waiting', 'type': '自主预约'}}})
-                setting_memory[str(i)]['peoples'] += 1
-        data['appointment'] = appointments
-        db.parent.update_one({'name': session['id']}, {'$set': data})
+    # 先原子地占用新增老师的名额，任一老师已满则整体回滚，原有预约保持不变
+    failed = book_teachers(session['id'], [i for i in new_appointments if i not in old_appointments])
+    if failed is not None:
+        return jsonify({'success': False, 'message': f'老师{failed}的预约人数已满，无法预约'})
+    
+    for i in old_appointments:
+        if i not in new_appointments:
+            dele(str(i), session['id'])
+            appointments = [item for item in appointments if item.get('teacher_id') != i]
+    for i in new_appointments:
+        if i not in old_appointments:
+            appointments.append({'teacher_id': i})
+    event.parent.update_one({'name': session['id']}, {'$set': {'appointment': appointments}, '$setOnInsert': {'must': []}}, upsert=True)
     return jsonify({'success': True})
 
 
+@app.route('/parent/appointment/save/status')
+def save_status():
+    if not session.get('parent_verified'):
+        return redirect('/login')
+    entry = current_event().admission_tickets.get(request.args.get('ticket', ''))
+    if entry is None or entry['name'] != session['id']:
+        return jsonify({'success': False, 'message': '排队信息已失效，请重新提交预约'})
+    return jsonify(admission_status(request.args['ticket']))
+
+
+# ==================== 开放时段排队预约 ====================
+# 开启后预约请求按到达顺序进入排队队列，由后台任务每次取出SURGE_BATCH_SIZE个请求合并写入数据库，
+# 请求在SURGE_WAIT秒内未处理完则返回排队号，前端凭排队号轮询结果；每个场次有各自的排队队列
+SURGE_MODE = os.environ.get('AQS_SURGE_MODE') == '1'
+SURGE_BATCH_SIZE = int(os.environ.get('AQS_SURGE_BATCH_SIZE', '50'))
+SURGE_WAIT = 3
+SURGE_TICKET_TTL = 600
+
+
+def admit_booking(name, appointments):
+    """预约请求排队，返回排队号"""
+    event = current_event()
+    event.admission_seq += 1
+    ticket = secrets.token_hex(8)
+    event.admission_tickets[ticket] = {'name': name, 'seq': event.admission_seq, 'result': None, 'time': time.time()}
+    event.admission_queue.append((ticket, name, appointments))
+    if not event.admission_draining:
+        event.admission_draining = True
+        socketio.start_background_task(drain_admission_queue, event)
+    return ticket
+
+
+def admission_status(ticket):
+    """返回预约结果，尚未处理时返回排队位置"""
+    event = current_event()
+    entry = event.admission_tickets[ticket]
+    if entry['result'] is not None:
+        return entry['result']
+    position = entry['seq'] - event.admission_done_seq
+    return {'success': False, 'pending': True, 'ticket': ticket, 'position': position, 'message': f'排队中，您前面还有{position - 1}人'}
+
+
+def wait_admission(ticket):
+    deadline = time.time() + SURGE_WAIT
+    tickets = current_event().admission_tickets
+    while tickets[ticket]['result'] is None and time.time() < deadline:
+        socketio.sleep(0.05)
+    return admission_status(ticket)
+
+
+def drain_admission_queue(event):
+    with event_context(event):
+        while event.admission_queue:
+            # 同一位家长的多次提交不能合并到同一批次，遇到重复时截断批次以保持先后顺序
+            batch = []
+            names = set()
+            while event.admission_queue and len(batch) < SURGE_BATCH_SIZE and event.admission_queue[0][1] not in names:
+                item = event.admission_queue.popleft()
+                batch.append(item)
+                names.add(item[1])
+            try:
+                results = commit_booking_batch([(name, appointments) for _, name, appointments in batch])
+            except Exception as error:
+                error_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+                log_writer.write('error.log', f"[{error_time}] Route: AdmissionBatch - Error: {str(error)}\n\n", key=f"Route: AdmissionBatch - Error: {str(error)}")
+                results = [{'success': False, 'message': '预约保存失败，请稍后重试'}] * len(batch)
+            for (ticket, name, _), result in zip(batch, results):
+                event.admission_tickets[ticket]['result'] = result
+                event.admission_done_seq = event.admission_tickets[ticket]['seq']
+                socketio.emit('booking_result', {**result, 'ticket': ticket}, room=f'parent_{name}', namespace=event.namespace)
+            expired = time.time() - SURGE_TICKET_TTL
+            for ticket in [t for t, entry in event.admission_tickets.items() if entry['result'] is not None and entry['time'] < expired]:
+                del event.admission_tickets[ticket]
+            socketio.sleep(0)
+        event.admission_draining = False
+
+
+def commit_booking_batch(requests):
+    """批量提交一批预约，每位家长新增的老师全部成功或全部回滚，按到达顺序分配名额"""
+    event = current_event()
+    names = [name for name, _ in requests]
+    parents = {data['name']: data for data in event.parent.find({'name': {'$in': names}}, {'_id': 0, 'name': 1, 'appointment': 1})}
+    plans = []
+    teacher_ids = set()
+    for name, new_appointments in requests:
+        appointments = parents[name]['appointment'] if name in parents else []
+        old_appointments = [i['teacher_id'] for i in appointments]
+        added = [i for i in new_appointments if i not in old_appointments]
+        removed = [i for i in old_appointments if i not in new_appointments]
+        plans.append({'name': name, 'appointments': appointments, 'added': added, 'removed': removed, 'result': None})
+        teacher_ids.update(str(i) for i in added + removed)
+    if not teacher_ids:
+        return [{'success': True} for _ in plans]
+
+    # 按到达顺序在内存中预演名额分配，再以条件更新批量写入，条件更新保证与其他worker并发时也不会超额
+    projection = {'_id': 0, 'id': 1, 'active': 1, 'maxParents': 1, 'queue.name': 1, 'version': 1}
+    capacity = {data['id']: data for data in event.teacher.find({'id': {'$in': [*teacher_ids]}}, projection)}
+    active = {teacher_id: data.get('active', 0) for teacher_id, data in capacity.items()}
+    ops = []
+    for plan in plans:
+        for i in plan['added']:
+            data = capacity.get(str(i))
+            if data is None or active[str(i)] >= data['maxParents'] or plan['name'] in [item['name'] for item in data.get('queue', [])]:
+                plan['result'] = {'success': False, 'message': f'老师{i}的预约人数已满，无法预约'}
+                break
+        if plan['result'] is not None:
+            continue
+        for i in plan['added']:
+            active[str(i)] += 1
+            ops.append(pymongo.UpdateOne(*reserve_op(i, {'name': plan['name'], 'status': 'waiting', 'type': '自主预约'})))
+    if ops:
+        event.teacher.bulk_write(ops, ordered=True)
+
+    # 核对写入结果，未能全部占到名额的家长整体回滚，成功的家长再取消其不再预约的老师
+    projection = {'_id': 0, 'id': 1, 'queue': 1, 'version': 1}
+    queues = {data['id']: data for data in event.teacher.find({'id': {'$in': [*teacher_ids]}}, projection)}
+    ops = []
+    # teacher_id -> 每次写入（每条使版本号加一）的增量操作，按写入顺序排列
+    inserted = {}
+    removed = {}
+    for plan in plans:
+        if plan['result'] is not None:
+            continue
+        landed = [i for i in plan['added'] if plan['name'] in [item['name'] for item in queues[str(i)]['queue']]]
+        if len(landed) < len(plan['added']):
+            failed = [i for i in plan['added'] if i not in landed][0]
+            plan['result'] = {'success': False, 'message': f'老师{failed}的预约人数已满，无法预约'}
+            release = landed
+        else:
+            plan['result'] = {'success': True}
+            release = plan['removed']
+        for i in landed:
+            inserted.setdefault(str(i), []).append({'op': 'insert', 'item': {'name': plan['name'], 'status': 'waiting', 'type': '自主预约'}})
+        for i in release:
+            if str(i) in queues and plan['name'] in [item['name'] for item in queues[str(i)]['queue']]:
+                removed.setdefault(str(i), []).append({'op': 'remove', 'name': plan['name']})
+            ops.extend(pymongo.UpdateOne(*op) for op in release_ops(i, plan['name']))
+    written = queues
+    if ops:
+        event.teacher.bulk_write(ops, ordered=True)
+        written = {data['id']: data for data in event.teacher.find({'id': {'$in': [*teacher_ids]}}, projection)}
+
+    ops = []
+    for plan in plans:
+        if plan['result']['success']:
+            appointments = [item for item in plan['appointments'] if item.get('teacher_id') not in plan['removed']]
+            appointments += [{'teacher_id': i} for i in plan['added']]
+            ops.append(pymongo.UpdateOne({'name': plan['name']}, {'$set': {'appointment': appointments}, '$setOnInsert': {'must': []}}, upsert=True))
+    if ops:
+        event.parent.bulk_write(ops, ordered=False)
+
+    # 每次写入按其版本号记录一条事件；两次读取之间版本号的增量与本批次的写入数不符时说明其他worker同时修改了队列，
+    # 无法确定各次写入的版本号，不记录事件，客户端补发时事件不连续会改发完整快照。只广播确有变化的老师
+    for teacher_id in {*inserted, *removed}:
+        data = written[teacher_id]
+        # 占用名额记为book，取消与回滚记为cancel，与非排队模式的reserve_slot、release_slot一致
+        for before, after, changes, action in ((capacity[teacher_id], queues[teacher_id], inserted.get(teacher_id, []), 'book'),
+                                               (queues[teacher_id], data, removed.get(teacher_id, []), 'cancel')):
+            version = before.get('version', 0)
+            if changes and after.get('version', 0) - version == len(changes):
+                for offset, op in enumerate(changes, 1):
+                    log_queue_event(teacher_id, version + offset, action, [op])
+        emit_queue_update(teacher_id, data['queue'], version=data.get('version', 0))
+        mark_queue_changed(teacher_id, [op['name'] for op in removed.get(teacher_id, [])])
+    return [plan['result'] for plan in plans]
+
+
 @app.route('/teacher')
 def teacher():
     if not session.get('teacher_verified'):
@@ -261,252 +864,596 @@ def teacher():
 def ontime():
     if not session.get('teacher_verified'):
         return redirect('/login')
-    data = db.teacher.find_one({'id': session['id']})
+    data = current_event().teacher.find_one({'id': session['id']})
     if data == None:
-        data = []
+        queue = []
+        version = 0
     else:
-        data = data['queue']
-    return render_template('ontime.html', t_queue=data)
+        queue = data['queue']
+        version = data.get('version', 0)
+    return render_template('ontime.html', t_queue=queue, t_version=version)
 
 
 @app.route('/teacher/list')
 def list():
     if not session.get('teacher_verified'):
         return redirect('/login')
-    data = db.teacher.find_one({'id': session['id']})
+    event = current_event()
+    data = event.teacher.find_one({'id': session['id']})
     if data == None:
         data = []
     else:
         data = data['queue']
-    return render_template('list.html', t_queue=data, t_start_time=CONVERSION_START_TIME)
+    times = event.current_etas().teacher_times(session['id'])
+    return render_template('list.html', t_queue=data, t_times=times, t_start_time=event.conversion_start, t_admin=session.get('admin_verified', False))
+
+
+@app.route('/overview')
+def overview():
+    """全部老师的总览面板，供管理员或走廊大屏使用"""
+    if not session.get('teacher_verified'):
+        return redirect('/login')
+    return render_template('overview.html', t_teachers=current_event().teachers)
 
 
 @app.route('/teacher/setting')
 def setting():
     if not session.get('teacher_verified'):
         return redirect('/login')
-    data = db.teacher.find_one({'id': session['id']})
+    data = current_event().teacher.find_one({'id': session['id']})
     maxParents = data['maxParents'] if data != None else 10
     reservedStudents = data['reservedStudents'] if data != None else []
     return render_template('setting.html', t_maxParents=maxParents, t_reservedStudents=reservedStudents)
 
 
+@app.route('/teacher/history')
+def teacher_history():
+    """查询本人队列在某一时刻（?at=2025-11-21T17:30:00，本地时间）或某一版本号（?version=）时的状态，
+    指定?name=时返回该家长在本人队列中的全部事件"""
+    if not session.get('teacher_verified'):
+        return jsonify({'success': False, 'message': '未授权'}), 401
+    queue_log = current_event().queue_log
+    name = request.args.get('name')
+    if name:
+        history = queue_log.history(name, session['id'])
+        for item in history:
+            item['time'] = item['time'].replace(tzinfo=timezone.utc).astimezone().strftime('%Y-%m-%dT%H:%M:%S')
+        return jsonify({'success': True, 'events': history})
+    try:
+        at = request.args.get('at')
+        at = datetime.strptime(at, '%Y-%m-%dT%H:%M:%S').astimezone(timezone.utc).replace(tzinfo=None) if at else None
+        version = request.args.get('version', type=int)
+    except ValueError:
+        return jsonify({'success': False, 'message': '时间格式错误'}), 400
+    queue, version = queue_log.state_at(session['id'], at=at, version=version)
+    return jsonify({'success': True, 'queue': queue, 'version': version})
+
+
 def add(name, id):
-    data = db.parent.find_one({'name': name})
+    event = current_event()
+    data = event.parent.find_one({'name': name})
     if data != None:
-        db.parent.update_one({'name': name}, {'$push': {'must': {'teacher_id': id, 'ranking': setting_memory[str(id)]['peoples']}}})
+        event.parent.update_one({'name': name}, {'$push': {'must': {'teacher_id': id}}})
     else:
-        db.parent.insert_one({'name': name, 'appointment': [], 'must': [{'teacher_id': id, 'ranking': setting_memory[str(id)]['peoples']}]})
-    setting_memory[str(id)]['peoples'] += 1
-    db.teacher.update_one({'id': str(id)}, {'$push': {'queue': {'name': name, 'status': 'waiting', 'type': '指定预约'}}})
+        event.parent.insert_one({'name': name, 'appointment': [], 'must': [{'teacher_id': id}]})
+    # 指定预约由老师安排，不受名额上限限制
+    item = {'name': name, 'status': 'waiting', 'type': '指定预约'}
+    data = event.teacher.find_one_and_update(
+        {'id': str(id)},
+        {'$push': {'queue': item}, '$inc': {'active': 1, 'version': 1}},
+        projection={'version': 1},
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if data is not None:
+        ops = [{'op': 'insert', 'item': item}]
+        event.apply_queue_ops(id, data['version'], ops)
+        emit_queue_delta(id, data['version'], ops, 'reserve')
 
 def delete(name, id):
-    # 获取teacher数据
-    teacher_data = db.teacher.find_one({'id': str(id)})
-    if teacher_data is None:
-        return
-    
-    # 找到要删除的queue项及其预约类型
-    queue_item = None
-    queue_index = -1
-    for i, item in enumerate(teacher_data.get('queue', [])):
-        if item.get('name') == name:
-            queue_item = item
-            queue_index = i
-            break
-    
+    # 通过内存队列找到要删除的queue项及其预约类型
+    event = current_event()
+    queue_item = event.queues[str(id)].entry(name) if str(id) in event.queues else None
     if queue_item is None:
         return
     
-    # 获取预约类型
-    appointment_type = queue_item.get('type', '未知')
-    
     # 从parent数据库中删除相应记录
-    parent_data = db.parent.find_one({'name': name})
-    if parent_data is not None:
-        if appointment_type == '自主预约':
-            db.parent.update_one({'name': name}, {'$pull': {'appointment': {'teacher_id': int(id)}}})
-        elif appointment_type == '指定预约':
-            db.parent.update_one({'name': name}, {'$pull': {'must': {'teacher_id': int(id)}}})
+    appointment_type = queue_item.type_text or '未知'
+    if appointment_type == '自主预约':
+        event.parent.update_one({'name': name}, {'$pull': {'appointment': {'teacher_id': int(id)}}})
+    elif appointment_type == '指定预约':
+        event.parent.update_one({'name': name}, {'$pull': {'must': {'teacher_id': int(id)}}})
     
-    # 更新后续队列项的时间显示
-    queue = teacher_data.get('queue', [])
-    for i in range(queue_index + 1, len(queue)):
-        current_item = queue[i]
-        # 更新parent数据库中的ranking
-        parent_name = current_item.get('name')
-        parent_data = db.parent.find_one({'name': parent_name})
-        if parent_data is not None:
-            if current_item.get('type') == '自主预约':
-                for j in parent_data.get('appointment', []):
-                    if j['teacher_id'] == int(id):
-                        j['ranking'] -= 1
-                db.parent.update_one({'name': parent_name}, {'$set': {'appointment': parent_data.get('appointment', [])}})
-            elif current_item.get('type') == '指定预约':
-                for j in parent_data.get('must', []):
-                    if j['teacher_id'] == int(id):
-                        j['ranking'] -= 1
-                db.parent.update_one({'name': parent_name}, {'$set': {'must': parent_data.get('must', [])}})
-    
-    # 从teacher数据库中删除queue项
-    db.teacher.update_one({'id': str(id)}, {'$pull': {'queue': {'name': name}}})
-    setting_memory[str(id)]['peoples'] -= 1
-
-
-def match_queue_item(item, parent_id=None, parent_name=None):
-    if parent_id:
-        item_id = item.get('id') or item.get('_id')
-        if item_id and str(item_id) == str(parent_id):
-            return True
-    if parent_name and item.get('name') == parent_name:
-        return True
-    return False
-
-
-def ensure_current_parent(queue):
-    has_current = any(item.get('status') == 'current' for item in queue)
-    if has_current:
-        return queue
-    for item in queue:
-        if item.get('status') == 'waiting':
-            item['status'] = 'current'
-            break
-    return queue
+    # 从teacher数据库中删除queue项并归还名额，后续家长的排位由索引实时计算
+    release_slot(id, name)
 
 
-def update_setting_memory_count(teacher_id, queue):
-    teacher_id = str(teacher_id)
-    active_count = len([item for item in queue if item.get('status') != 'completed'])
-    if teacher_id not in setting_memory:
-        setting_memory[teacher_id] = {'maxParents': 10, 'peoples': active_count}
-    else:
-        setting_memory[teacher_id]['peoples'] = active_count
+def ensure_current_parent(model, busy=(), remaining=None):
+    """没有正在谈话的家长时按排程规则选出下一位，busy中的家长正在其他老师处谈话，暂时跳过；
+    remaining为各家长在其他老师处的剩余预约数，见scheduler.next_parent；返回增量操作"""
+    if model.current:
+        return []
+    name = next_parent(model, busy, remaining)
+    if name is None:
+        return []
+    return [model.set_status(name, Status.CURRENT)]
+
 
+def update_setting_memory_count(teacher_id, queue, version=0):
+    """用完整队列重建内存模型，人数随之按未完成的家长重新统计"""
+    current_event().load_queue(str(teacher_id), queue, version)
 
-def emit_queue_update(teacher_id, queue=None, room=None):
+
+def emit_queue_update(teacher_id, queue=None, room=None, version=None):
+    """发送完整队列快照，仅用于加入房间或客户端版本落后时；不指定room时在下一个tick广播给老师房间"""
+    event = current_event()
     teacher_id = str(teacher_id)
     if queue is None:
-        teacher_data = db.teacher.find_one({'id': teacher_id})
+        teacher_data = event.teacher.find_one({'id': teacher_id})
         queue = teacher_data.get('queue', []) if teacher_data else []
-    update_setting_memory_count(teacher_id, queue)
-    payload = {'teacherId': teacher_id, 'queue': queue}
-    target_room = room or f'teacher_{teacher_id}'
-    socketio.emit('queue_update', payload, room=target_room)
+        version = teacher_data.get('version', 0) if teacher_data else 0
+    update_setting_memory_count(teacher_id, queue, version or 0)
+    if room is None:
+        event.broadcast.add_snapshot(teacher_id)
+        schedule_broadcast(event)
+        return
+    payload = {'teacherId': teacher_id, 'queue': queue, 'version': version or 0}
+    socketio.emit('queue_update', payload, room=room, namespace=event.namespace)
+
+
+def emit_queue_delta(teacher_id, version, ops, action):
+    """记录队列事件，队列增量在下一个tick与同一老师的其他变化合并发送"""
+    event = current_event()
+    log_queue_event(teacher_id, version, action, ops)
+    event.broadcast.add_delta(teacher_id, version, ops)
+    schedule_broadcast(event)
+    mark_queue_changed(teacher_id, [op['name'] for op in ops if op['op'] == 'remove'])
+
+
+# ==================== 合并广播 ====================
+# 队列变化先记入场次的广播缓冲区（见broadcast.py），每秒BROADCAST_HZ次为每位有变化的老师发送一帧，
+# 并向总览房间发送有变化的老师的紧凑行；AQS_BROADCAST_HZ=0时不合并，每次变化立即发送
+BROADCAST_HZ = float(os.environ.get('AQS_BROADCAST_HZ', '4'))
+OVERVIEW_ROOM = 'overview'
+
+
+def schedule_broadcast(event):
+    if BROADCAST_HZ <= 0:
+        flush_broadcast(event)
+    elif not event.broadcast.scheduled:
+        event.broadcast.scheduled = True
+        socketio.start_background_task(flush_broadcast, event)
+
+
+def flush_broadcast(event):
+    if BROADCAST_HZ > 0:
+        socketio.sleep(1 / BROADCAST_HZ)
+    event.broadcast.scheduled = False
+    deltas, snapshots, dirty = event.broadcast.take()
+    namespace = event.namespace
+    for teacher_id, frame in deltas.items():
+        room = f'teacher_{teacher_id}'
+        broadcast_fanout.observe(room_size(room, namespace), 'queue_delta')
+        broadcast_batch.observe(len(frame['ops']))
+        socketio.emit('queue_delta', {'teacherId': teacher_id, **frame}, room=room, namespace=namespace)
+    for teacher_id in snapshots:
+        model = event.queues.get(teacher_id)
+        if model is None:
+            continue
+        room = f'teacher_{teacher_id}'
+        broadcast_fanout.observe(room_size(room, namespace), 'queue_update')
+        socketio.emit('queue_update', {'teacherId': teacher_id, 'queue': model.to_documents(), 'version': model.version}, room=room, namespace=namespace)
+    rows = [overview_row(teacher_id, event.queues[teacher_id]) for teacher_id in sorted(dirty, key=int) if teacher_id in event.queues]
+    if rows:
+        broadcast_fanout.observe(room_size(OVERVIEW_ROOM, namespace), 'overview_update')
+        socketio.emit('overview_update', {'teachers': rows}, room=OVERVIEW_ROOM, namespace=namespace)
+
+
+def overview_payload():
+    """总览面板的完整数据，加入房间时发送一次，之后只接收有变化的行"""
+    event = current_event()
+    return {'teachers': [overview_row(teacher_id, model) for teacher_id, model in sorted(event.queues.items(), key=lambda item: int(item[0]))]}
+
+
+# 事件先暂存在内存，QUEUE_LOG_DELAY秒内的多条事件一次写入
+QUEUE_LOG_DELAY = 0.2
+
+
+def log_queue_event(teacher_id, version, action, ops):
+    event = current_event()
+    event.queue_log.record(teacher_id, version, action, ops)
+    if not event.queue_log_scheduled:
+        event.queue_log_scheduled = True
+        socketio.start_background_task(flush_queue_log, event)
+
+
+def flush_queue_log(event):
+    socketio.sleep(QUEUE_LOG_DELAY)
+    event.queue_log_scheduled = False
+    try:
+        event.queue_log.flush()
+    except pymongo.errors.PyMongoError as error:
+        error_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        log_writer.write('error.log', f"[{error_time}] Route: QueueLog - Error: {str(error)}\n\n", key=f"Route: QueueLog - Error: {str(error)}")
+
+
+def send_queue_catchup(teacher_id, since_version, room):
+    """客户端断线重连后只补发其版本号之后的事件，事件不连续时返回False，由调用方改发完整快照"""
+    event = current_event()
+    data = event.teacher.find_one({'id': str(teacher_id)}, {'_id': 0, 'version': 1})
+    if data is None:
+        return False
+    tail = event.queue_log.tail(teacher_id, since_version)
+    if tail is None or (tail[-1]['version'] if tail else since_version) != data.get('version', 0):
+        return False
+    for item in tail:
+        socketio.emit('queue_delta', {'teacherId': str(teacher_id), 'version': item['version'], 'ops': item['ops']}, room=room, namespace=event.namespace)
+    return True
+
+
+# ==================== 家长排位推送 ====================
+# 队列变化后先标记受影响的家长，等待PARENT_PUSH_DELAY秒合并多次变化，再给每位家长推送一条汇总消息
+PARENT_PUSH_DELAY = 0.5
+
+
+def parent_position_payload(name):
+    """汇总家长在所预约的每位老师队列中的前方等待人数、状态与预计时间"""
+    event = current_event()
+    items = []
+    etas = event.current_etas()
+    for teacher_id, model in event.queues.items():
+        entry = model.entry(name)
+        if entry is None:
+            continue
+        items.append({'teacherId': int(teacher_id), 'ahead': model.ahead(name), 'status': entry.status.text, 'estimatedTime': etas.lookup(teacher_id, name)})
+    return {'teachers': items}
+
+
+def mark_queue_changed(teacher_id, names=()):
+    """标记队列中的家长需要推送排位，同一时间窗口内的多次变化只推送一次"""
+    event = current_event()
+    model = event.queues.get(str(teacher_id))
+    if model is not None:
+        event.dirty_parents.update(model.names())
+    event.dirty_parents.update(names)
+    if event.dirty_parents and not event.parent_push_scheduled:
+        event.parent_push_scheduled = True
+        socketio.start_background_task(flush_parent_positions, event)
+
+
+def flush_parent_positions(event):
+    socketio.sleep(PARENT_PUSH_DELAY)
+    event.parent_push_scheduled = False
+    names = [event.dirty_parents.pop() for _ in range(len(event.dirty_parents))]
+    with event_context(event):
+        for name in names:
+            payload = parent_position_payload(name)
+            if event.parent_push_cache.get(name) == payload:
+                continue
+            event.parent_push_cache[name] = payload
+            socketio.emit('position_update', payload, room=f'parent_{name}', namespace=event.namespace)
+
+
+QUEUE_CAS_RETRIES = 5
+
+
+def mutate_queue(teacher_id, mutation, action):
+    """在内存队列上执行修改，再以版本号做比较交换写回数据库；期间队列被其他worker修改时重新加载并重试
+    mutation修改传入的TeacherQueue并返回增量操作，无需修改时返回None；返回(队列模型, 是否已修改)"""
+    event = current_event()
+    teacher_id = str(teacher_id)
+    # 空队列的模型长度为0，不能用真值判断是否已加载
+    model = event.queues.get(teacher_id)
+    if model is None:
+        model = event.reload_queue(teacher_id)
+    for _ in range(QUEUE_CAS_RETRIES):
+        version = model.version
+        try:
+            ops = mutation(model)
+            if ops is None:
+                return model, False
+            if all(op['op'] == 'status' and len(model.by_name[op['name']]) == 1 for op in ops):
+                # 只改状态时按位置更新对应元素，避免整体覆盖队列
+                changes = {f"queue.{model.position(op['name'])}.status": op['status'] for op in ops}
+            else:
+                changes = {'queue': model.to_documents()}
+            changes['active'] = model.active_count
+            result = event.teacher.update_one({'id': teacher_id, 'version': version or {'$in': [0, None]}}, {'$set': changes, '$inc': {'version': 1}})
+        except pymongo.errors.PyMongoError:
+            # 内存已修改但未能写入，丢弃内存模型，下次使用时从数据库重新加载
+            event.queues.pop(teacher_id, None)
+            raise
+        if result.matched_count:
+            model.version = version + 1
+            event.queues_version += 1
+            event.update_setting(teacher_id, peoples=model.active_count)
+            emit_queue_delta(teacher_id, version + 1, ops, action)
+            return model, True
+        model = event.reload_queue(teacher_id)
+    # 冲突持续时放弃本次操作，让客户端重新同步最新队列
+    emit_queue_update(teacher_id)
+    return model, False
+
+
+RESERVED_WRITE_ROUNDS = 3
+
+
+def apply_reserved_lists(lists):
+    """把多位老师的提前预订名单改为lists（teacher_id -> 学生列表），新增与删除学生的效果与add()、delete()相同。
+    每位老师的队列、名额计数与名单合并为一个以版本号为条件的更新，全部老师一次bulk_write写入，家长记录再一次bulk_write；
+    期间队列被其他请求修改的老师重新加载后重试，返回最终未能写入的老师id"""
+    event = current_event()
+    pending = {str(teacher_id): students for teacher_id, students in lists.items()}
+    projection = {'_id': 0, 'id': 1, 'version': 1, 'reservedStudents': 1}
+    for _ in range(RESERVED_WRITE_ROUNDS):
+        current = {data['id']: data.get('reservedStudents', []) for data in event.teacher.find({'id': {'$in': [*pending]}}, projection)}
+        plans = []
+        for teacher_id, students in pending.items():
+            model = event.queues.get(teacher_id)
+            if model is None:
+                model = event.reload_queue(teacher_id)
+            old = current.get(teacher_id, [])
+            ops = []
+            parent_ops = []
+            for name in [name for name in old if name not in students]:
+                entry = model.entry(name)
+                if entry is None:
+                    continue
+                field = {'自主预约': 'appointment', '指定预约': 'must'}.get(entry.type_text)
+                if field:
+                    parent_ops.append(pymongo.UpdateOne({'name': name}, {'$pull': {field: {'teacher_id': int(teacher_id)}}}))
+                ops.append(model.remove(name))
+            for name in [name for name in students if name not in old]:
+                # 指定预约由老师安排，不受名额上限限制
+                parent_ops.append(pymongo.UpdateOne({'name': name}, {'$push': {'must': {'teacher_id': int(teacher_id)}}, '$setOnInsert': {'appointment': []}}, upsert=True))
+                ops.append(model.append(name, '指定预约'))
+            plans.append({'teacher_id': teacher_id, 'version': model.version, 'students': students, 'ops': ops, 'parent_ops': parent_ops})
+        writes = [pymongo.UpdateOne(
+            {'id': plan['teacher_id'], 'version': plan['version'] or {'$in': [0, None]}},
+            {'$set': {'queue': event.queues[plan['teacher_id']].to_documents(), 'active': event.queues[plan['teacher_id']].active_count, 'reservedStudents': plan['students']}, '$inc': {'version': 1}}
+        ) for plan in plans]
+        try:
+            event.teacher.bulk_write(writes, ordered=False)
+        except pymongo.errors.PyMongoError:
+            # 内存模型已修改但不确定是否写入，全部重新加载
+            for plan in plans:
+                event.queues.pop(plan['teacher_id'], None)
+            raise
+        # 名单已是目标名单即为写入成功；版本号恰好加一时内存模型可直接沿用，否则期间有其他修改，重新加载
+        written = {data['id']: data for data in event.teacher.find({'id': {'$in': [*pending]}}, projection)}
+        parent_ops = []
+        for plan in plans:
+            teacher_id = plan['teacher_id']
+            data = written.get(teacher_id, {})
+            if data.get('reservedStudents') != plan['students']:
+                event.reload_queue(teacher_id)
+                continue
+            del pending[teacher_id]
+            parent_ops.extend(plan['parent_ops'])
+            if data.get('version') == plan['version'] + 1:
+                model = event.queues[teacher_id]
+                model.version = plan['version'] + 1
+                event.queues_version += 1
+                event.update_setting(teacher_id, peoples=model.active_count)
+                if plan['ops']:
+                    emit_queue_delta(teacher_id, model.version, plan['ops'], 'reserve')
+            else:
+                # 名单写入后队列又被其他请求修改过，本次修改仍记在plan['version'] + 1，事件日志保持连续
+                if plan['ops']:
+                    log_queue_event(teacher_id, plan['version'] + 1, 'reserve', plan['ops'])
+                model = event.reload_queue(teacher_id)
+                emit_queue_update(teacher_id, model.to_documents(), version=model.version)
+                mark_queue_changed(teacher_id, [op['name'] for op in plan['ops'] if op['op'] == 'remove'])
+        if parent_ops:
+            # 同一位家长可能有多条更新（如同时被多位老师指定），按顺序执行
+            event.parent.bulk_write(parent_ops, ordered=True)
+        if not pending:
+            break
+    return [*pending]
+
+
+@app.route('/teacher/setting/import', methods=['POST'])
+def reserved_import():
+    """批量导入各位老师的提前预订名单（CSV或xlsx，列为老师编号、班级、学生姓名）。
+    文件中出现的老师的名单整体替换为文件中的名单，?mode=append时只新增；?dry_run=1时只返回校验结果与变化。
+    管理员可导入所有老师的名单，老师只能导入自己的名单"""
+    if not session.get('teacher_verified') or not (session.get('admin_verified') or 'id' in session):
+        return jsonify({'success': False, 'message': '未授权'}), 401
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        return jsonify({'success': False, 'message': '请选择要导入的文件'})
+    event = current_event()
+    try:
+        rows = read_rows(upload.filename, upload.read())
+    except ValueError as error:
+        return jsonify({'success': False, 'message': str(error)})
+    lists, errors = parse_reserved(rows, event.teachers, classes_data.get(event.grade, []))
+    if not session.get('admin_verified'):
+        others = sorted(teacher_id for teacher_id in lists if teacher_id != str(session['id']))
+        if others:
+            return jsonify({'success': False, 'message': f'只能导入自己的名单，文件中包含老师{"、".join(others)}的名单'}), 403
+    if errors:
+        return jsonify({'success': False, 'message': f'导入文件中有{len(errors)}处错误，未做任何修改', 'errors': errors[:50]})
+    current = {data['id']: data.get('reservedStudents', []) for data in event.teacher.find({'id': {'$in': [*lists]}}, {'_id': 0, 'id': 1, 'reservedStudents': 1})}
+    changes = diff_reserved(current, lists, append=request.args.get('mode') == 'append')
+    summary = [{'teacherId': teacher_id, 'added': change['added'], 'removed': change['removed']} for teacher_id, change in changes.items()]
+    if request.args.get('dry_run') == '1' or not changes:
+        return jsonify({'success': True, 'applied': False, 'changes': summary})
+    event.sync_shared_state()
+    failed = apply_reserved_lists({teacher_id: change['reserved'] for teacher_id, change in changes.items()})
+    if failed:
+        return jsonify({'success': False, 'message': f'老师{"、".join(failed)}的队列正在被修改，名单未能导入，请稍后重试', 'changes': summary})
+    return jsonify({'success': True, 'applied': True, 'changes': summary})
 
-def save_queue(teacher_id, queue):
-    db.teacher.update_one({'id': str(teacher_id)}, {'$set': {'queue': queue}})
-    emit_queue_update(teacher_id, queue)
 
 @app.route('/teacher/setting/save', methods=['POST'])
 def setting_save():
     if not session.get('teacher_verified'):
         return redirect('/login')
-    data = db.teacher.find_one({'id': session['id']})
+    event = current_event()
+    event.sync_shared_state()
+    data = event.teacher.find_one({'id': session['id']})
     if data == None:
         for i in request.json.get('reservedStudents'):
             add(i, int(session['id']))
-        db.teacher.insert_one({'id': session['id'], 'maxParents': request.json.get('maxParents'), 'reservedStudents': request.json.get('reservedStudents'), 'queue': []})
+        event.teacher.insert_one({'id': session['id'], 'maxParents': request.json.get('maxParents'), 'reservedStudents': request.json.get('reservedStudents'), 'queue': [], 'active': 0, 'version': 0})
     else:
-        for i in request.json.get('reservedStudents'):
-            if i not in data['reservedStudents']:
-                add(i, int(session['id']))
-        for i in data['reservedStudents']:
-            if i not in request.json.get('reservedStudents'):
-                delete(i, int(session['id']))
-        db.teacher.update_one({'id': session['id']},{'$set': {'maxParents': request.json.get('maxParents'),'reservedStudents': request.json.get('reservedStudents')}})
-    setting_memory[session['id']]['maxParents'] = request.json.get('maxParents')
+        if request.json.get('reservedStudents') != data['reservedStudents'] and apply_reserved_lists({session['id']: request.json.get('reservedStudents')}):
+            return jsonify({'success': False, 'message': '队列正在被修改，请稍后重试'})
+        event.teacher.update_one({'id': session['id']},{'$set': {'maxParents': request.json.get('maxParents')}})
+    event.update_setting(session['id'], maxParents=request.json.get('maxParents'))
     return jsonify({'success': True})
 
 
-@socketio.on('join_teacher_room')
+@socket_event('join_teacher_room')
 def handle_join_teacher_room(data):
     teacher_id = str(data.get('teacherId', '')).strip()
     if not teacher_id:
         return
     room_name = f'teacher_{teacher_id}'
     join_room(room_name)
+    version = data.get('version')
+    if isinstance(version, int) and send_queue_catchup(teacher_id, version, request.sid):
+        return
     emit_queue_update(teacher_id, room=request.sid)
 
 
-def complete_current_and_promote(queue):
-    updated = False
-    for item in queue:
-        if item.get('status') == 'current':
-            item['status'] = 'completed'
-            updated = True
-            break
-    if updated:
-        ensure_current_parent(queue)
-    return queue, updated
+@socket_event('join_parent')
+def handle_join_parent(data=None):
+    if not session.get('parent_verified') or 'id' not in session:
+        return
+    event = current_event()
+    event.sync_shared_state()
+    join_room(f'parent_{session["id"]}')
+    payload = parent_position_payload(session['id'])
+    event.parent_push_cache[session['id']] = payload
+    emit('position_update', payload)
 
 
-@socketio.on('complete_parent')
-def handle_complete_parent(data):
+@socket_event('join_overview')
+def handle_join_overview(data=None):
+    if not session.get('teacher_verified'):
+        return
+    current_event().sync_shared_state()
+    join_room(OVERVIEW_ROOM)
+    emit('overview_update', overview_payload())
+
+
+@socket_event('queue_sync')
+def handle_queue_sync(data):
     teacher_id = str(data.get('teacherId', '')).strip()
     if not teacher_id:
         return
-    teacher_data = db.teacher.find_one({'id': teacher_id})
-    if not teacher_data:
+    version = data.get('version')
+    if isinstance(version, int) and send_queue_catchup(teacher_id, version, request.sid):
         return
-    queue = teacher_data.get('queue', [])
-    queue, updated = complete_current_and_promote(queue)
+    emit_queue_update(teacher_id, room=request.sid)
+
+
+def complete_current_and_promote(model, busy=(), remaining=None):
+    """完成当前家长并选出下一位，返回增量操作，没有进行中的家长时返回空列表"""
+    entry = model.current_entry()
+    if entry is None:
+        return []
+    return [model.set_status(entry.name, Status.COMPLETED)] + ensure_current_parent(model, busy, remaining)
+
+
+@socket_event('complete_parent')
+def handle_complete_parent(data):
+    teacher_id = str(data.get('teacherId', '')).strip()
+    if not teacher_id:
+        return
+    event = current_event()
+    busy = event.parents_in_session(teacher_id)
+    remaining = event.parents_remaining(teacher_id)
+
+    def mutation(model):
+        return complete_current_and_promote(model, busy, remaining) or None
+
+    model, updated = mutate_queue(teacher_id, mutation, 'complete')
     if updated:
-        save_queue(teacher_id, queue)
+        event.eta_engine.record_completion(teacher_id)
     else:
-        emit_queue_update(teacher_id, queue)
+        emit_queue_update(teacher_id, model.to_documents(), version=model.version)
 
 
-@socketio.on('skip_parent')
+@socket_event('skip_parent')
 def handle_skip_parent(data):
     teacher_id = str(data.get('teacherId', '')).strip()
-    parent_id = data.get('parentId')
     parent_name = data.get('parentName')
     if not teacher_id:
         return
-    teacher_data = db.teacher.find_one({'id': teacher_id})
-    if not teacher_data:
-        return
-    queue = teacher_data.get('queue', [])
-    current_index = None
-    for idx, item in enumerate(queue):
-        if item.get('status') == 'current' and (match_queue_item(item, parent_id, parent_name) or current_index is None):
-            current_index = idx
-            if match_queue_item(item, parent_id, parent_name):
-                break
-    if current_index is None:
-        return
-    current_item = queue.pop(current_index)
-    current_item['status'] = 'waiting'
-    queue.append(current_item)
-    ensure_current_parent(queue)
-    save_queue(teacher_id, queue)
+    event = current_event()
+    busy = event.parents_in_session(teacher_id)
+    remaining = event.parents_remaining(teacher_id)
+
+    def mutation(model):
+        entry = model.entry(parent_name) if parent_name else None
+        if entry is None or entry.status != Status.CURRENT:
+            entry = model.current_entry()
+        if entry is None:
+            return None
+        return [model.move_to_tail(entry.name, Status.WAITING)] + ensure_current_parent(model, busy, remaining)
+
+    mutate_queue(teacher_id, mutation, 'skip')
 
 
-@socketio.on('promote_first_waiting')
+@socket_event('promote_first_waiting')
 def handle_promote_first_waiting(data):
     teacher_id = str(data.get('teacherId', '')).strip()
-    parent_id = data.get('parentId')
     parent_name = data.get('parentName')
     if not teacher_id:
         return
-    teacher_data = db.teacher.find_one({'id': teacher_id})
-    if not teacher_data:
-        socketio.emit('promote_rejected', {'teacherId': teacher_id}, room=f'teacher_{teacher_id}')
-        return
+    event = current_event()
+    busy = event.parents_in_session(teacher_id)
+    remaining = event.parents_remaining(teacher_id)
+    # 目标家长已在谈话、队列无需修改时不写数据库，也不算拒绝
+    unchanged = []
+
+    def mutation(model):
+        if not parent_name or parent_name not in model:
+            return None
+        ops = []
+        target = parent_name
+        redirected = None
+        if target in busy:
+            # 该家长正在其他老师处谈话，改为排在其后、此刻空闲的家长；页面上已提前标为进行中的家长需改回等待
+            candidate = next_parent(model, busy, remaining)
+            if candidate is not None and candidate not in busy:
+                redirected = {'op': 'status', 'name': target, 'status': 'waiting'}
+                target = candidate
+        for name in [*model.current]:
+            if name != target:
+                ops.append(model.set_status(name, Status.WAITING))
+        op = model.set_status(target, Status.CURRENT)
+        if op is not None:
+            ops.append(op)
+        if not ops:
+            unchanged.append(True)
+            return None
+        if redirected is not None:
+            ops.insert(0, redirected)
+        return ops
+
+    model, updated = mutate_queue(teacher_id, mutation, 'promote')
+    if not updated and not unchanged:
+        socketio.emit('promote_rejected', {'teacherId': teacher_id}, room=f'teacher_{teacher_id}', namespace=event.namespace)
+
+
+# ==================== 名单导出 ====================
+
+
+def export_teacher_list(event, teacher_id, teacher_data, fmt):
+    """生成老师的预约名单文件，队列版本与名单中的预计时间文本都不变时直接返回缓存；
+    预计时间重新计算但该老师各家长的时间（精确到分钟）没有变化时仍使用缓存。
+    打包下载时在响应流中生成，没有请求上下文，因此由调用方传入场次"""
+    times = event.current_etas().teacher_times(teacher_id)
     queue = teacher_data.get('queue', [])
-    target_index = None
-    for idx, item in enumerate(queue):
-        if match_queue_item(item, parent_id, parent_name):
-            target_index = idx
-            break
-    if target_index is None:
-        socketio.emit('promote_rejected', {'teacherId': teacher_id}, room=f'teacher_{teacher_id}')
-        return
-    for item in queue:
-        if item.get('status') == 'current':
-            item['status'] = 'waiting'
-    queue[target_index]['status'] = 'current'
-    save_queue(teacher_id, queue)
+    labels = tuple(times.get(item.get('name')) for item in queue)
+    key = (str(teacher_id), teacher_data.get('version', 0), fmt)
+    write = EXPORT_FORMATS[fmt][0]
+    return event.export_cache.get_or_build(key, lambda: run_blocking(write, queue_rows(queue, lambda item: times.get(item.get('name')))), stamp=labels)
+
+
 @app.route('/teacher/list/download')
 def list_download():
     if not session.get('teacher_verified'):
@@ -514,53 +1461,56 @@ def list_download():
     
     teacher_name = session.get('name', '未知老师')
     teacher_id = session.get('id')
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'xlsx'
     
-    teacher_data = db.teacher.find_one({'id': teacher_id})
+    event = current_event()
+    teacher_data = event.teacher.find_one({'id': teacher_id}, {'_id': 0, 'queue': 1, 'version': 1})
     if teacher_data == None:
-        queue = []
-    else:
-        queue = teacher_data['queue']
-    
-    status_text_map = {
-        'waiting': '等待中',
-        'current': '进行中',
-        'completed': '已完成',
-        'skipped': '已跳过'
-    }
+        teacher_data = {'queue': [], 'version': 0}
     
-    data_list = []
-    for index, item in enumerate(queue, 1):
-        full_name = item.get('name', '')
-        status = item.get('status', 'waiting')
-        appointment_time = item.get('appointmentTime', item.get('appointment_time'))
-        if not appointment_time:
-            appointment_datetime = datetime.strptime(CONVERSION_START_TIME, "%Y-%m-%dT%H:%M:%S") + timedelta(minutes=(index-1) * 10)
-            appointment_time = appointment_datetime.strftime('%H:%M')
-        status_text = status_text_map.get(status, '未知')
-
-        data_list.append({
-            '序号': index,
-            '学生姓名': full_name,
-            '预计时间': appointment_time,
-            '状态': status_text
-        })
-    
-    df = pd.DataFrame(data_list)
-    
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='预约列表')
-    
-    output.seek(0)
-    filename = f"{teacher_name}的预约列表.xlsx"
+    output = BytesIO(export_teacher_list(event, teacher_id, teacher_data, fmt))
+    filename = f"{teacher_name}的预约列表.{fmt}"
     
     return send_file(
         output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        mimetype=EXPORT_FORMATS[fmt][1],
         as_attachment=True,
         download_name=filename
     )
 
+
+@app.route('/teacher/list/download_all')
+def list_download_all():
+    """一次性导出所有老师的名单，打包为zip边生成边下载；仅管理员可用"""
+    if not session.get('teacher_verified'):
+        return redirect('/login')
+    if not session.get('admin_verified'):
+        return jsonify({'success': False, 'message': '仅管理员可下载全部老师的名单'}), 403
+    
+    fmt = request.args.get('format', 'xlsx')
+    if fmt not in EXPORT_FORMATS:
+        fmt = 'xlsx'
+    event = current_event()
+    queues = {data['id']: data for data in event.teacher.find({}, {'_id': 0, 'id': 1, 'queue': 1, 'version': 1})}
+    
+    def files():
+        for teacher in event.teachers:
+            teacher_data = queues.get(str(teacher['id']), {'queue': [], 'version': 0})
+            yield f"{teacher['id']:02d}-{teacher['subject']}{teacher['name']}的预约列表.{fmt}", export_teacher_list(event, teacher['id'], teacher_data, fmt)
+    
+    response = Response(stream_zip(files()), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote('全部老师预约列表.zip')}"
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN and request.args.get('token') != METRICS_TOKEN:
+        return Response(status=403)
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 # ==================== 错误处理 ====================
 @app.errorhandler(404)
 def handle_404(error):
@@ -576,20 +1526,18 @@ def handle_500(error):
     error_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
     error_msg = f"[{error_time}] IP: {client_ip} - Route: {route_info} - Error: {str(error)}\n\n"
 
-    with open('log/error.log', 'a', encoding='utf-8') as f:
-        f.write(error_msg)
+    log_writer.write('error.log', error_msg, key=f"IP: {client_ip} - Route: {route_info} - Error: {str(error)}")
     return redirect('/login')
 
 
-@socketio.on_error()
+@socketio.on_error_default
 def handle_500(error):
     """错误处理-ws错误"""
     client_ip = get_real_ip()
     error_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
     error_msg = f"[{error_time}] IP: {client_ip} - Route: WebSocketEvent - Error: {str(error)}\n\n"
 
-    with open('log/error.log', 'a', encoding='utf-8') as f:
-        f.write(error_msg)
+    log_writer.write('error.log', error_msg, key=f"IP: {client_ip} - Route: WebSocketEvent - Error: {str(error)}")
 
 
 # 添加速率限制错误处理
@@ -601,8 +1549,7 @@ def ratelimit_handler(e):
     limit_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
     limit_msg = f"[{limit_time}] IP: {client_ip} - Route: {route_info} - Rate limit exceeded: {e.description}\n\n"
 
-    with open('log/limit.log', 'a', encoding='utf-8') as f:
-        f.write(limit_msg)
+    log_writer.write('limit.log', limit_msg, key=f"IP: {client_ip} - Route: {route_info}")
 
     return {'success': False, 'message': '请求过于频繁'}
 
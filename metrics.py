@@ -0,0 +1,123 @@
+# coding=UTF-8
+"""轻量级运行指标：直方图、计数器与仪表，以Prometheus文本格式输出。
+只做字典查找与整数累加，开销足够低，可在开放时段常开。"""
+import bisect
+from pymongo import monitoring
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series = {}
+
+    def inc(self, *label_values, amount=1):
+        self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.series.items():
+            yield self.name + format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        self.series[label_values] = value
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for label_values, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield self.name + '_bucket' + format_labels(self.labels + ('le',), label_values + (bound,)), cumulative
+            yield self.name + '_sum' + format_labels(self.labels, label_values), total
+            yield self.name + '_count' + format_labels(self.labels, label_values), cumulative
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collect(self, func):
+        """注册在每次抓取时调用的函数，用于把内存中的状态同步到仪表"""
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        for func in self.collectors:
+            func()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, value in metric.samples():
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """把每条数据库命令的耗时交给record(秒)统计"""
+
+    def __init__(self, record):
+        self.record = record
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event.duration_micros / 1000000)
+
+    def failed(self, event):
+        self.record(event.duration_micros / 1000000)
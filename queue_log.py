@@ -0,0 +1,147 @@
+# coding=UTF-8
+"""队列事件日志：每次队列变化以(老师, 版本号)为键追加一条事件，事件内容与推送给老师页面的增量操作相同；
+每位老师每累积snapshot_every条事件保存一次完整快照。
+任一时刻的队列 = 该时刻之前最近的快照 + 其后的事件重放，查询无需扫描全部历史。"""
+from datetime import datetime
+import pymongo
+from pymongo.errors import BulkWriteError, PyMongoError
+
+
+def apply_ops(queue, ops):
+    """在队列上重放增量操作，与老师页面ontime.js中的applyOps保持一致"""
+    for op in ops:
+        if op['op'] == 'insert':
+            queue.append(dict(op['item']))
+        elif op['op'] == 'remove':
+            queue[:] = [item for item in queue if item.get('name') != op['name']]
+        elif op['op'] == 'status':
+            for item in queue:
+                if item.get('name') == op['name']:
+                    item['status'] = op['status']
+        elif op['op'] == 'move_tail':
+            target = next((item for item in queue if item.get('name') == op['name']), None)
+            if target is not None:
+                queue[:] = [item for item in queue if item.get('name') != op['name']]
+                queue.append({**target, 'status': op['status']})
+    return queue
+
+
+class QueueLog:
+    def __init__(self, db, snapshot_every=50, prefix=''):
+        """prefix为场次的集合前缀，见events.py"""
+        self.events = db[prefix + 'queue_event']
+        self.snapshots = db[prefix + 'queue_snapshot']
+        self.teachers = db[prefix + 'teacher']
+        self.snapshot_every = snapshot_every
+        self.pending = []
+        # teacher_id -> 上次快照之后本worker记录的事件数
+        self.since_snapshot = {}
+
+    def ensure_indexes(self):
+        # 同一老师的同一版本号只能有一条事件，重复写入会被忽略
+        self.events.create_index([('teacher_id', 1), ('version', 1)], unique=True)
+        self.events.create_index([('teacher_id', 1), ('time', 1)])
+        self.events.create_index('names')
+        self.snapshots.create_index([('teacher_id', 1), ('version', -1)])
+        self.snapshots.create_index([('teacher_id', 1), ('time', -1)])
+
+    def ensure_baseline(self, teachers):
+        """为还没有快照的老师以当前队列保存首个快照，此前的历史不在日志中，重放从这里开始"""
+        known = set(self.snapshots.distinct('teacher_id'))
+        baseline = [{'teacher_id': str(data['id']), 'version': data.get('version', 0), 'time': datetime.utcnow(), 'queue': data.get('queue', [])}
+                    for data in teachers if str(data['id']) not in known]
+        if baseline:
+            self.snapshots.insert_many(baseline, ordered=False)
+        return len(baseline)
+
+    def record(self, teacher_id, version, action, ops):
+        """记录一次队列变化，version为变化后的队列版本号；事件先暂存在内存，由flush批量写入"""
+        names = sorted({op['item']['name'] if op['op'] == 'insert' else op['name'] for op in ops})
+        self.pending.append({
+            'teacher_id': str(teacher_id),
+            'version': version,
+            'time': datetime.utcnow(),
+            'action': action,
+            'names': names,
+            'ops': ops
+        })
+
+    def flush(self):
+        """批量写入暂存的事件，并为事件数达到阈值的老师保存快照"""
+        events, self.pending = self.pending, []
+        if not events:
+            return
+        try:
+            self.events.insert_many(events, ordered=False)
+        except BulkWriteError as error:
+            # 只容忍版本号重复（同一事件被重试写入），其他错误继续抛出
+            if any(item.get('code') != 11000 for item in error.details.get('writeErrors', [])):
+                raise
+        except PyMongoError:
+            # 数据库暂时不可用时事件放回队列，下次一并写入
+            self.pending[:0] = events
+            raise
+        due = []
+        for event in events:
+            count = self.since_snapshot.get(event['teacher_id'], 0) + 1
+            self.since_snapshot[event['teacher_id']] = count
+            if count >= self.snapshot_every and event['teacher_id'] not in due:
+                due.append(event['teacher_id'])
+        for teacher_id in due:
+            self.snapshot(teacher_id)
+
+    def snapshot(self, teacher_id):
+        """以数据库中当前的队列和版本号保存快照"""
+        data = self.teachers.find_one({'id': str(teacher_id)}, {'_id': 0, 'queue': 1, 'version': 1})
+        if data is None:
+            return
+        self.snapshots.insert_one({
+            'teacher_id': str(teacher_id),
+            'version': data.get('version', 0),
+            'time': datetime.utcnow(),
+            'queue': data.get('queue', [])
+        })
+        self.since_snapshot[str(teacher_id)] = 0
+
+    def state_at(self, teacher_id, at=None, version=None):
+        """返回老师在某一时刻（UTC datetime）或某一版本号时的(队列, 版本号)，都不指定时为日志中的最新状态"""
+        teacher_id = str(teacher_id)
+        query = {'teacher_id': teacher_id}
+        if version is not None:
+            query['version'] = {'$lte': version}
+            sort = [('version', pymongo.DESCENDING)]
+        elif at is not None:
+            query['time'] = {'$lte': at}
+            sort = [('time', pymongo.DESCENDING)]
+        else:
+            sort = [('version', pymongo.DESCENDING)]
+        snapshot = self.snapshots.find_one(query, sort=sort)
+        queue = [dict(item) for item in snapshot['queue']] if snapshot else []
+        current = snapshot['version'] if snapshot else 0
+        tail = {'teacher_id': teacher_id, 'version': {'$gt': current}}
+        if version is not None:
+            tail['version']['$lte'] = version
+        if at is not None:
+            tail['time'] = {'$lte': at}
+        for event in self.events.find(tail, {'_id': 0, 'version': 1, 'ops': 1}).sort('version', pymongo.ASCENDING):
+            apply_ops(queue, event['ops'])
+            current = event['version']
+        return queue, current
+
+    def tail(self, teacher_id, since_version):
+        """返回某版本号之后的全部事件，版本号不连续（中间有批量写入或尚未落盘的事件）时返回None"""
+        events = [*self.events.find({'teacher_id': str(teacher_id), 'version': {'$gt': since_version}},
+                                    {'_id': 0, 'version': 1, 'ops': 1}).sort('version', pymongo.ASCENDING)]
+        expected = since_version + 1
+        for event in events:
+            if event['version'] != expected:
+                return None
+            expected += 1
+        return events
+
+    def history(self, name, teacher_id=None):
+        """某位家长经历过的全部队列事件，按时间排序，可只查某位老师的队列"""
+        query = {'names': name}
+        if teacher_id is not None:
+            query['teacher_id'] = str(teacher_id)
+        return [*self.events.find(query, {'_id': 0}).sort('time', pymongo.ASCENDING)]
@@ -0,0 +1,229 @@
+# coding=UTF-8
+"""老师队列的内存模型：条目使用__slots__并以整数编码状态与预约类型，按家长姓名建立索引，
+用树状数组(Fenwick)按序号维护排位，删除、移到队尾、查询位置与前方人数都是O(log n)。
+写回数据库时仍转换为原有的 [{'name', 'status', 'type'}] 文档结构。"""
+from enum import IntEnum
+
+
+class Status(IntEnum):
+    WAITING = 0
+    CURRENT = 1
+    COMPLETED = 2
+    SKIPPED = 3
+
+    @property
+    def text(self):
+        return STATUS_NAMES[self]
+
+    @classmethod
+    def parse(cls, text):
+        return STATUS_CODES.get(text, cls.WAITING)
+
+
+STATUS_NAMES = {Status.WAITING: 'waiting', Status.CURRENT: 'current', Status.COMPLETED: 'completed', Status.SKIPPED: 'skipped'}
+STATUS_CODES = {text: status for status, text in STATUS_NAMES.items()}
+
+# 预约类型编码，遇到新的类型文本时追加，所有老师共用同一张表
+TYPE_NAMES = ['自主预约', '指定预约']
+TYPE_CODES = {text: code for code, text in enumerate(TYPE_NAMES)}
+
+
+def type_code(text):
+    code = TYPE_CODES.get(text)
+    if code is None:
+        code = TYPE_CODES[text] = len(TYPE_NAMES)
+        TYPE_NAMES.append(text)
+    return code
+
+
+class Entry:
+    __slots__ = ('name', 'status', 'type', 'seq')
+
+    def __init__(self, name, status, type, seq):
+        self.name = name
+        self.status = status
+        self.type = type
+        self.seq = seq
+
+    @property
+    def type_text(self):
+        return TYPE_NAMES[self.type]
+
+    def to_document(self):
+        return {'name': self.name, 'status': STATUS_NAMES[self.status], 'type': TYPE_NAMES[self.type]}
+
+
+class Fenwick:
+    """树状数组：单点增减与前缀和均为O(log n)"""
+
+    def __init__(self, size):
+        self.tree = [0] * (size + 1)
+
+    def add(self, index, delta):
+        index += 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        """下标[0, index)的和"""
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+
+class TeacherQueue:
+    """一位老师的队列。条目按递增的序号排列，移到队尾即换一个新序号；
+    present统计各序号上是否有条目，active统计未完成的条目，二者的前缀和分别是位置与前方人数"""
+
+    def __init__(self, version=0, capacity=16):
+        self.version = version
+        self.capacity = capacity
+        self.slots = []
+        self.present = Fenwick(capacity)
+        self.active = Fenwick(capacity)
+        self.by_name = {}
+        self.current = set()
+        self.size = 0
+        self.active_count = 0
+
+    @classmethod
+    def from_documents(cls, queue, version=0):
+        model = cls(version or 0, max(16, len(queue) * 2))
+        for item in queue:
+            model.append(item.get('name'), item.get('type'), Status.parse(item.get('status', 'waiting')))
+        return model
+
+    def to_documents(self):
+        return [entry.to_document() for entry in self]
+
+    def __iter__(self):
+        return (entry for entry in self.slots if entry is not None)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def names(self):
+        return self.by_name.keys()
+
+    def entry(self, name):
+        """姓名对应的第一个条目（同名只会出现在指定预约重复添加时）"""
+        entries = self.by_name.get(name)
+        return entries[0] if entries else None
+
+    def position(self, name):
+        entry = self.entry(name)
+        return None if entry is None else self.present.prefix(entry.seq)
+
+    def ahead(self, name):
+        """排在该家长之前且尚未完成的人数"""
+        entry = self.entry(name)
+        return 0 if entry is None else self.active.prefix(entry.seq)
+
+    def current_entry(self):
+        """排在最前的进行中条目"""
+        entries = [self.entry(name) for name in self.current]
+        return min(entries, key=lambda entry: entry.seq) if entries else None
+
+    # ---------- 修改，均返回与推送给老师页面相同格式的增量操作 ----------
+    def append(self, name, type, status=Status.WAITING):
+        if len(self.slots) >= self.capacity:
+            self.compact()
+        entry = Entry(name, status, type_code(type), len(self.slots))
+        self.slots.append(entry)
+        self.by_name.setdefault(name, []).append(entry)
+        self.present.add(entry.seq, 1)
+        self.size += 1
+        self.track(entry, 1)
+        return {'op': 'insert', 'item': entry.to_document()}
+
+    def remove(self, name):
+        """删除该姓名的全部条目，与数据库中的$pull一致"""
+        entries = self.by_name.pop(name, None)
+        if not entries:
+            return None
+        for entry in entries:
+            self.slots[entry.seq] = None
+            self.present.add(entry.seq, -1)
+            self.size -= 1
+            self.track(entry, -1)
+        self.current.discard(name)
+        return {'op': 'remove', 'name': name}
+
+    def set_status(self, name, status):
+        entries = self.by_name.get(name)
+        if not entries or all(entry.status == status for entry in entries):
+            return None
+        for entry in entries:
+            self.track(entry, -1)
+            entry.status = status
+            self.track(entry, 1)
+        return {'op': 'status', 'name': name, 'status': STATUS_NAMES[status]}
+
+    def move_to_tail(self, name, status=Status.WAITING):
+        """把该姓名移到队尾；同名的多个条目合并为第一个条目，与事件日志重放及老师页面的applyOps一致"""
+        entries = self.by_name.get(name)
+        if not entries:
+            return None
+        if len(self.slots) >= self.capacity:
+            self.compact()
+        entry = entries[0]
+        for other in entries[1:]:
+            self.slots[other.seq] = None
+            self.present.add(other.seq, -1)
+            self.size -= 1
+            self.track(other, -1)
+        del entries[1:]
+        self.current.discard(name)
+        self.slots[entry.seq] = None
+        self.present.add(entry.seq, -1)
+        self.track(entry, -1)
+        entry.seq = len(self.slots)
+        entry.status = status
+        self.slots.append(entry)
+        self.present.add(entry.seq, 1)
+        self.track(entry, 1)
+        return {'op': 'move_tail', 'name': name, 'status': STATUS_NAMES[status]}
+
+    def apply(self, ops):
+        """重放增量操作（来自其他请求或事件日志）"""
+        for op in ops:
+            if op['op'] == 'insert':
+                self.append(op['item']['name'], op['item'].get('type'), Status.parse(op['item'].get('status', 'waiting')))
+            elif op['op'] == 'remove':
+                self.remove(op['name'])
+            elif op['op'] == 'status':
+                self.set_status(op['name'], Status.parse(op['status']))
+            elif op['op'] == 'move_tail':
+                self.move_to_tail(op['name'], Status.parse(op['status']))
+
+    # ---------- 内部维护 ----------
+    def track(self, entry, sign):
+        """条目加入(sign=1)或离开(sign=-1)时更新未完成计数与进行中集合"""
+        if entry.status != Status.COMPLETED:
+            self.active.add(entry.seq, sign)
+            self.active_count += sign
+        if entry.status == Status.CURRENT:
+            if sign > 0:
+                self.current.add(entry.name)
+            elif all(other is entry or other.status != Status.CURRENT for other in self.by_name.get(entry.name, ())):
+                self.current.discard(entry.name)
+
+    def compact(self):
+        """序号用尽时按当前顺序重新编号，容量翻倍，均摊后仍为O(log n)"""
+        entries = [*self]
+        self.capacity = max(16, len(entries) * 2)
+        self.slots = []
+        self.present = Fenwick(self.capacity)
+        self.active = Fenwick(self.capacity)
+        for seq, entry in enumerate(entries):
+            entry.seq = seq
+            self.slots.append(entry)
+            self.present.add(seq, 1)
+            if entry.status != Status.COMPLETED:
+                self.active.add(seq, 1)
@@ -0,0 +1,208 @@
+# coding=UTF-8
+"""两级速率限制存储：每个worker在内存中维护滑动窗口，请求只做本地判断；
+后台线程定期把本地命中批量写入MongoDB，并取回其他worker对同一key的命中。
+被限流的请求直接在本地拒绝，不会产生任何数据库访问。"""
+import os
+import secrets
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+import pymongo
+from pymongo.errors import PyMongoError
+from limits.storage import Storage, MovingWindowSupport
+
+
+class TieredStorage(Storage, MovingWindowSupport):
+    """flask-limiter存储后端，storage_uri写作 tiered+mongodb://...，需配合strategy='moving-window'使用"""
+
+    STORAGE_SCHEME = ['tiered+mongodb', 'tiered+mongodb+srv']
+
+    def __init__(self, uri=None, wrap_exceptions=False, database='limits', collection='ratelimit', sync_interval=2.0, on_error=None, **options):
+        """on_error(error)在同步遇到数据库以外的异常时调用，用于记录日志"""
+        super().__init__(uri, wrap_exceptions=wrap_exceptions)
+        self.uri = uri[len('tiered+'):]
+        self.database = database
+        self.collection_name = collection
+        self.sync_interval = float(sync_interval)
+        self.on_error = on_error
+        self.options = options
+        self.worker = f'{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}'
+        # key -> 本worker的命中时间（升序）
+        self.events = {}
+        # key -> 上次同步时其他worker在窗口内的命中时间（升序）
+        self.remote = {}
+        self.expiry = {}
+        self.dirty = set()
+        self.cleared = set()
+        self.clear_all = False
+        # 固定窗口计数，仅供strategy='fixed-window'时使用，不参与同步
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.collection = None
+
+    @property
+    def base_exceptions(self):
+        return PyMongoError
+
+    # ---------- 滑动窗口（快速路径，只访问内存） ----------
+    def acquire_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        with self.lock:
+            local = self.window(self.events, key, now - expiry)
+            remote = self.window(self.remote, key, now - expiry)
+            if len(local) + len(remote) + amount > limit:
+                return False
+            local.extend([now] * amount)
+            self.expiry[key] = expiry
+            self.dirty.add(key)
+        self.start()
+        return True
+
+    def get_moving_window(self, key, limit, expiry):
+        now = time.time()
+        with self.lock:
+            local = self.window(self.events, key, now - expiry)
+            remote = self.window(self.remote, key, now - expiry)
+            count = len(local) + len(remote)
+            if not count:
+                return now, 0
+            return min(hits[0] for hits in (local, remote) if hits), count
+
+    @staticmethod
+    def window(table, key, start):
+        hits = table.get(key)
+        if hits is None:
+            hits = table[key] = deque()
+        while hits and hits[0] < start:
+            hits.popleft()
+        return hits
+
+    def clear(self, key):
+        """只清除这一个key（例如某个IP在某条路由上的计数），各worker在下次同步后生效"""
+        with self.lock:
+            self.events.pop(key, None)
+            self.remote.pop(key, None)
+            self.counters.pop(key, None)
+            self.dirty.discard(key)
+            self.cleared.add(key)
+        self.start()
+
+    def reset(self):
+        with self.lock:
+            count = len(self.events) + len(self.counters)
+            self.events.clear()
+            self.remote.clear()
+            self.counters.clear()
+            self.dirty.clear()
+            self.cleared.clear()
+            self.clear_all = True
+        self.start()
+        return count
+
+    # ---------- 固定窗口 ----------
+    def incr(self, key, expiry, amount=1):
+        now = time.time()
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None or counter[1] <= now:
+                counter = self.counters[key] = [0, now + expiry]
+            counter[0] += amount
+            return counter[0]
+
+    def get(self, key):
+        counter = self.counters.get(key)
+        if counter is None or counter[1] <= time.time():
+            return 0
+        return counter[0]
+
+    def get_expiry(self, key):
+        counter = self.counters.get(key)
+        if counter is not None:
+            return counter[1]
+        hits = self.events.get(key)
+        if hits:
+            return hits[0] + self.expiry.get(key, 0)
+        return time.time()
+
+    def check(self):
+        return True
+
+    # ---------- 后台同步 ----------
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='ratelimit-sync', daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except PyMongoError:
+                # 数据库暂时不可用时继续按本地计数限流，待写入的key保留到下一轮
+                pass
+            except Exception as error:
+                # 其他异常（异常数据、驱动错误等）同样不能结束同步线程，否则限流悄然退化为各worker单独计数
+                if self.on_error is not None:
+                    self.on_error(error)
+
+    def connect(self):
+        if self.collection is None:
+            client = pymongo.MongoClient(self.uri, **self.options)
+            collection = client[self.database][self.collection_name]
+            collection.create_index('key')
+            collection.create_index('expireAt', expireAfterSeconds=0)
+            self.collection = collection
+        return self.collection
+
+    def sync(self):
+        """一轮同步：删除被清除的key，写入本worker的命中，再取回其他worker的命中"""
+        collection = self.connect()
+        now = time.time()
+        with self.lock:
+            clear_all, self.clear_all = self.clear_all, False
+            cleared, self.cleared = self.cleared, set()
+            dirty, self.dirty = self.dirty, set()
+            writes = []
+            for key in dirty:
+                expiry = self.expiry[key]
+                hits = [*self.window(self.events, key, now - expiry)]
+                if hits:
+                    writes.append(pymongo.UpdateOne(
+                        {'_id': f'{self.worker}|{key}'},
+                        {'$set': {'key': key, 'worker': self.worker, 'hits': hits,
+                                  'expireAt': datetime.utcfromtimestamp(hits[-1]) + timedelta(seconds=expiry)}},
+                        upsert=True
+                    ))
+            # 窗口已空的key不再保留，内存只随活跃IP数增长
+            for key in [*self.events]:
+                if not self.window(self.events, key, now - self.expiry.get(key, 0)):
+                    del self.events[key]
+                    self.expiry.pop(key, None)
+            keys = [*self.events] + [key for key, hits in self.remote.items() if hits]
+        try:
+            if clear_all:
+                collection.delete_many({})
+            if cleared:
+                collection.delete_many({'key': {'$in': [*cleared]}})
+            if writes:
+                collection.bulk_write(writes, ordered=False)
+        except Exception:
+            with self.lock:
+                self.clear_all = self.clear_all or clear_all
+                self.cleared |= cleared
+                self.dirty |= dirty
+            raise
+        remote = {}
+        if keys:
+            for doc in collection.find({'key': {'$in': [*set(keys)]}, 'worker': {'$ne': self.worker}}, {'key': 1, 'hits': 1}):
+                remote.setdefault(doc['key'], []).extend(doc.get('hits', []))
+        with self.lock:
+            self.remote = {key: deque(sorted(hits)) for key, hits in remote.items() if key not in self.cleared}
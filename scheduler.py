@@ -0,0 +1,148 @@
+# coding=UTF-8
+"""跨老师排程：家长最多可同时预约3位老师，各队列互不知情时同一位家长常在两位老师处同时轮到，
+其中一位老师只能空等。选择下一位谈话的家长时，优先跳过正在其他老师处谈话的家长，
+被跳过的家长保留原位，空闲后仍排在最前。
+提供各家长在其他老师处剩余的预约数时，在队首若干位空闲家长中优先选择剩余预约最少的家长，
+让只约了少数老师的家长尽早谈完离开；所有等待家长都在别处谈话时，选择预计最早结束的家长。
+
+本文件也可单独运行，用模拟数据比较按队列顺序(FIFO)、跳过冲突与按评分选择几种策略的吞吐量：
+    python scheduler.py --parents 300 --service-minutes 10
+"""
+import argparse
+import heapq
+import json
+import os
+import random
+from queue_model import Status, TeacherQueue
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# 按剩余预约数挑选时只比较队首的几位空闲家长，排在后面的家长最多被越过有限次，不会一直等待
+WINDOW = 3
+
+
+def next_parent(queue, busy=(), remaining=None, window=WINDOW):
+    """返回下一位应开始谈话的家长姓名，没有等待的家长时返回None。
+    busy为正在其他老师处谈话的家长，可以是集合，也可以是 {家长: 预计结束的时间戳}；
+    remaining为 {家长: 在其他老师处还未谈话的预约数}，不提供时按队列(TeacherQueue)顺序选择第一位空闲家长，
+    提供时在前window位空闲家长中选择剩余预约最少的，相同时按队列顺序。
+    全部等待家长都在别处谈话时，busy提供了结束时间则选择预计最早结束的家长，否则退回第一位等待的家长"""
+    free = []
+    fallback = None
+    for entry in queue:
+        if entry.status != Status.WAITING:
+            continue
+        if entry.name not in busy:
+            if remaining is None:
+                return entry.name
+            free.append((remaining.get(entry.name, 0), len(free), entry.name))
+            if len(free) >= window:
+                break
+        elif fallback is None or (isinstance(busy, dict) and busy[entry.name] < busy[fallback]):
+            fallback = entry.name
+    if free:
+        return min(free)[2]
+    return fallback
+
+
+# ==================== 模拟器 ====================
+POLICIES = {
+    'fifo': lambda queue, busy, remaining: next_parent(queue),
+    'conflict-aware': lambda queue, busy, remaining: next_parent(queue, set(busy)),
+    'scored': next_parent
+}
+
+
+def generate_bookings(teachers, classes_data, parents, rng):
+    """按老师任教班级随机生成预约：每位家长预约1~3位任教本班的老师，提交顺序随机"""
+    class_names = [name for grade in classes_data.values() for name in grade]
+    bookings = {str(teacher['id']): [] for teacher in teachers}
+    for number in range(parents):
+        class_name = rng.choice(class_names)
+        candidates = [str(teacher['id']) for teacher in teachers if class_name in teacher['class']]
+        if not candidates:
+            continue
+        for teacher_id in rng.sample(candidates, min(len(candidates), rng.randint(1, 3))):
+            bookings[teacher_id].append(f'{class_name}家长{number}')
+    return bookings
+
+
+def simulate(bookings, durations, policy):
+    """离散事件模拟：老师空闲时按policy选出下一位家长，家长在别处谈话时需等其结束才能开始。
+    durations[(老师, 家长)]为谈话用时（分钟），两种策略使用同一组用时以便比较"""
+    queues = {teacher_id: TeacherQueue.from_documents([{'name': name, 'type': '自主预约'} for name in names]) for teacher_id, names in bookings.items()}
+    parent_free = {}
+    parent_finish = {}
+    idle = 0.0
+    meetings = 0
+    makespan = 0.0
+    events = [(0.0, teacher_id) for teacher_id, queue in queues.items() if queue]
+    heapq.heapify(events)
+    while events:
+        now, teacher_id = heapq.heappop(events)
+        queue = queues[teacher_id]
+        busy = {name: until for name, until in parent_free.items() if until > now}
+        remaining = {}
+        for other_id, other in queues.items():
+            if other_id != teacher_id:
+                for entry in other:
+                    remaining[entry.name] = remaining.get(entry.name, 0) + 1
+        name = policy(queue, busy, remaining)
+        if name is None:
+            continue
+        queue.remove(name)
+        start = max(now, parent_free.get(name, 0.0))
+        end = start + durations[(teacher_id, name)]
+        idle += start - now
+        meetings += 1
+        makespan = max(makespan, end)
+        parent_free[name] = end
+        parent_finish[name] = max(parent_finish.get(name, 0.0), end)
+        heapq.heappush(events, (end, teacher_id))
+    return {
+        'meetings': meetings,
+        'makespan_min': makespan,
+        'meetings_per_hour': meetings / (makespan / 60) if makespan else 0,
+        'teacher_idle_min': idle,
+        'parent_finish_avg_min': sum(parent_finish.values()) / len(parent_finish) if parent_finish else 0
+    }
+
+
+def run(args):
+    with open(os.path.join(BASE_DIR, 'teacher.json'), 'r', encoding='utf-8') as f:
+        teachers = json.load(f)
+    with open(os.path.join(BASE_DIR, 'class.json'), 'r', encoding='utf-8') as f:
+        classes_data = json.load(f)
+    rng = random.Random(args.seed)
+    bookings = generate_bookings(teachers, classes_data, args.parents, rng)
+    # 谈话用时服从对数正态分布，中位数为service_minutes
+    durations = {(teacher_id, name): args.service_minutes * rng.lognormvariate(0, args.service_spread)
+                 for teacher_id, names in bookings.items() for name in names}
+    return {name: simulate(bookings, durations, policy) for name, policy in POLICIES.items()}
+
+
+def print_report(result):
+    print(f"{'策略':<18}{'谈话数':>8}{'总时长(min)':>14}{'谈话/小时':>12}{'老师空等(min)':>16}{'家长平均结束(min)':>20}")
+    for name, row in result.items():
+        print(f"{name:<18}{row['meetings']:>8}{row['makespan_min']:>14.1f}{row['meetings_per_hour']:>12.1f}{row['teacher_idle_min']:>16.1f}{row['parent_finish_avg_min']:>20.1f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='比较FIFO、跳过冲突与按评分选择几种排程策略')
+    parser.add_argument('--parents', type=int, default=300, help='模拟家长数量')
+    parser.add_argument('--service-minutes', type=float, default=10, help='单次谈话用时的中位数（分钟）')
+    parser.add_argument('--service-spread', type=float, default=0.3, help='谈话用时对数正态分布的sigma')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='以JSON输出结果')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
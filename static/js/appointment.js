@@ -227,17 +227,46 @@ function submitAppointment() {
         })
     })
         .then(response => response.json())
-        .then(data => {
-            if (!data.success) {
-                alert(data.message || '预约保存失败，请稍后重试');
-                showTeacherScreen();
-            }
-        })
+        .then(handleSaveResult)
         .catch(() => {
             alert('预约保存失败，请检查网络后重试');
         });
 }
 
+// 排队中的预约：结果通过socket的booking_result推送，轮询作为推送未送达时的后备
+let pendingTicket = null;
+let pendingTimer = null;
+
+function handleSaveResult(data) {
+    const admissionStatus = document.getElementById('admission-status');
+    clearTimeout(pendingTimer);
+    if (data.pending) {
+        pendingTicket = data.ticket;
+        admissionStatus.textContent = data.message;
+        admissionStatus.style.display = 'block';
+        pendingTimer = setTimeout(() => {
+            fetch(`/parent/appointment/save/status?ticket=${encodeURIComponent(data.ticket)}`)
+                .then(response => response.json())
+                .then(result => {
+                    // 结果已由推送处理时忽略这次轮询
+                    if (pendingTicket === data.ticket) {
+                        handleSaveResult(result);
+                    }
+                })
+                .catch(() => {
+                    alert('预约保存失败，请检查网络后重试');
+                });
+        }, 1000);
+        return;
+    }
+    pendingTicket = null;
+    admissionStatus.style.display = 'none';
+    if (!data.success) {
+        alert(data.message || '预约保存失败，请稍后重试');
+        showTeacherScreen();
+    }
+}
+
 function formatTime(minutes) {
     const now = new Date();
     const targetTime = new Date(now.getTime() + minutes * 60000);
@@ -246,8 +275,43 @@ function formatTime(minutes) {
     return `${hours}:${mins}`;
 }
 
+function initPositionUpdates() {
+    if (typeof io === 'undefined') {
+        return;
+    }
+    const socket = io(eventNamespace);
+
+    socket.on('connect', () => {
+        socket.emit('join_parent');
+    });
+
+    socket.on('booking_result', (data) => {
+        if (data && pendingTicket !== null && data.ticket === pendingTicket) {
+            handleSaveResult(data);
+        }
+    });
+
+    socket.on('position_update', (data) => {
+        if (!data || !Array.isArray(data.teachers)) {
+            return;
+        }
+        data.teachers.forEach(item => {
+            [mustAppointments, previousAppointments].forEach(list => {
+                const entry = list.find(t => t.teacher_id === item.teacherId);
+                if (entry) {
+                    entry.ranking = item.ahead;
+                }
+            });
+        });
+        if (document.getElementById('teacher-screen').classList.contains('active')) {
+            renderTeachers();
+        }
+    });
+}
+
 document.addEventListener('DOMContentLoaded', function () {
     showNoticeModal();
+    initPositionUpdates();
 
     document.getElementById('close-notice-btn').addEventListener('click', closeNoticeModal);
 
@@ -29,7 +29,10 @@ document.addEventListener('DOMContentLoaded', function() {
             const fullName = item.name || '';
             const status = item.status || 'waiting';
             let appointmentTime = item.appointmentTime || item.appointment_time;
-            if (!appointmentTime && typeof t_start_time !== 'undefined') {
+            if (!appointmentTime && typeof t_times !== 'undefined' && status !== 'completed') {
+                appointmentTime = t_times[fullName];
+            }
+            if (!appointmentTime && status !== 'completed' && typeof t_start_time !== 'undefined') {
                 const appointmentStartTime = new Date(t_start_time);
                 const estimatedTime = new Date(appointmentStartTime.getTime() + index * 10 * 60000);
                 appointmentTime = `${estimatedTime.getHours().toString().padStart(2, '0')}:${estimatedTime.getMinutes().toString().padStart(2, '0')}`;
@@ -1,7 +1,8 @@
 class QueueManager {
-    constructor(initialQueue, teacherId) {
+    constructor(initialQueue, teacherId, initialVersion) {
         this.queue = Array.isArray(initialQueue) ? [...initialQueue] : [];
         this.teacherId = teacherId;
+        this.version = initialVersion || 0;
         this.socket = null;
         this.pendingConfirmTimer = null;
         this.pendingParentId = null;
@@ -14,10 +15,10 @@ class QueueManager {
     }
 
     initSocket() {
-        this.socket = io();
+        this.socket = io(eventNamespace);
         
         this.socket.on('connect', () => {
-            this.socket.emit('join_teacher_room', { teacherId: this.teacherId });
+            this.socket.emit('join_teacher_room', { teacherId: this.teacherId, version: this.version });
         });
 
         this.socket.on('queue_update', (data) => {
@@ -26,12 +27,30 @@ class QueueManager {
             }
             if (data.queue) {
                 this.queue = data.queue;
+                this.version = data.version || 0;
                 this.skipUntilQueueUpdate = false;
                 this.resetPendingConfirm();
                 this.render();
             }
         });
 
+        this.socket.on('queue_delta', (data) => {
+            if (!data || data.teacherId !== this.teacherId || data.version <= this.version) {
+                return;
+            }
+            // 同一tick内的多次变化合并为一帧，base为合并前的版本号
+            const base = typeof data.base === 'number' ? data.base : data.version - 1;
+            if (base !== this.version) {
+                this.socket.emit('queue_sync', { teacherId: this.teacherId, version: this.version });
+                return;
+            }
+            this.applyOps(data.ops || []);
+            this.version = data.version;
+            this.skipUntilQueueUpdate = false;
+            this.resetPendingConfirm();
+            this.render();
+        });
+
         this.socket.on('promote_rejected', (data = {}) => {
             if (data.teacherId && data.teacherId !== this.teacherId) {
                 return;
@@ -60,6 +79,24 @@ class QueueManager {
         this.elements.skipBtn.addEventListener('click', () => this.handleSkip());
     }
 
+    applyOps(ops) {
+        ops.forEach((op) => {
+            if (op.op === 'insert') {
+                this.queue.push(op.item);
+            } else if (op.op === 'remove') {
+                this.queue = this.queue.filter(item => item.name !== op.name);
+            } else if (op.op === 'status') {
+                this.queue = this.queue.map(item => item.name === op.name ? { ...item, status: op.status } : item);
+            } else if (op.op === 'move_tail') {
+                const target = this.queue.find(item => item.name === op.name);
+                if (target) {
+                    this.queue = this.queue.filter(item => item.name !== op.name);
+                    this.queue.push({ ...target, status: op.status });
+                }
+            }
+        });
+    }
+
     getCurrentParent() {
         return this.queue.find(item => item.status === 'current') || null;
     }
@@ -246,7 +283,7 @@ class QueueManager {
 
 document.addEventListener('DOMContentLoaded', function() {
     if (typeof queue !== 'undefined' && typeof teacherId !== 'undefined') {
-        new QueueManager(queue, teacherId);
+        new QueueManager(queue, teacherId, typeof queueVersion !== 'undefined' ? queueVersion : 0);
         console.log(queue, teacherId);
     } else {
         console.error('Queue or teacherId not defined');
@@ -0,0 +1,78 @@
+class OverviewBoard {
+    constructor(teachers) {
+        this.teachers = teachers;
+        // teacherId -> { version, current, waiting }
+        this.rows = {};
+        this.grid = document.getElementById('overview-grid');
+        this.cards = {};
+        this.createCards();
+        this.initSocket();
+    }
+
+    initSocket() {
+        this.socket = io(eventNamespace);
+
+        this.socket.on('connect', () => {
+            this.socket.emit('join_overview');
+        });
+
+        // 每帧只包含有变化的老师：[老师id, 队列版本号, 当前家长, 等待人数]
+        this.socket.on('overview_update', (data) => {
+            if (!data || !Array.isArray(data.teachers)) {
+                return;
+            }
+            data.teachers.forEach(([teacherId, version, current, waiting]) => {
+                const known = this.rows[teacherId];
+                if (known && known.version > version) {
+                    return;
+                }
+                this.rows[teacherId] = { version, current, waiting };
+                this.renderCard(teacherId);
+            });
+        });
+    }
+
+    createCards() {
+        this.grid.innerHTML = '';
+        this.teachers.forEach((teacher) => {
+            const card = document.createElement('div');
+            card.className = 'teacher-card';
+            card.innerHTML = `
+                <div class="teacher-name">${this.escapeHtml(teacher.subject + teacher.name)}</div>
+                <div class="teacher-info">
+                    <span><strong>地点:</strong> <span class="waiting-count">${this.escapeHtml(teacher.location)}</span></span>
+                </div>
+                <div class="teacher-info">
+                    <span><strong>当前家长:</strong> <span class="waiting-count" data-field="current">-</span></span>
+                </div>
+                <div class="teacher-info">
+                    <span><strong>等待人数:</strong> <span class="waiting-count" data-field="waiting">-</span></span>
+                </div>
+            `;
+            this.grid.appendChild(card);
+            this.cards[String(teacher.id)] = card;
+        });
+    }
+
+    renderCard(teacherId) {
+        const card = this.cards[teacherId];
+        const row = this.rows[teacherId];
+        if (!card || !row) {
+            return;
+        }
+        card.querySelector('[data-field="current"]').textContent = row.current || '暂无';
+        card.querySelector('[data-field="waiting"]').textContent = `${row.waiting}人`;
+    }
+
+    escapeHtml(text) {
+        const div = document.createElement('div');
+        div.textContent = text;
+        return div.innerHTML;
+    }
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    if (typeof teachers !== 'undefined') {
+        new OverviewBoard(teachers);
+    }
+});
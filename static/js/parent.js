@@ -17,14 +17,9 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
-    allTeachers.forEach(teacher => {
-        const waitingCount = teacher.ranking || 0;
-        const totalWaiting = waitingCount;
-        const estimatedTime = new Date(appointmentStartTime.getTime() + totalWaiting * 10 * 60000);
-        const estimatedTimeStr = `${estimatedTime.getHours().toString().padStart(2, '0')}:${estimatedTime.getMinutes().toString().padStart(2, '0')}`;
-        
-        const waitingElement = document.querySelector(`[data-waiting="${teacher.teacher_id}"]`);
-        const timeElement = document.querySelector(`[data-time="${teacher.teacher_id}"]`);
+    function renderPosition(teacherId, waitingCount, estimatedTimeStr) {
+        const waitingElement = document.querySelector(`[data-waiting="${teacherId}"]`);
+        const timeElement = document.querySelector(`[data-time="${teacherId}"]`);
         
         if (waitingElement) {
             waitingElement.textContent = `${waitingCount}人`;
@@ -33,6 +28,33 @@ document.addEventListener('DOMContentLoaded', function() {
         if (timeElement) {
             timeElement.textContent = estimatedTimeStr;
         }
+    }
+
+    allTeachers.forEach(teacher => {
+        const waitingCount = teacher.ranking || 0;
+        let estimatedTimeStr = teacher.estimatedTime;
+        if (!estimatedTimeStr) {
+            const estimatedTime = new Date(appointmentStartTime.getTime() + waitingCount * 10 * 60000);
+            estimatedTimeStr = `${estimatedTime.getHours().toString().padStart(2, '0')}:${estimatedTime.getMinutes().toString().padStart(2, '0')}`;
+        }
+        
+        renderPosition(teacher.teacher_id, waitingCount, estimatedTimeStr);
     });
-});
 
+    if (typeof io !== 'undefined' && allTeachers.length > 0) {
+        const socket = io(eventNamespace);
+
+        socket.on('connect', () => {
+            socket.emit('join_parent');
+        });
+
+        socket.on('position_update', (data) => {
+            if (!data || !Array.isArray(data.teachers)) {
+                return;
+            }
+            data.teachers.forEach(item => {
+                renderPosition(item.teacherId, item.ahead, item.status === 'current' ? '正在进行' : (item.estimatedTime || '已完成'));
+            });
+        });
+    }
+});
@@ -1,6 +1,6 @@
 let reservedStudents = [];
 let maxParents = 10;
-const defaultGrade = '初一';
+const defaultGrade = eventGrade;
 
 function loadSettings() {
     if (typeof initialMaxParents !== 'undefined') {
@@ -105,6 +105,57 @@ function saveSettings() {
     });
 }
 
+function uploadImport(dryRun) {
+    const file = document.getElementById('import-file').files[0];
+    const params = new URLSearchParams();
+    if (dryRun) {
+        params.set('dry_run', '1');
+    }
+    if (document.getElementById('import-append').checked) {
+        params.set('mode', 'append');
+    }
+    const formData = new FormData();
+    formData.append('file', file);
+    return fetch(`/teacher/setting/import?${params}`, {
+        method: 'POST',
+        body: formData
+    }).then(response => response.json());
+}
+
+function importReserved() {
+    if (!document.getElementById('import-file').files[0]) {
+        alert('请选择要导入的文件');
+        return;
+    }
+    // 先校验并预览各位老师名单的变化，确认后再正式导入
+    uploadImport(true)
+        .then(data => {
+            if (!data.success) {
+                alert([data.message || '导入失败', ...(data.errors || [])].join('\n'));
+                return;
+            }
+            if (data.changes.length === 0) {
+                alert('名单没有变化');
+                return;
+            }
+            const lines = data.changes.map(change => `老师${change.teacherId}：新增${change.added.length}人，删除${change.removed.length}人`);
+            if (!confirm(`将修改以下老师的名单：\n${lines.join('\n')}\n确定导入吗？`)) {
+                return;
+            }
+            return uploadImport(false).then(result => {
+                if (result.success) {
+                    alert('名单导入成功');
+                    window.location.reload();
+                } else {
+                    alert([result.message || '导入失败', ...(result.errors || [])].join('\n'));
+                }
+            });
+        })
+        .catch(() => {
+            alert('导入失败，请检查网络后重试');
+        });
+}
+
 function loadClasses(grade = defaultGrade) {
     const select = document.getElementById('class-select');
     if (!select) {
@@ -139,5 +190,6 @@ document.addEventListener('DOMContentLoaded', function() {
     });
     
     document.getElementById('save-settings-btn').addEventListener('click', saveSettings);
+    document.getElementById('import-btn').addEventListener('click', importReserved);
 });
 
@@ -0,0 +1,521 @@
+# coding=UTF-8
+"""数据存储后端：应用的全部数据访问（队列的条件更新与版本号比较交换、家长预约记录、老师名额设置、
+名额计数器、队列事件日志）都写作pymongo集合接口的一个子集，本模块按AQS_STORAGE选择实现：
+
+- mongo（默认）：pymongo连接AQS_MONGODB_URI，支持多worker部署；
+- memory：进程内的内存引擎，不需要数据库服务，用于离线测试、不需要多worker的小规模单机场次，
+  以及与mongo对比吞吐量；数据只保存在本进程内存中，重启后清空，也不能与其他worker共享。
+
+内存引擎实现的接口子集：
+    find / find_one（投影、sort、limit）、distinct、insert_one / insert_many、update_one（upsert）、
+    find_one_and_update、bulk_write（UpdateOne、InsertOne）、create_index（unique）、delete_many
+    查询：等值（含点号路径与数组元素）、$in $ne $gt $gte $lt $lte $elemMatch，
+          $expr中的 $lt $lte $gt $gte $eq $ne $ifNull 与 '$字段' 引用
+    更新：$set（含 queue.3.status 形式的数组下标）、$inc、$push、$pull、$setOnInsert
+新代码需要使用子集之外的操作时须同时在这里实现，未实现的操作符会抛出NotImplementedError。"""
+import threading
+from itertools import count
+import pymongo
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.results import BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult
+
+
+STORAGE_KINDS = ('mongo', 'memory')
+
+
+def open_database(kind, uri, name, **options):
+    """返回数据库对象，options为pymongo.MongoClient的连接池等参数，内存引擎忽略"""
+    if kind == 'memory':
+        return MemoryClient()[name]
+    if kind != 'mongo':
+        raise ValueError(f'未知的存储后端{kind}，可选：{"、".join(STORAGE_KINDS)}')
+    return pymongo.MongoClient(uri, **options)[name]
+
+
+# ==================== 文档读写 ====================
+def copy_value(value):
+    """复制文档，写入与读出时都复制，调用方修改返回值不会影响已存储的数据"""
+    if isinstance(value, dict):
+        return {key: copy_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_value(item) for item in value]
+    return value
+
+
+def lookup(value, parts):
+    """取出路径上的全部值，经过数组时对每个元素继续取值；字段不存在时返回空列表"""
+    if not parts:
+        return [value]
+    if isinstance(value, dict):
+        if parts[0] not in value:
+            return []
+        return lookup(value[parts[0]], parts[1:])
+    if isinstance(value, list):
+        if parts[0].isdigit():
+            index = int(parts[0])
+            return lookup(value[index], parts[1:]) if index < len(value) else []
+        return [found for item in value for found in lookup(item, parts)]
+    return []
+
+
+def candidates(document, path):
+    """参与比较的值：路径上的值，值为数组时再加上其中的元素"""
+    values = []
+    for value in lookup(document, path.split('.')):
+        values.append(value)
+        if isinstance(value, list):
+            values.extend(value)
+    return values
+
+
+def project(document, projection):
+    """按投影返回文档的副本，支持包含式（含 queue.name 形式的点号路径）与只排除_id"""
+    if not projection:
+        return copy_value(document)
+    include = {key: value for key, value in projection.items() if key != '_id'}
+    if not any(include.values()):
+        result = {key: copy_value(value) for key, value in document.items() if projection.get(key, 1)}
+        return result
+    result = {}
+    if projection.get('_id', 1) and '_id' in document:
+        result['_id'] = document['_id']
+    for path in include:
+        pick(document, path.split('.'), result)
+    # 字段顺序与存储的文档一致
+    return {key: result[key] for key in document if key in result}
+
+
+def pick(source, parts, target):
+    """把source中的一条路径复制到target，路径经过数组时按元素逐个复制"""
+    key = parts[0]
+    if key not in source:
+        return
+    value = source[key]
+    if len(parts) == 1:
+        target[key] = copy_value(value)
+    elif isinstance(value, dict):
+        pick(value, parts[1:], target.setdefault(key, {}))
+    elif isinstance(value, list):
+        existing = target.setdefault(key, [{} for item in value if isinstance(item, dict)])
+        for item, picked in zip([item for item in value if isinstance(item, dict)], existing):
+            pick(item, parts[1:], picked)
+
+
+# ==================== 查询 ====================
+def compare(op, left, right):
+    try:
+        if op == '$gt':
+            return left > right
+        if op == '$gte':
+            return left >= right
+        if op == '$lt':
+            return left < right
+        if op == '$lte':
+            return left <= right
+    except TypeError:
+        # 类型不同的值之间不比较，与MongoDB只比较同类型的值一致
+        return False
+    raise NotImplementedError(op)
+
+
+def equals(values, expected):
+    if expected is None:
+        return not values or None in values
+    return any(value == expected for value in values)
+
+
+def match_condition(document, path, condition):
+    values = candidates(document, path)
+    if not (isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition)):
+        return equals(values, condition)
+    for op, operand in condition.items():
+        if op == '$in':
+            matched = any(equals(values, item) for item in operand)
+        elif op == '$ne':
+            matched = not equals(values, operand)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            matched = any(value is not None and compare(op, value, operand) for value in values)
+        elif op == '$elemMatch':
+            matched = any(isinstance(value, list) and any(isinstance(item, dict) and matches(item, operand) for item in value)
+                          for value in lookup(document, path.split('.')))
+        else:
+            raise NotImplementedError(f'内存引擎不支持查询操作符{op}')
+        if not matched:
+            return False
+    return True
+
+
+def evaluate(document, expression):
+    """计算$expr表达式"""
+    if isinstance(expression, str) and expression.startswith('$'):
+        values = lookup(document, expression[1:].split('.'))
+        return values[0] if values else None
+    if isinstance(expression, dict) and len(expression) == 1:
+        op, args = next(iter(expression.items()))
+        if op == '$ifNull':
+            value = evaluate(document, args[0])
+            return evaluate(document, args[1]) if value is None else value
+        if op in ('$eq', '$ne'):
+            equal = evaluate(document, args[0]) == evaluate(document, args[1])
+            return equal if op == '$eq' else not equal
+        if op in ('$gt', '$gte', '$lt', '$lte'):
+            return compare(op, evaluate(document, args[0]), evaluate(document, args[1]))
+        raise NotImplementedError(f'内存引擎不支持表达式{op}')
+    return expression
+
+
+def matches(document, query):
+    for key, condition in query.items():
+        if key == '$expr':
+            if not evaluate(document, condition):
+                return False
+        elif key.startswith('$'):
+            raise NotImplementedError(f'内存引擎不支持查询操作符{key}')
+        elif not match_condition(document, key, condition):
+            return False
+    return True
+
+
+# ==================== 更新 ====================
+def set_path(document, path, value):
+    parts = path.split('.')
+    target = document
+    for part in parts[:-1]:
+        target = target[int(part)] if isinstance(target, list) else target.setdefault(part, {})
+    if isinstance(target, list):
+        target[int(parts[-1])] = value
+    else:
+        target[parts[-1]] = value
+
+
+def get_path(document, path, default=None):
+    values = lookup(document, path.split('.'))
+    return values[0] if values else default
+
+
+def apply_update(document, update, inserting=False):
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, value in fields.items():
+            if op in ('$set', '$setOnInsert'):
+                set_path(document, path, copy_value(value))
+            elif op == '$inc':
+                set_path(document, path, get_path(document, path, 0) + value)
+            elif op == '$push':
+                items = get_path(document, path)
+                if items is None:
+                    set_path(document, path, [copy_value(value)])
+                else:
+                    items.append(copy_value(value))
+            elif op == '$pull':
+                items = get_path(document, path)
+                if isinstance(items, list):
+                    if isinstance(value, dict):
+                        items[:] = [item for item in items if not (isinstance(item, dict) and matches(item, value))]
+                    else:
+                        items[:] = [item for item in items if item != value]
+            else:
+                raise NotImplementedError(f'内存引擎不支持更新操作符{op}')
+
+
+def upsert_document(query, update):
+    """按查询中的等值条件与更新内容生成新文档"""
+    document = {}
+    for key, value in query.items():
+        if not key.startswith('$') and not (isinstance(value, dict) and any(k.startswith('$') for k in value)):
+            set_path(document, key, copy_value(value))
+    apply_update(document, update, inserting=True)
+    return document
+
+
+def sort_documents(documents, order):
+    """按[(字段, 方向), ...]排序，null与缺失字段排在最前，与MongoDB一致"""
+    for key, direction in reversed(order):
+        documents.sort(key=lambda document: (get_path(document, key) is not None, get_path(document, key)),
+                       reverse=direction == pymongo.DESCENDING)
+    return documents
+
+
+# ==================== 索引 ====================
+class Index:
+    """按首个字段的值索引文档，供等值与$in查询缩小范围；unique时按全部字段检查重复"""
+
+    def __init__(self, fields, unique):
+        self.fields = fields
+        self.unique = unique
+        self.entries = {}
+        self.owners = {}
+
+    def keys(self, document):
+        return [value for value in candidates(document, self.fields[0]) if not isinstance(value, (dict, list))]
+
+    def unique_key(self, document):
+        return tuple(get_path(document, field) for field in self.fields)
+
+    def check(self, document):
+        if self.unique and self.owners.get(self.unique_key(document), document['_id']) != document['_id']:
+            raise DuplicateKeyError(f'E11000 duplicate key error index: {self.fields} dup key: {self.unique_key(document)}', 11000)
+
+    def add(self, document):
+        for key in self.keys(document):
+            self.entries.setdefault(key, set()).add(document['_id'])
+        if self.unique:
+            self.owners[self.unique_key(document)] = document['_id']
+
+    def remove(self, document):
+        for key in self.keys(document):
+            ids = self.entries.get(key)
+            if ids is not None:
+                ids.discard(document['_id'])
+                if not ids:
+                    del self.entries[key]
+        if self.unique and self.owners.get(self.unique_key(document)) == document['_id']:
+            del self.owners[self.unique_key(document)]
+
+
+# ==================== 集合与数据库 ====================
+class MemoryCursor:
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.order = []
+        self.count = 0
+
+    def sort(self, key, direction=pymongo.ASCENDING):
+        self.order = [*key] if isinstance(key, list) else [(key, direction)]
+        return self
+
+    def limit(self, count):
+        self.count = count
+        return self
+
+    def __iter__(self):
+        with self.collection.lock:
+            documents = sort_documents(self.collection.select(self.query), self.order)
+            if self.count:
+                documents = documents[:self.count]
+            return iter([project(document, self.projection) for document in documents])
+
+
+class MemoryCollection:
+    def __init__(self, name, lock):
+        self.name = name
+        self.lock = lock
+        # _id -> 文档，按插入顺序
+        self.documents = {}
+        # (字段, ...) -> Index
+        self.indexes = {}
+        self.sequence = count()
+        self.order = {}
+
+    # ---------- 内部 ----------
+    def select(self, query):
+        """返回匹配的文档（不复制），有索引可用时只检查索引命中的文档"""
+        ids = None
+        for key, condition in query.items():
+            index = next((index for fields, index in self.indexes.items() if fields[0] == key), None)
+            if index is None:
+                continue
+            if isinstance(condition, dict) and [*condition] == ['$in']:
+                values = condition['$in']
+            elif not isinstance(condition, (dict, list)) and condition is not None:
+                values = [condition]
+            else:
+                continue
+            ids = set().union(*[index.entries.get(value, ()) for value in values if not isinstance(value, (dict, list))])
+            break
+        if ids is None:
+            documents = self.documents.values()
+        else:
+            documents = [self.documents[i] for i in sorted(ids, key=self.order.get)]
+        return [document for document in documents if matches(document, query)]
+
+    def store(self, document):
+        document = copy_value(document)
+        document.setdefault('_id', ObjectId())
+        if document['_id'] in self.documents:
+            raise DuplicateKeyError(f"E11000 duplicate key error index: _id dup key: {document['_id']}", 11000)
+        for index in self.indexes.values():
+            index.check(document)
+        self.documents[document['_id']] = document
+        self.order[document['_id']] = next(self.sequence)
+        for index in self.indexes.values():
+            index.add(document)
+        return document['_id']
+
+    def modify(self, document, update):
+        """在副本上执行更新，通过唯一索引检查后才替换原文档"""
+        updated = copy_value(document)
+        apply_update(updated, update)
+        if updated == document:
+            return document, False
+        for index in self.indexes.values():
+            index.check(updated)
+        for index in self.indexes.values():
+            index.remove(document)
+        self.documents[document['_id']] = updated
+        for index in self.indexes.values():
+            index.add(updated)
+        return updated, True
+
+    def write(self, query, update, upsert=False):
+        """更新第一个匹配的文档，返回(更新后的文档, 匹配数, 修改数, 新建的_id)"""
+        found = self.select(query)
+        if found:
+            document, modified = self.modify(found[0], update)
+            return document, 1, int(modified), None
+        if not upsert:
+            return None, 0, 0, None
+        inserted = self.store(upsert_document(query, update))
+        return self.documents[inserted], 0, 0, inserted
+
+    # ---------- 集合接口 ----------
+    def create_index(self, keys, unique=False, **options):
+        fields = [keys] if isinstance(keys, str) else [field for field, _ in keys]
+        with self.lock:
+            index = Index(fields, unique)
+            for document in self.documents.values():
+                index.check(document)
+                index.add(document)
+            self.indexes[tuple(fields)] = index
+        return '_'.join(f'{field}_1' for field in fields)
+
+    def find(self, query=None, projection=None):
+        return MemoryCursor(self, query or {}, projection)
+
+    def find_one(self, query=None, projection=None, sort=None):
+        cursor = self.find(query, projection).limit(1)
+        if sort:
+            cursor.sort(sort)
+        return next(iter(cursor), None)
+
+    def distinct(self, key, query=None):
+        with self.lock:
+            values = []
+            for document in self.select(query or {}):
+                for value in candidates(document, key):
+                    if not isinstance(value, list) and value not in values:
+                        values.append(value)
+            return values
+
+    def insert_one(self, document):
+        with self.lock:
+            inserted = self.store(document)
+        document.setdefault('_id', inserted)
+        return InsertOneResult(inserted, True)
+
+    def insert_many(self, documents, ordered=True):
+        inserted, errors = [], []
+        with self.lock:
+            for index, document in enumerate(documents):
+                try:
+                    inserted.append(self.store(document))
+                except DuplicateKeyError as error:
+                    errors.append({'index': index, 'code': 11000, 'errmsg': str(error), 'op': document})
+                    if ordered:
+                        break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'nInserted': len(inserted), 'nUpserted': 0, 'nMatched': 0,
+                                  'nModified': 0, 'nRemoved': 0, 'upserted': [], 'writeConcernErrors': []})
+        return InsertManyResult(inserted, True)
+
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            _, matched, modified, inserted = self.write(query, update, upsert)
+        raw = {'n': matched + (inserted is not None), 'nModified': modified}
+        if inserted is not None:
+            raw['upserted'] = inserted
+        return UpdateResult(raw, True)
+
+    def find_one_and_update(self, query, update, projection=None, upsert=False, return_document=pymongo.ReturnDocument.BEFORE, sort=None):
+        with self.lock:
+            found = sort_documents(self.select(query), [*sort] if sort else [])
+            if found:
+                before = copy_value(found[0])
+                after, _ = self.modify(found[0], update)
+            elif upsert:
+                before = None
+                after = self.documents[self.store(upsert_document(query, update))]
+            else:
+                return None
+            document = after if return_document == pymongo.ReturnDocument.AFTER else before
+            return project(document, projection) if document is not None else None
+
+    def bulk_write(self, requests, ordered=True):
+        result = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+                  'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self.lock:
+            for index, request in enumerate(requests):
+                try:
+                    if isinstance(request, pymongo.InsertOne):
+                        self.store(request._doc)
+                        result['nInserted'] += 1
+                    elif isinstance(request, pymongo.UpdateOne):
+                        _, matched, modified, inserted = self.write(request._filter, request._doc, request._upsert)
+                        result['nMatched'] += matched
+                        result['nModified'] += modified
+                        if inserted is not None:
+                            result['nUpserted'] += 1
+                            result['upserted'].append({'index': index, '_id': inserted})
+                    else:
+                        raise NotImplementedError(f'内存引擎不支持批量操作{type(request).__name__}')
+                except DuplicateKeyError as error:
+                    result['writeErrors'].append({'index': index, 'code': 11000, 'errmsg': str(error)})
+                    if ordered:
+                        break
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def delete_many(self, query):
+        with self.lock:
+            removed = self.select(query)
+            for document in removed:
+                for index in self.indexes.values():
+                    index.remove(document)
+                del self.documents[document['_id']]
+                del self.order[document['_id']]
+        return DeleteResult({'n': len(removed)}, True)
+
+    def count_documents(self, query):
+        with self.lock:
+            return len(self.select(query))
+
+
+class MemoryDatabase:
+    def __init__(self, name):
+        self.name = name
+        # 同一数据库的所有集合共用一把锁，单个操作内的读取与写入不会与其他线程交错
+        self.lock = threading.RLock()
+        self.collections = {}
+
+    def __getitem__(self, name):
+        collection = self.collections.get(name)
+        if collection is None:
+            collection = self.collections[name] = MemoryCollection(name, self.lock)
+        return collection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def list_collection_names(self):
+        return [*self.collections]
+
+
+class MemoryClient:
+    def __init__(self):
+        self.databases = {}
+
+    def __getitem__(self, name):
+        database = self.databases.get(name)
+        if database is None:
+            database = self.databases[name] = MemoryDatabase(name)
+        return database
+
+    def drop_database(self, name):
+        self.databases.pop(name, None)
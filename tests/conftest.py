@@ -0,0 +1,40 @@
+# coding=UTF-8
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 各模块位于仓库根目录，直接运行pytest时也能导入
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='session')
+def main_app(tmp_path_factory):
+    """以内存存储、普通线程导入应用（不打猴子补丁，不影响测试进程），日志写入临时目录；
+    应用按工作目录读取老师与班级名单，测试期间工作目录切换到仓库根目录"""
+    os.environ.update(AQS_ASYNC_MODE='threading', AQS_STORAGE='memory', AQS_WARM_START_INTERVAL='0',
+                      AQS_BROADCAST_HZ='0', AQS_LOG_DIR=str(tmp_path_factory.mktemp('log')))
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    import main_app
+    main_app.ENABLE_TIME_CHECK = False
+    main_app.socketio.server.async_handlers = False
+    yield main_app
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def event(main_app):
+    """默认场次，老师队列与家长记录清空，在场次上下文中运行"""
+    event = main_app.events.default
+    for teacher in event.teachers:
+        teacher_id = str(teacher['id'])
+        event.teacher.update_one({'id': teacher_id}, {'$set': {'queue': [], 'active': 0, 'version': 0, 'maxParents': 10, 'reservedStudents': []}})
+        event.update_setting(teacher_id, maxParents=10)
+        event.reload_queue(teacher_id)
+    event.parent.delete_many({})
+    event.queue_log.pending.clear()
+    event.queue_log.events.delete_many({})
+    with main_app.event_context(event):
+        yield event
@@ -0,0 +1,85 @@
+# coding=UTF-8
+"""由test_async_io.py在子进程中运行：猴子补丁对整个进程生效，不能与其他测试共用进程。
+工作目录为仓库根目录（读取老师与班级名单），日志写入测试传入的AQS_LOG_DIR。
+
+与eventlet worker为每个连接分配一个绿色线程相同，两位老师的complete_parent各在一个绿色线程中处理；
+第一位老师写队列前先经过一次真实的网络往返（连接AQS_SLOW_SERVER，对方延迟若干秒才回复），
+输出第二位老师的队列更新在多少秒后送达其面板（JSON）。"""
+import json
+import os
+import socket
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+os.environ.update(AQS_STORAGE='memory', AQS_WARM_START_INTERVAL='0', AQS_BROADCAST_HZ='0')
+
+import main_app  # noqa: E402  按AQS_ASYNC_MODE决定是否打猴子补丁
+import eventlet  # noqa: E402
+
+SLOW_TEACHER, OTHER_TEACHER = '1', '2'
+
+
+class SlowCollection:
+    """第一位老师的队列写入前先向慢服务器发一次请求并等待回复"""
+
+    def __init__(self, collection, address):
+        self._collection = collection
+        self._address = address
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def update_one(self, query, *args, **kwargs):
+        if isinstance(query, dict) and query.get('id') == SLOW_TEACHER:
+            with socket.create_connection(self._address) as connection:
+                connection.sendall(b'ping')
+                connection.recv(4)
+        return self._collection.update_one(query, *args, **kwargs)
+
+
+def teacher_socket(event, teacher_id):
+    app = main_app.app
+    client = app.test_client()
+    client.get(f'/login?event={event.id}')
+    client.post('/verify-key', json={'key': app.config['TEACHER_KEY']})
+    client.post('/handle', json={'name': teacher_id})
+    connection = main_app.socketio.test_client(app, namespace=event.namespace, flask_test_client=client)
+    connection.emit('join_teacher_room', {'teacherId': teacher_id}, namespace=event.namespace)
+    connection.get_received(event.namespace)
+    return connection
+
+
+def main():
+    host, port = os.environ['AQS_SLOW_SERVER'].split(':')
+    main_app.ENABLE_TIME_CHECK = False
+    main_app.socketio.server.async_handlers = False
+    event = main_app.events.default
+    for teacher_id in (SLOW_TEACHER, OTHER_TEACHER):
+        queue = [{'name': f'家长{teacher_id}a', 'status': 'current', 'type': '自主预约'},
+                 {'name': f'家长{teacher_id}b', 'status': 'waiting', 'type': '自主预约'}]
+        event.teacher.update_one({'id': teacher_id}, {'$set': {'queue': queue, 'active': 2}})
+        event.reload_queue(teacher_id)
+    slow_socket = teacher_socket(event, SLOW_TEACHER)
+    other_socket = teacher_socket(event, OTHER_TEACHER)
+    event.teacher = SlowCollection(event.teacher, (host, int(port)))
+
+    started = time.perf_counter()
+    slow = eventlet.spawn(slow_socket.emit, 'complete_parent', {'teacherId': SLOW_TEACHER}, namespace=event.namespace)
+    # 让第一位老师的处理先开始并停在网络等待上
+    eventlet.sleep(0.05)
+    other_socket.emit('complete_parent', {'teacherId': OTHER_TEACHER}, namespace=event.namespace)
+    delivered = None
+    while time.perf_counter() - started < 10:
+        if any(packet['name'] == 'queue_delta' for packet in other_socket.get_received(event.namespace)):
+            delivered = time.perf_counter() - started
+            break
+        eventlet.sleep(0.01)
+    slow.wait()
+    print(json.dumps({'async_mode': main_app.ASYNC_MODE, 'other_teacher_update_s': delivered, 'slow_op_s': time.perf_counter() - started}))
+
+
+if __name__ == '__main__':
+    main()
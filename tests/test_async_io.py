@@ -0,0 +1,61 @@
+# coding=UTF-8
+"""一位老师的处理停在慢速网络调用上时，同一worker上其他老师的队列更新仍应及时送达"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+SCENARIO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'slow_call_scenario.py')
+STALL = 2.0
+
+
+@pytest.fixture
+def slow_server():
+    """收到请求后等待STALL秒才回复的TCP服务器，运行在测试进程的普通线程中，不受子进程的猴子补丁影响"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    stopped = threading.Event()
+
+    def reply(connection):
+        with connection:
+            connection.recv(4)
+            time.sleep(STALL)
+            connection.sendall(b'pong')
+
+    def serve():
+        while not stopped.is_set():
+            try:
+                connection, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=reply, args=(connection,), daemon=True).start()
+    threading.Thread(target=serve, daemon=True).start()
+    yield '127.0.0.1:%d' % listener.getsockname()[1]
+    stopped.set()
+    listener.close()
+
+
+def run_scenario(address, async_mode, log_dir):
+    env = dict(os.environ, AQS_SLOW_SERVER=address, AQS_ASYNC_MODE=async_mode, AQS_LOG_DIR=str(log_dir))
+    output = subprocess.run([sys.executable, SCENARIO], env=env, capture_output=True, text=True, timeout=60)
+    assert output.returncode == 0, output.stderr
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def test_other_teacher_not_blocked_by_slow_call(slow_server, tmp_path):
+    result = run_scenario(slow_server, 'eventlet', tmp_path)
+    assert result['slow_op_s'] >= STALL
+    assert result['other_teacher_update_s'] is not None
+    assert result['other_teacher_update_s'] < STALL / 2
+
+
+def test_slow_call_blocks_worker_without_monkey_patching(slow_server, tmp_path):
+    # 对照：不打补丁时网络等待阻塞整个worker，其他老师的更新要等慢调用结束，说明上面的测试确实能发现问题
+    result = run_scenario(slow_server, 'threading', tmp_path)
+    assert result['other_teacher_update_s'] is None or result['other_teacher_update_s'] >= STALL
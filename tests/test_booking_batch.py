@@ -0,0 +1,78 @@
+# coding=UTF-8
+"""排队预约模式的批量提交：名额已满时拒绝，同一家长的多位老师全部成功或全部回滚，每次写入按各自的版本号记录事件"""
+from queue_log import apply_ops
+
+
+def queue_names(event, teacher_id):
+    return [item['name'] for item in event.teacher.find_one({'id': teacher_id})['queue']]
+
+
+def logged(event, teacher_id):
+    event.queue_log.flush()
+    return [*event.queue_log.events.find({'teacher_id': teacher_id}, {'_id': 0}).sort('version', 1)]
+
+
+def test_full_teacher_rejected_in_arrival_order(main_app, event):
+    event.teacher.update_one({'id': '1'}, {'$set': {'maxParents': 2}})
+    results = main_app.commit_booking_batch([('甲', [1]), ('乙', [1]), ('丙', [1])])
+    assert [result['success'] for result in results] == [True, True, False]
+    assert '已满' in results[2]['message']
+    assert queue_names(event, '1') == ['甲', '乙']
+    assert event.teacher.find_one({'id': '1'})['active'] == 2
+    assert event.parent.find_one({'name': '丙'}) is None
+
+
+def test_parent_rolled_back_when_one_teacher_fills(main_app, event):
+    event.teacher.update_one({'id': '2'}, {'$set': {'maxParents': 1}})
+    bulk_write = event.teacher.bulk_write
+
+    def competing_bulk_write(requests, **kwargs):
+        # 预演之后、写入之前，另一个worker占用了老师2的最后一个名额
+        event.teacher.bulk_write = bulk_write
+        event.teacher.update_one({'id': '2'}, {'$push': {'queue': {'name': '他人', 'status': 'waiting', 'type': '自主预约'}}, '$inc': {'active': 1, 'version': 1}})
+        return bulk_write(requests, **kwargs)
+    event.teacher.bulk_write = competing_bulk_write
+    try:
+        results = main_app.commit_booking_batch([('甲', [1, 2]), ('乙', [1])])
+    finally:
+        event.teacher.bulk_write = bulk_write
+    assert results[0]['success'] is False and '老师2' in results[0]['message']
+    assert results[1] == {'success': True}
+    # 已占到的老师1的名额归还，家长记录不变
+    assert queue_names(event, '1') == ['乙']
+    assert event.teacher.find_one({'id': '1'})['active'] == 1
+    assert queue_names(event, '2') == ['他人']
+    assert event.parent.find_one({'name': '甲'}) is None
+    assert [(item['version'], item['action'], item['names']) for item in logged(event, '1')] == [
+        (1, 'book', ['甲']), (2, 'book', ['乙']), (3, 'cancel', ['甲'])
+    ]
+
+
+def test_each_write_logged_at_its_own_version(main_app, event):
+    main_app.commit_booking_batch([('甲', [1, 4]), ('乙', [1])])
+    results = main_app.commit_booking_batch([('甲', [1]), ('丙', [1, 4]), ('丁', [4])])
+    assert all(result['success'] for result in results)
+    for teacher_id in ('1', '4'):
+        data = event.teacher.find_one({'id': teacher_id})
+        events = logged(event, teacher_id)
+        assert [item['version'] for item in events] == [*range(1, data['version'] + 1)]
+        assert event.queue_log.tail(teacher_id, 0) is not None
+        queue = []
+        for item in events:
+            apply_ops(queue, item['ops'])
+        assert queue == data['queue']
+    # 甲不再预约老师4，记为取消
+    assert [(item['action'], item['names']) for item in logged(event, '4')] == [
+        ('book', ['甲']), ('book', ['丙']), ('book', ['丁']), ('cancel', ['甲'])
+    ]
+    assert event.parent.find_one({'name': '甲'})['appointment'] == [{'teacher_id': 1}]
+
+
+def test_unchanged_teachers_not_broadcast(main_app, event, monkeypatch):
+    main_app.commit_booking_batch([('甲', [4])])
+    event.teacher.update_one({'id': '1'}, {'$set': {'maxParents': 0}})
+    sent = []
+    monkeypatch.setattr(main_app, 'emit_queue_update', lambda teacher_id, *args, **kwargs: sent.append(teacher_id))
+    results = main_app.commit_booking_batch([('乙', [1]), ('丙', [4])])
+    assert [result['success'] for result in results] == [False, True]
+    assert sent == ['4']
@@ -0,0 +1,71 @@
+# coding=UTF-8
+"""BroadcastBuffer：同一tick内版本连续的增量合并为一帧，出现缺口时改发完整快照"""
+from broadcast import BroadcastBuffer, overview_row
+from queue_model import Status, TeacherQueue
+
+
+def insert(name):
+    return {'op': 'insert', 'item': {'name': name, 'status': 'waiting', 'type': '自主预约'}}
+
+
+def test_consecutive_deltas_are_merged():
+    buffer = BroadcastBuffer()
+    buffer.add_delta(1, 4, [insert('甲')])
+    buffer.add_delta('1', 5, [insert('乙')])
+    buffer.add_delta(1, 6, [{'op': 'remove', 'name': '甲'}])
+    deltas, snapshots, dirty = buffer.take()
+    assert deltas == {'1': {'base': 3, 'version': 6, 'ops': [insert('甲'), insert('乙'), {'op': 'remove', 'name': '甲'}]}}
+    assert snapshots == set()
+    assert dirty == {'1'}
+
+
+def test_gap_falls_back_to_snapshot():
+    buffer = BroadcastBuffer()
+    buffer.add_delta(1, 4, [insert('甲')])
+    buffer.add_delta(1, 6, [insert('乙')])
+    # 已改发快照的老师本tick内后续的增量不再暂存
+    buffer.add_delta(1, 7, [insert('丙')])
+    deltas, snapshots, dirty = buffer.take()
+    assert deltas == {}
+    assert snapshots == {'1'}
+    assert dirty == {'1'}
+
+
+def test_snapshot_discards_pending_delta():
+    buffer = BroadcastBuffer()
+    buffer.add_delta(1, 4, [insert('甲')])
+    buffer.add_delta(2, 9, [insert('乙')])
+    buffer.add_snapshot(1)
+    deltas, snapshots, dirty = buffer.take()
+    assert [*deltas] == ['2']
+    assert snapshots == {'1'}
+    assert dirty == {'1', '2'}
+
+
+def test_take_clears_buffer():
+    buffer = BroadcastBuffer()
+    buffer.add_delta(1, 4, [insert('甲')])
+    buffer.take()
+    assert buffer.take() == ({}, set(), set())
+    # 下一tick从新的版本重新开始合并
+    buffer.add_delta(1, 8, [insert('乙')])
+    assert buffer.take()[0] == {'1': {'base': 7, 'version': 8, 'ops': [insert('乙')]}}
+
+
+def test_ops_are_copied():
+    buffer = BroadcastBuffer()
+    ops = [insert('甲')]
+    buffer.add_delta(1, 1, ops)
+    buffer.add_delta(1, 2, [insert('乙')])
+    assert ops == [insert('甲')]
+
+
+def test_overview_row():
+    model = TeacherQueue.from_documents([
+        {'name': '甲', 'status': 'completed', 'type': '自主预约'},
+        {'name': '乙', 'status': 'current', 'type': '自主预约'},
+        {'name': '丙', 'status': 'waiting', 'type': '自主预约'},
+    ], version=3)
+    assert overview_row(1, model) == ['1', 3, '乙', 1]
+    model.set_status('乙', Status.COMPLETED)
+    assert overview_row(1, model) == ['1', 3, None, 1]
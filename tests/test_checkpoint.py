@@ -0,0 +1,119 @@
+# coding=UTF-8
+"""预热快照：保存与读取、原子替换、文件损坏或过旧时退回完整加载，以及重启后按数据库校正"""
+import os
+import pickle
+import time
+
+import pytest
+
+from checkpoint import FORMAT_VERSION, CheckpointFile
+from conftest import ROOT
+from events import Event
+from queue_model import Status
+from storage import MemoryClient
+
+CONFIG = {'id': 'test', 'teachers': 'teacher.json', 'appointment_start': '2026-11-20T08:00:00', 'conversion_start': '2025-11-21T16:45:00'}
+
+
+def new_event(db):
+    return Event(CONFIG, db, ROOT)
+
+
+@pytest.fixture
+def db():
+    return MemoryClient()['aqs_test']
+
+
+@pytest.fixture
+def loaded(db):
+    """已完整加载、老师1的队列中有两位家长的场次"""
+    event = new_event(db)
+    event.load_teachers()
+    model = event.queues['1']
+    ops = [model.append('甲', '自主预约'), model.append('乙', '指定预约'), model.set_status('甲', Status.CURRENT)]
+    event.teacher.update_one({'id': '1'}, {'$set': {'queue': model.to_documents(), 'active': 2}, '$inc': {'version': len(ops)}})
+    model.version += len(ops)
+    event.apply_queue_ops('1', model.version, [])
+    return event
+
+
+def test_round_trip_and_warm_start(db, loaded, tmp_path):
+    checkpoint = CheckpointFile(str(tmp_path / 'state' / 'warm_start.pkl'))
+    assert checkpoint.save([loaded])
+    restarted = new_event(db)
+    stale, active = restarted.warm_start(checkpoint.load()['test'])
+    assert stale == []
+    assert restarted.queues['1'].to_documents() == loaded.queues['1'].to_documents()
+    assert restarted.queues['1'].version == loaded.queues['1'].version
+    assert restarted.setting_memory['1']['peoples'] == 2
+    assert restarted.queues_version == loaded.queues_version
+    assert active['1'] == 2
+
+
+def test_save_skipped_when_unchanged(loaded, tmp_path):
+    checkpoint = CheckpointFile(str(tmp_path / 'warm_start.pkl'))
+    assert checkpoint.save([loaded])
+    assert not checkpoint.save([loaded])
+    assert checkpoint.save([loaded], force=True)
+    loaded.queues_version += 1
+    assert checkpoint.save([loaded])
+
+
+def test_failed_write_keeps_previous_snapshot(loaded, tmp_path, monkeypatch):
+    path = tmp_path / 'warm_start.pkl'
+    checkpoint = CheckpointFile(str(path))
+    checkpoint.save([loaded])
+    previous = path.read_bytes()
+
+    def broken_dump(data, f, protocol=None):
+        f.write(b'half written')
+        raise pickle.PicklingError('cannot pickle')
+    monkeypatch.setattr(pickle, 'dump', broken_dump)
+    with pytest.raises(pickle.PicklingError):
+        checkpoint.save([loaded], force=True)
+    assert path.read_bytes() == previous
+    assert os.listdir(tmp_path) == ['warm_start.pkl']
+
+
+@pytest.mark.parametrize('content', [
+    b'not a pickle',
+    b'',
+    pickle.dumps(['unexpected']),
+    pickle.dumps({'format': FORMAT_VERSION + 1, 'saved_at': time.time(), 'events': {'test': {}}}),
+    pickle.dumps({'format': FORMAT_VERSION, 'saved_at': time.time() - 7200, 'events': {'test': {}}}),
+])
+def test_unusable_file_falls_back(tmp_path, content):
+    path = tmp_path / 'warm_start.pkl'
+    path.write_bytes(content)
+    assert CheckpointFile(str(path), max_age=3600).load() == {}
+    assert CheckpointFile(str(tmp_path / 'missing.pkl')).load() == {}
+
+
+def test_changed_queue_reloaded_by_reconcile(db, loaded, tmp_path):
+    checkpoint = CheckpointFile(str(tmp_path / 'warm_start.pkl'))
+    checkpoint.save([loaded])
+    # 保存快照之后、重启之前，其他worker修改了老师1的队列，名额计数器也有误差
+    queue = [{'name': '甲', 'status': 'completed', 'type': '自主预约'}, {'name': '乙', 'status': 'current', 'type': '指定预约'}]
+    db.teacher.update_one({'id': '1'}, {'$set': {'queue': queue, 'active': 5}, '$inc': {'version': 1}})
+    restarted = new_event(db)
+    stale, active = restarted.warm_start(checkpoint.load()['test'])
+    assert stale == ['1']
+    # 队列重新读取之前先显示数据库中的计数
+    assert restarted.setting_memory['1']['peoples'] == 5
+    assert restarted.reconcile(stale, active) == 1
+    assert restarted.queues['1'].to_documents() == queue
+    assert restarted.setting_memory['1']['peoples'] == 1
+    assert db.teacher.find_one({'id': '1'})['active'] == 1
+
+
+def test_snapshot_rejected_for_other_roster(db, loaded, tmp_path):
+    state = loaded.export_state()
+    state['teachers'] = state['teachers'][:1]
+    assert new_event(db).warm_start(state) is None
+
+
+def test_save_checkpoint_never_raises(main_app, monkeypatch):
+    def changed_during_iteration(*args, **kwargs):
+        raise RuntimeError('dictionary changed size during iteration')
+    monkeypatch.setattr(main_app.checkpoint, 'save', changed_during_iteration)
+    main_app.save_checkpoint()
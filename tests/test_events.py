@@ -0,0 +1,30 @@
+# coding=UTF-8
+"""场次配置：id、集合前缀与命名空间都不能重复"""
+import json
+
+import pytest
+
+from events import EventRegistry
+from storage import MemoryClient
+
+
+def registry(tmp_path, configs):
+    (tmp_path / 'events.json').write_text(json.dumps(configs, ensure_ascii=False), encoding='utf-8')
+    return EventRegistry('events.json', MemoryClient()['aqs_test'], {}, base_dir=str(tmp_path))
+
+
+def test_distinct_events_accepted(tmp_path):
+    configs = [{'id': 'grade7', 'namespace': '/'}, {'id': 'grade8', 'prefix': 'grade8_', 'namespace': '/grade8'}]
+    assert registry(tmp_path, configs).read() == configs
+
+
+@pytest.mark.parametrize('configs, key', [
+    # 都不写前缀时两个场次共用同一组集合
+    ([{'id': 'grade7', 'namespace': '/'}, {'id': 'grade8', 'namespace': '/grade8'}], 'prefix'),
+    ([{'id': 'grade7', 'prefix': 'a_', 'namespace': '/'}, {'id': 'grade8', 'prefix': 'a_', 'namespace': '/grade8'}], 'prefix'),
+    ([{'id': 'grade7', 'prefix': 'a_'}, {'id': 'grade8', 'prefix': 'b_'}], 'namespace'),
+    ([{'id': 'grade7', 'prefix': 'a_', 'namespace': '/a'}, {'id': 'grade7', 'prefix': 'b_', 'namespace': '/b'}], 'id'),
+])
+def test_duplicate_keys_rejected(tmp_path, configs, key):
+    with pytest.raises(ValueError, match=f'场次的{key}不能重复'):
+        registry(tmp_path, configs).read()
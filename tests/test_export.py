@@ -0,0 +1,37 @@
+# coding=UTF-8
+"""名单导出：全部老师的名单只有管理员可以下载"""
+import io
+import zipfile
+
+import pytest
+
+
+@pytest.fixture
+def login(main_app, event, monkeypatch):
+    monkeypatch.setitem(main_app.app.config, 'ADMIN_KEY', 'admin-test')
+
+    def login(key, address):
+        # 登录接口按IP限流，每个客户端使用不同的地址
+        client = main_app.app.test_client()
+        headers = {'X-Forwarded-For': address}
+        assert client.post('/verify-key', json={'key': key}, headers=headers).get_json()['success']
+        client.post('/handle', json={'name': '1'}, headers=headers)
+        return client
+    return login
+
+
+def test_teacher_cannot_download_all(main_app, login):
+    client = login(main_app.app.config['TEACHER_KEY'], '10.9.0.1')
+    assert client.get('/teacher/list/download_all').status_code == 403
+    assert '/teacher/list/download_all' not in client.get('/teacher/list').get_data(as_text=True)
+    assert client.get('/teacher/list/download').status_code == 200
+
+
+def test_admin_downloads_all(main_app, event, login):
+    client = login('admin-test', '10.9.0.2')
+    assert '/teacher/list/download_all' in client.get('/teacher/list').get_data(as_text=True)
+    response = client.get('/teacher/list/download_all?format=csv')
+    assert response.status_code == 200
+    names = zipfile.ZipFile(io.BytesIO(response.get_data())).namelist()
+    assert len(names) == len(event.teachers)
+    assert all(name.endswith('.csv') for name in names)
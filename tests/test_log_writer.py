@@ -0,0 +1,40 @@
+# coding=UTF-8
+"""日志写入：eventlet下写入线程必须是系统线程，hub被占住时日志照样落盘"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+from log_writer import LogWriter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 写入日志后用未打补丁的sleep占住hub，绿色线程在此期间得不到运行
+SCENARIO = r'''
+import eventlet
+eventlet.monkey_patch()
+import os, sys
+from eventlet import patcher
+from log_writer import LogWriter
+writer = LogWriter(sys.argv[1], flush_interval=0.05)
+writer.write('test.log', 'hello\n')
+patcher.original('time').sleep(1)
+path = os.path.join(sys.argv[1], 'test.log')
+print(open(path).read() if os.path.exists(path) else '')
+'''
+
+
+def test_writes_while_hub_is_busy(tmp_path):
+    pytest.importorskip('eventlet')
+    output = subprocess.run([sys.executable, '-c', SCENARIO, str(tmp_path)], cwd=ROOT, capture_output=True, text=True, timeout=30)
+    assert output.returncode == 0, output.stderr
+    assert output.stdout.strip() == 'hello'
+
+
+def test_duplicates_merged(tmp_path):
+    writer = LogWriter(str(tmp_path), flush_interval=0.01, dedup_window=60)
+    for _ in range(3):
+        writer.write('error.log', 'boom\n', key='boom')
+    writer.close()
+    assert (tmp_path / 'error.log').read_text(encoding='utf-8') == 'boom\n'
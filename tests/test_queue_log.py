@@ -0,0 +1,96 @@
+# coding=UTF-8
+"""QueueLog：按版本号或时刻重放出的队列与当时的实际队列一致，tail在版本不连续时返回None"""
+import time
+from datetime import datetime
+
+import pytest
+
+from queue_log import QueueLog, apply_ops
+from queue_model import Status, TeacherQueue
+from storage import MemoryClient
+
+TEACHER = '1'
+
+
+class Recorder:
+    """像应用一样修改队列：写回老师记录、记录事件，并保存每个版本的实际队列"""
+
+    def __init__(self, snapshot_every):
+        self.db = MemoryClient()['aqs_test']
+        self.log = QueueLog(self.db, snapshot_every=snapshot_every)
+        self.log.ensure_indexes()
+        self.model = TeacherQueue()
+        self.db.teacher.insert_one({'id': TEACHER, 'queue': [], 'version': 0})
+        self.log.ensure_baseline(self.db.teacher.find())
+        self.history = {0: []}
+
+    def change(self, op):
+        self.model.version += 1
+        self.db.teacher.update_one({'id': TEACHER}, {'$set': {'queue': self.model.to_documents(), 'version': self.model.version}})
+        self.log.record(TEACHER, self.model.version, 'test', [op])
+        self.log.flush()
+        self.history[self.model.version] = self.model.to_documents()
+
+
+def play(recorder, steps):
+    names = ['甲', '乙', '丙', '丁']
+    for step in range(steps):
+        name = names[step % len(names)]
+        if name not in recorder.model:
+            op = recorder.model.append(name, '自主预约')
+        elif step % 3 == 0:
+            op = recorder.model.move_to_tail(name, Status.WAITING)
+        elif step % 3 == 1:
+            op = recorder.model.set_status(name, Status.CURRENT) or recorder.model.remove(name)
+        else:
+            op = recorder.model.remove(name)
+        recorder.change(op)
+
+
+@pytest.mark.parametrize('snapshot_every', [1, 3, 50])
+def test_state_at_version(snapshot_every):
+    recorder = Recorder(snapshot_every)
+    play(recorder, 20)
+    for version, queue in recorder.history.items():
+        assert recorder.log.state_at(TEACHER, version=version) == (queue, version)
+    assert recorder.log.state_at(TEACHER) == (recorder.history[20], 20)
+
+
+def test_state_at_time():
+    recorder = Recorder(snapshot_every=4)
+    play(recorder, 6)
+    middle = datetime.utcnow()
+    time.sleep(0.01)
+    play(recorder, 5)
+    assert recorder.log.state_at(TEACHER, at=middle) == (recorder.history[6], 6)
+
+
+def test_tail_returns_consecutive_events():
+    recorder = Recorder(snapshot_every=50)
+    play(recorder, 5)
+    events = recorder.log.tail(TEACHER, 2)
+    assert [event['version'] for event in events] == [3, 4, 5]
+    queue = [dict(item) for item in recorder.history[2]]
+    for event in events:
+        apply_ops(queue, event['ops'])
+    assert queue == recorder.history[5]
+    assert recorder.log.tail(TEACHER, 5) == []
+
+
+def test_tail_with_gap_returns_none():
+    recorder = Recorder(snapshot_every=50)
+    play(recorder, 3)
+    # 一次未记录事件的写入（如其他worker的批量修改）使版本号出现缺口
+    recorder.model.version += 1
+    play(recorder, 2)
+    assert recorder.log.tail(TEACHER, 3) is None
+    assert recorder.log.tail(TEACHER, 1) is None
+    assert [event['version'] for event in recorder.log.tail(TEACHER, 4)] == [5, 6]
+
+
+def test_duplicate_event_is_ignored():
+    recorder = Recorder(snapshot_every=50)
+    play(recorder, 2)
+    recorder.log.record(TEACHER, 2, 'test', [{'op': 'remove', 'name': '甲'}])
+    recorder.log.flush()
+    assert recorder.log.state_at(TEACHER) == (recorder.history[2], 2)
@@ -0,0 +1,81 @@
+# coding=UTF-8
+"""TeacherQueue的排位与前方人数与按列表逐项计算的结果一致"""
+import random
+
+import pytest
+
+from queue_log import apply_ops
+from queue_model import Status, TeacherQueue
+
+
+def reference_position(queue, name):
+    names = [item['name'] for item in queue]
+    return names.index(name) if name in names else None
+
+
+def reference_ahead(queue, name):
+    position = reference_position(queue, name)
+    if position is None:
+        return 0
+    return sum(item['status'] != 'completed' for item in queue[:position])
+
+
+def check(model, queue):
+    assert model.to_documents() == queue
+    assert len(model) == len(queue)
+    assert model.active_count == sum(item['status'] != 'completed' for item in queue)
+    assert set(model.current) == {item['name'] for item in queue if item['status'] == 'current'}
+    for name in {item['name'] for item in queue} | {'不在队列中'}:
+        assert model.position(name) == reference_position(queue, name)
+        assert model.ahead(name) == reference_ahead(queue, name)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_matches_list_reference(seed):
+    rng = random.Random(seed)
+    names = [f'家长{i}' for i in range(12)]
+    model = TeacherQueue()
+    queue = []
+    # 操作次数远超初始容量，覆盖序号用尽后的重新编号
+    for _ in range(300):
+        name = rng.choice(names)
+        action = rng.random()
+        if action < 0.35:
+            op = model.append(name, rng.choice(['自主预约', '指定预约']))
+        elif action < 0.55:
+            op = model.remove(name)
+        elif action < 0.8:
+            op = model.set_status(name, rng.choice([Status.WAITING, Status.CURRENT, Status.COMPLETED]))
+        else:
+            op = model.move_to_tail(name, rng.choice([Status.WAITING, Status.CURRENT]))
+        if op is not None:
+            apply_ops(queue, [op])
+        check(model, queue)
+
+
+def test_from_documents_round_trip():
+    queue = [
+        {'name': '甲', 'status': 'completed', 'type': '自主预约'},
+        {'name': '乙', 'status': 'current', 'type': '指定预约'},
+        {'name': '丙', 'status': 'waiting', 'type': '自主预约'},
+    ]
+    model = TeacherQueue.from_documents(queue, version=7)
+    assert model.version == 7
+    check(model, queue)
+    assert model.current_entry().name == '乙'
+
+
+def test_move_to_tail_merges_duplicates():
+    model = TeacherQueue.from_documents([
+        {'name': '甲', 'status': 'waiting', 'type': '指定预约'},
+        {'name': '乙', 'status': 'waiting', 'type': '自主预约'},
+        {'name': '甲', 'status': 'current', 'type': '指定预约'},
+    ])
+    op = model.move_to_tail('甲', Status.WAITING)
+    assert model.to_documents() == [
+        {'name': '乙', 'status': 'waiting', 'type': '自主预约'},
+        {'name': '甲', 'status': 'waiting', 'type': '指定预约'},
+    ]
+    assert op == {'op': 'move_tail', 'name': '甲', 'status': 'waiting'}
+    assert not model.current
+    assert model.ahead('甲') == 1
@@ -0,0 +1,55 @@
+# coding=UTF-8
+"""两级限流存储：同步遇到任何异常后后台线程继续运行，待写入的命中保留到下一轮"""
+import time
+
+from ratelimit import TieredStorage
+from storage import MemoryClient
+
+
+class FlakyCollection:
+    """前几次批量写入抛出非数据库异常"""
+
+    def __init__(self, collection, failures):
+        self._collection = collection
+        self.failures = failures
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def bulk_write(self, requests, **kwargs):
+        if self.failures:
+            self.failures -= 1
+            raise TypeError('unexpected document')
+        return self._collection.bulk_write(requests, **kwargs)
+
+
+def wait_for(condition, timeout=3):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_sync_survives_unexpected_errors():
+    errors = []
+    storage = TieredStorage('tiered+mongodb://127.0.0.1:1/', sync_interval=0.01, on_error=errors.append)
+    collection = MemoryClient()['limits']['ratelimit']
+    storage.collection = FlakyCollection(collection, failures=2)
+    assert storage.acquire_entry('login/10.0.0.1', 10, 60)
+    assert wait_for(lambda: collection.count_documents({}) == 1)
+    assert [type(error) for error in errors] == [TypeError, TypeError]
+    assert storage.thread.is_alive()
+    assert collection.find_one({})['hits'] == [*storage.events['login/10.0.0.1']]
+
+
+def test_remote_hits_count_against_limit():
+    storage = TieredStorage('tiered+mongodb://127.0.0.1:1/', sync_interval=0.01)
+    collection = MemoryClient()['limits']['ratelimit']
+    storage.collection = collection
+    now = time.time()
+    collection.insert_one({'_id': 'other|key', 'key': 'key', 'worker': 'other', 'hits': [now, now]})
+    assert storage.acquire_entry('key', 3, 60)
+    assert wait_for(lambda: len(storage.remote.get('key', ())) == 2)
+    assert not storage.acquire_entry('key', 3, 60)
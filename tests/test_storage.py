@@ -0,0 +1,94 @@
+# coding=UTF-8
+"""内存引擎：占用名额的条件更新是原子的，名额已满或家长已在队列中时不写入"""
+import threading
+
+import pymongo
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+from storage import MemoryClient
+
+
+def reserve(name):
+    """与main_app.reserve_op相同的条件更新"""
+    return (
+        {'id': '1', 'queue.name': {'$ne': name}, '$expr': {'$lt': [{'$ifNull': ['$active', 0]}, '$maxParents']}},
+        {'$push': {'queue': {'name': name, 'status': 'waiting', 'type': '自主预约'}}, '$inc': {'active': 1, 'version': 1}}
+    )
+
+
+def release(name):
+    """与main_app.release_ops中归还名额的条件更新相同"""
+    return (
+        {'id': '1', 'queue': {'$elemMatch': {'name': name, 'status': {'$ne': 'completed'}}}},
+        {'$pull': {'queue': {'name': name}}, '$inc': {'active': -1, 'version': 1}}
+    )
+
+
+@pytest.fixture
+def teacher():
+    collection = MemoryClient()['aqs_test'].teacher
+    collection.create_index('id', unique=True)
+    collection.insert_one({'id': '1', 'maxParents': 2, 'queue': [], 'version': 0})
+    return collection
+
+
+def test_full_teacher_rejects_reservation(teacher):
+    assert teacher.find_one_and_update(*reserve('甲'), return_document=pymongo.ReturnDocument.AFTER)['active'] == 1
+    assert teacher.find_one_and_update(*reserve('乙')) is not None
+    assert teacher.find_one_and_update(*reserve('丙')) is None
+    data = teacher.find_one({'id': '1'}, {'_id': 0})
+    assert [item['name'] for item in data['queue']] == ['甲', '乙']
+    assert (data['active'], data['version']) == (2, 2)
+
+
+def test_duplicate_parent_rejected(teacher):
+    assert teacher.update_one(*reserve('甲')).modified_count == 1
+    assert teacher.update_one(*reserve('甲')).matched_count == 0
+    assert teacher.find_one({'id': '1'})['active'] == 1
+
+
+def test_release_frees_slot(teacher):
+    teacher.update_one(*reserve('甲'))
+    teacher.update_one(*reserve('乙'))
+    assert teacher.update_one(*release('甲')).modified_count == 1
+    assert teacher.update_one(*release('甲')).matched_count == 0
+    assert teacher.update_one(*reserve('丙')).modified_count == 1
+    assert [item['name'] for item in teacher.find_one({'id': '1'})['queue']] == ['乙', '丙']
+
+
+def test_concurrent_reservations_never_exceed_capacity(teacher):
+    teacher.update_one({'id': '1'}, {'$set': {'maxParents': 5}})
+    barrier = threading.Barrier(40)
+    results = []
+
+    def book(number):
+        barrier.wait()
+        results.append(teacher.find_one_and_update(*reserve(f'家长{number}')) is not None)
+    threads = [threading.Thread(target=book, args=(number,)) for number in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    data = teacher.find_one({'id': '1'})
+    assert results.count(True) == 5
+    assert data['active'] == len(data['queue']) == 5
+    assert data['version'] == 5
+
+
+def test_bulk_reserve_stops_at_capacity(teacher):
+    result = teacher.bulk_write([pymongo.UpdateOne(*reserve(name)) for name in ['甲', '乙', '丙', '甲']], ordered=True)
+    assert (result.matched_count, result.modified_count) == (2, 2)
+    assert [item['name'] for item in teacher.find_one({'id': '1'})['queue']] == ['甲', '乙']
+
+
+def test_version_compare_and_swap(teacher):
+    assert teacher.update_one({'id': '1', 'version': {'$in': [0, None]}}, {'$set': {'queue': []}, '$inc': {'version': 1}}).matched_count == 1
+    # 另一个请求仍以旧版本号写入时不匹配
+    assert teacher.update_one({'id': '1', 'version': 0}, {'$set': {'queue': []}, '$inc': {'version': 1}}).matched_count == 0
+    assert teacher.find_one({'id': '1'})['version'] == 1
+
+
+def test_unique_index(teacher):
+    with pytest.raises(DuplicateKeyError):
+        teacher.insert_one({'id': '1'})